@@ -0,0 +1,253 @@
+"""Throughput and latency benchmark for the broker transport.
+
+Runs each scenario for every sample message, from the small router task up to a
+full itinerary state (see sample_messages):
+
+  enqueue       enqueue_task one at a time, and enqueue_many in pipelined batches
+  cycle         start_atomic_task -> finish_atomic_task, per-task latency
+  requeue_dlq   requeue_failed_task and move_to_dlq with the task at the far end of a
+                processing list holding --depths other in-flight tasks (LREM scans
+                the list, so this is the cost of failing the oldest task; list
+                transport only)
+  fanout        publish_event to --subscribers AsyncMessageBrokers on one channel,
+                delivery rate and publish-to-callback latency
+
+Rows are printed as a table, or as JSON lines with --json. --output appends the JSON
+lines to a file, tagged with the run's start time, backend, transport and codec, so
+results of broker changes can be compared run over run.
+
+USAGE:
+  $ python benchmarks/broker_benchmark.py --fakeredis
+  $ python benchmarks/broker_benchmark.py --tasks 5000 --transport stream --json
+  $ python benchmarks/broker_benchmark.py --scenario cycle --scenario fanout --output results.jsonl
+"""
+import asyncio
+import json
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+
+import click
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import redis_connection
+import wire_codec
+from message_broker import AsyncMessageBroker, MessageBroker, agent_dead_letter_queue, agent_processing_queue, agent_task_queue
+from benchmarks.sample_messages import SAMPLES, router_task
+
+AGENT = "broker_bench"
+SCENARIOS = ("enqueue", "cycle", "requeue_dlq", "fanout")
+
+
+def _percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def _latency_fields(latencies_s: list[float]) -> dict:
+    if not latencies_s:
+        return {"p50_ms": None, "p99_ms": None}
+    return {
+        "p50_ms": round(statistics.median(latencies_s) * 1000, 3),
+        "p99_ms": round(_percentile(latencies_s, 99) * 1000, 3),
+    }
+
+
+def _tasks(message: dict, count: int) -> list[dict]:
+    """Copies of ``message`` with their own IDs, so the broker's dedup window never drops one."""
+    tasks = []
+    for i in range(count):
+        task = json.loads(json.dumps(message))
+        task["header"]["correlation_id"] = f"bench-{i}"
+        task["header"]["message_id"] = str(uuid.uuid4())
+        tasks.append(task)
+    return tasks
+
+
+def _encoded(broker: MessageBroker, message: dict) -> bytes:
+    """The message as the broker stores it, with its codec and compression settings."""
+    return wire_codec.encode(message, broker.codec, broker.compressor, broker.compress_threshold)
+
+
+def _cleanup(broker: MessageBroker):
+    queue, processing = agent_task_queue(AGENT), agent_processing_queue(AGENT)
+    lanes = [queue, broker.lane_name(queue, "background")]
+    broker.redis_client.delete(*map(broker.delayed_name, lanes), processing, agent_dead_letter_queue(AGENT), broker.dedup_name(processing))
+    if broker.transport == "stream":
+        # Empty the streams but keep them and their consumer groups, which the broker caches as created.
+        for lane in lanes:
+            broker.redis_client.xtrim(lane, maxlen=0)
+    else:
+        broker.redis_client.delete(*lanes)
+
+
+def bench_enqueue(broker: MessageBroker, message: dict, tasks: int, batch_size: int) -> list[dict]:
+    queue = agent_task_queue(AGENT)
+    rows = []
+    batch = _tasks(message, tasks)
+    _cleanup(broker)
+    start = time.perf_counter()
+    for task in batch:
+        broker.enqueue_task(queue, task)
+    rows.append({"mode": "single", "per_s": round(tasks / (time.perf_counter() - start))})
+    _cleanup(broker)
+    start = time.perf_counter()
+    for i in range(0, tasks, batch_size):
+        broker.enqueue_many([(queue, task) for task in batch[i:i + batch_size]])
+    rows.append({"mode": f"batch_{batch_size}", "per_s": round(tasks / (time.perf_counter() - start))})
+    _cleanup(broker)
+    return rows
+
+
+def bench_cycle(broker: MessageBroker, message: dict, tasks: int) -> list[dict]:
+    queue, processing = agent_task_queue(AGENT), agent_processing_queue(AGENT)
+    _cleanup(broker)
+    broker.enqueue_many([(queue, task) for task in _tasks(message, tasks)])
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(tasks):
+        cycle_start = time.perf_counter()
+        task = broker.start_atomic_task(queue, processing, timeout=1)
+        if task is None:
+            break
+        broker.finish_atomic_task(processing, task)
+        latencies.append(time.perf_counter() - cycle_start)
+    elapsed = time.perf_counter() - start
+    _cleanup(broker)
+    return [{"mode": "start_finish", "per_s": round(len(latencies) / elapsed) if elapsed else 0, "completed": len(latencies), **_latency_fields(latencies)}]
+
+
+def bench_requeue_dlq(broker: MessageBroker, message: dict, depths: list[int], repetitions: int) -> list[dict]:
+    queue, processing, dlq = agent_task_queue(AGENT), agent_processing_queue(AGENT), agent_dead_letter_queue(AGENT)
+    filler = _encoded(broker, router_task())
+    rows = []
+    for depth in depths:
+        _cleanup(broker)
+        for i in range(0, depth, 1000):
+            broker.redis_client.lpush(processing, *[filler] * min(1000, depth - i))
+        for operation in ("requeue", "dlq"):
+            latencies = []
+            for task in _tasks(message, repetitions):
+                broker.enqueue_task(queue, task)
+                started = broker.start_atomic_task(queue, processing, timeout=1)
+                # The started task is at the head; rotate it behind the fillers, like the oldest in-flight task.
+                broker.redis_client.lmove(processing, processing, "LEFT", "RIGHT")
+                op_start = time.perf_counter()
+                if operation == "requeue":
+                    broker.requeue_failed_task(processing, queue, started)
+                else:
+                    broker.move_to_dlq(processing, dlq, started)
+                latencies.append(time.perf_counter() - op_start)
+                broker.redis_client.delete(queue, dlq)
+            rows.append({"mode": operation, "processing_depth": depth, "per_s": round(len(latencies) / sum(latencies)), **_latency_fields(latencies)})
+    _cleanup(broker)
+    return rows
+
+
+async def _fanout(message: dict, subscribers: int, messages: int) -> dict:
+    channel = f"bench:fanout:{uuid.uuid4()}"
+    latencies, done = [], asyncio.Event()
+    expected = subscribers * messages
+
+    def on_event(data: dict):
+        latencies.append(time.perf_counter() - data["bench_sent"])
+        if len(latencies) >= expected:
+            done.set()
+
+    brokers = [AsyncMessageBroker() for _ in range(subscribers)]
+    for broker in brokers:
+        await broker.subscribe_to_channel(channel, on_event)
+    publisher = AsyncMessageBroker()
+    # Let every listener task start reading before publishing.
+    await asyncio.sleep(0.2)
+    start = time.perf_counter()
+    for _ in range(messages):
+        await publisher.publish_event(channel, {**message, "bench_sent": time.perf_counter()})
+    try:
+        await asyncio.wait_for(done.wait(), timeout=30)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.perf_counter() - start
+    for broker in (*brokers, publisher):
+        await broker.close()
+    return {"mode": "pubsub", "subscribers": subscribers, "delivered": len(latencies), "expected": expected, "per_s": round(len(latencies) / elapsed), **_latency_fields(latencies)}
+
+
+async def bench_fanout(bases: list[dict], subscriber_counts: list[int], messages: int) -> list[dict]:
+    """Runs every fan-out on one event loop, since the shared asyncio pool is bound to it."""
+    rows = []
+    for base in bases:
+        message = SAMPLES[base["sample"]]()
+        for subscribers in subscriber_counts:
+            rows.append({**base, "scenario": "fanout", **await _fanout(message, subscribers, messages)})
+    return rows
+
+
+def run(scenarios: list[str], samples: list[str], tasks: int, batch_size: int, depths: list[int], repetitions: int, subscriber_counts: list[int], transport: str, backend: str) -> list[dict]:
+    broker = MessageBroker(transport=transport)
+    meta = {
+        "run_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "backend": backend,
+        "transport": transport,
+        "codec": broker.codec.name,
+    }
+    rows, bases = [], []
+    for sample in samples:
+        message = SAMPLES[sample]()
+        base = {**meta, "sample": sample, "bytes": len(_encoded(broker, message))}
+        bases.append(base)
+        if "enqueue" in scenarios:
+            rows += [{**base, "scenario": "enqueue", **row} for row in bench_enqueue(broker, message, tasks, batch_size)]
+        if "cycle" in scenarios:
+            rows += [{**base, "scenario": "cycle", **row} for row in bench_cycle(broker, message, tasks)]
+        if "requeue_dlq" in scenarios and transport == "list":
+            rows += [{**base, "scenario": "requeue_dlq", **row} for row in bench_requeue_dlq(broker, message, depths, repetitions)]
+    if "fanout" in scenarios:
+        rows += asyncio.run(bench_fanout(bases, subscriber_counts, repetitions))
+    return rows
+
+
+def _int_list(value: str) -> list[int]:
+    return [int(part) for part in value.split(",") if part.strip()]
+
+
+@click.command()
+@click.option("--scenario", "scenarios", multiple=True, type=click.Choice(SCENARIOS), help="Scenario to run; repeat for several. Default: all.")
+@click.option("--sample", "samples", multiple=True, type=click.Choice(list(SAMPLES)), help="Sample message to use; repeat for several. Default: all.")
+@click.option("--tasks", default=2000, show_default=True, help="Tasks per enqueue and cycle run.")
+@click.option("--batch-size", default=100, show_default=True, help="Tasks per enqueue_many call.")
+@click.option("--depths", default="0,100,1000,10000", show_default=True, help="Processing list depths for requeue_dlq, comma-separated.")
+@click.option("--repetitions", default=200, show_default=True, help="Operations per requeue_dlq depth, and messages per fanout run.")
+@click.option("--subscribers", default="1,10,50", show_default=True, help="Subscriber counts for fanout, comma-separated.")
+@click.option("--transport", type=click.Choice(["list", "stream"]), default="list", show_default=True, help="Broker task queue transport.")
+@click.option("--fakeredis", "use_fakeredis", is_flag=True, help="Run against an in-memory fakeredis server instead of REDIS_HOST/REDIS_PORT.")
+@click.option("--json", "as_json", is_flag=True, help="Emit one JSON object per result instead of a table.")
+@click.option("--output", type=click.Path(dir_okay=False), default=None, help="Also append the JSON lines to this file.")
+def main(scenarios, samples, tasks, batch_size, depths, repetitions, subscribers, transport, use_fakeredis, as_json, output) -> None:
+    """Measures broker enqueue, task cycle, requeue/DLQ and Pub/Sub fan-out performance."""
+    if use_fakeredis:
+        redis_connection.use_fakeredis()
+    rows = run(list(scenarios or SCENARIOS), list(samples or SAMPLES), tasks, batch_size, _int_list(depths), repetitions, _int_list(subscribers), transport,
+               "fakeredis" if use_fakeredis else redis_connection.describe_endpoint())
+    if output:
+        with open(output, "a") as f:
+            f.writelines(json.dumps(row) + "\n" for row in rows)
+    if as_json:
+        for row in rows:
+            click.echo(json.dumps(row))
+        return
+    click.echo(f"{'scenario':<12} {'sample':<18} {'bytes':>8} {'mode':<14} {'param':>7} {'per s':>9} {'p50 ms':>9} {'p99 ms':>9}")
+    for row in rows:
+        param = row.get("processing_depth", row.get("subscribers", ""))
+        click.echo(
+            f"{row['scenario']:<12} {row['sample']:<18} {row['bytes']:>8} {row['mode']:<14} {param:>7} "
+            f"{row['per_s']:>9} {str(row.get('p50_ms', '')):>9} {str(row.get('p99_ms', '')):>9}"
+        )
+
+
+if __name__ == "__main__":
+    main()
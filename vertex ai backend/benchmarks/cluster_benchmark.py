@@ -0,0 +1,132 @@
+"""Throughput benchmark for the broker on Redis Cluster.
+
+Drives the full task life cycle (enqueue, start_atomic_task, complete_task with a
+reply to a per-request inbox, pop_reply) for several agents at once and reports
+rates, cycle latency percentiles, and how the agents' hash-tagged keys spread over
+the cluster nodes. Each agent's queues share a hash tag, so the broker's scripts stay
+single-slot; replies to inboxes in another slot take the two-step path, and the
+share of such cycles is reported as ``cross_slot``.
+
+Start a local cluster first, e.g. with ``utils/create-cluster`` from the Redis
+source tree (``create-cluster start && create-cluster create``, ports 30001-30006).
+
+USAGE:
+  $ python benchmarks/cluster_benchmark.py --nodes 127.0.0.1:30001,127.0.0.1:30002,127.0.0.1:30003
+  $ python benchmarks/cluster_benchmark.py --tasks 5000 --agents 9 --transport stream --json
+  $ python benchmarks/cluster_benchmark.py --standalone   # Same workload on REDIS_HOST/REDIS_PORT, for comparison
+"""
+import json
+import os
+import statistics
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+
+import click
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import redis_connection
+from message_broker import MessageBroker, agent_dead_letter_queue, agent_processing_queue, agent_task_queue
+from benchmarks.sample_messages import router_task
+
+
+def _percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def _cleanup(broker: MessageBroker, agents: list[str]):
+    for agent in agents:
+        queue = agent_task_queue(agent)
+        for key in (queue, broker.lane_name(queue, "background"), agent_processing_queue(agent), agent_dead_letter_queue(agent), broker.delayed_name(queue), broker.dedup_name(agent_processing_queue(agent))):
+            broker.redis_client.delete(key)
+
+
+def _node_spread(broker: MessageBroker, agents: list[str]) -> dict[str, int]:
+    """Agents per cluster node (by the node serving their task queue's slot)."""
+    if not redis_connection.is_cluster():
+        return {redis_connection.describe_endpoint(): len(agents)}
+    nodes = Counter(broker.redis_client.get_node_from_key(agent_task_queue(agent)).name for agent in agents)
+    return dict(sorted(nodes.items()))
+
+
+def run(tasks: int, agents: int, transport: str) -> dict:
+    broker = MessageBroker(transport=transport)
+    names = [f"bench_agent_{i}" for i in range(agents)]
+    _cleanup(broker, names)
+    message = router_task()
+
+    start = time.perf_counter()
+    batch = []
+    for i in range(tasks):
+        task = json.loads(json.dumps(message))
+        task["header"]["correlation_id"] = task["header"]["message_id"] = f"bench-{i}"
+        batch.append((agent_task_queue(names[i % agents]), task))
+        if len(batch) == 100:
+            broker.enqueue_many(batch)
+            batch = []
+    broker.enqueue_many(batch)
+    enqueue_seconds = time.perf_counter() - start
+
+    latencies, cross_slot, inboxes = [], 0, []
+    start = time.perf_counter()
+    for i in range(tasks):
+        agent = names[i % agents]
+        processing = agent_processing_queue(agent)
+        cycle_start = time.perf_counter()
+        task = broker.start_atomic_task(agent_task_queue(agent), processing, timeout=1)
+        if task is None:
+            continue
+        inbox = broker.reply_inbox("results:bench", task["header"]["correlation_id"])
+        broker.complete_task(processing, task, inbox, {"header": task["header"], "payload": {"status": "SUCCESS", "data": {}}})
+        latencies.append((time.perf_counter() - cycle_start) * 1000)
+        cross_slot += not redis_connection.same_slot(processing, inbox)
+        inboxes.append(inbox)
+    cycle_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    replies = sum(broker.pop_reply(inbox, timeout=1) is not None for inbox in inboxes)
+    reply_seconds = time.perf_counter() - start
+    _cleanup(broker, names)
+
+    return {
+        "endpoint": redis_connection.describe_endpoint(),
+        "transport": transport,
+        "tasks": tasks,
+        "agents": agents,
+        "enqueue_per_s": round(tasks / enqueue_seconds),
+        "cycle_per_s": round(len(latencies) / cycle_seconds) if cycle_seconds else 0,
+        "cycle_p50_ms": round(statistics.median(latencies), 3) if latencies else None,
+        "cycle_p99_ms": round(_percentile(latencies, 99), 3) if latencies else None,
+        "reply_per_s": round(replies / reply_seconds) if reply_seconds else 0,
+        "replies": replies,
+        "cross_slot": round(cross_slot / len(latencies), 4) if latencies else None,
+        "agents_per_node": _node_spread(broker, names),
+    }
+
+
+@click.command()
+@click.option("--nodes", default=lambda: os.getenv("REDIS_CLUSTER_NODES", "127.0.0.1:30001,127.0.0.1:30002,127.0.0.1:30003"), show_default="REDIS_CLUSTER_NODES or 127.0.0.1:30001-30003", help="Cluster startup nodes, host:port comma-separated.")
+@click.option("--standalone", is_flag=True, help="Run against the standalone REDIS_HOST/REDIS_PORT instead of a cluster.")
+@click.option("--tasks", default=2000, show_default=True, help="Tasks pushed through the full life cycle.")
+@click.option("--agents", default=9, show_default=True, help="Agents (task queues) the tasks are spread over.")
+@click.option("--transport", type=click.Choice(["list", "stream"]), default="list", show_default=True, help="Broker task queue transport.")
+@click.option("--json", "as_json", is_flag=True, help="Emit the result as one JSON object instead of a table.")
+def main(nodes: str, standalone: bool, tasks: int, agents: int, transport: str, as_json: bool) -> None:
+    """Measures broker throughput and key distribution on Redis Cluster."""
+    if standalone:
+        os.environ.pop("REDIS_CLUSTER_NODES", None)
+    else:
+        os.environ["REDIS_CLUSTER_NODES"] = nodes
+    result = run(tasks, agents, transport)
+    if as_json:
+        click.echo(json.dumps(result))
+        return
+    for key, value in result.items():
+        click.echo(f"{key:<16} {value}")
+
+
+if __name__ == "__main__":
+    main()
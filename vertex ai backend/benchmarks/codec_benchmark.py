@@ -0,0 +1,79 @@
+"""Micro-benchmark for the broker wire codecs.
+
+Reports, per sample message and codec, the stored size and the encode/decode CPU
+time per message, and how much each codec saves relative to stdlib JSON.
+Pass --compression to measure a compressor at a given size threshold.
+
+USAGE:
+  $ python benchmarks/codec_benchmark.py
+  $ python benchmarks/codec_benchmark.py --iterations 5000 --json
+  $ python benchmarks/codec_benchmark.py --compression zlib --threshold 4096
+"""
+import json
+import sys
+import time
+from pathlib import Path
+
+import click
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import wire_codec
+from benchmarks.sample_messages import SAMPLES
+
+
+def _per_call_us(func, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def run(iterations: int, compressor: wire_codec.Compressor | None = None, threshold: int = 0) -> list[dict]:
+    rows = []
+    for sample_name, build in SAMPLES.items():
+        message = build()
+        baseline = None
+        for codec_name in wire_codec.available_codecs():
+            codec = wire_codec.get_codec(codec_name)
+            raw = wire_codec.encode(message, codec, compressor, threshold)
+            assert wire_codec.decode(raw) == message, f"{codec_name} did not round-trip {sample_name}"
+            row = {
+                "sample": sample_name,
+                "codec": codec_name,
+                "bytes": len(raw),
+                "encode_us": round(_per_call_us(lambda: wire_codec.encode(message, codec, compressor, threshold), iterations), 2),
+                "decode_us": round(_per_call_us(lambda: wire_codec.decode(raw), iterations), 2),
+            }
+            if codec_name == wire_codec.DEFAULT_CODEC:
+                baseline = row
+            rows.append(row)
+        for row in rows:
+            if row["sample"] == sample_name and baseline:
+                row["bytes_saved"] = baseline["bytes"] - row["bytes"]
+                row["cpu_saved_us"] = round(baseline["encode_us"] + baseline["decode_us"] - row["encode_us"] - row["decode_us"], 2)
+    return rows
+
+
+@click.command()
+@click.option("--iterations", default=2000, show_default=True, help="Encode/decode calls timed per sample and codec.")
+@click.option("--json", "as_json", is_flag=True, help="Emit one JSON object per result instead of a table.")
+@click.option("--compression", default="none", show_default=True, help="Compressor to apply: none, zlib or zstd.")
+@click.option("--threshold", default=0, show_default=True, help="Only compress bodies of at least this many bytes.")
+def main(iterations: int, as_json: bool, compression: str, threshold: int) -> None:
+    """Compares message size and CPU cost of every installed codec."""
+    rows = run(iterations, wire_codec.get_compressor(compression), threshold)
+    if as_json:
+        for row in rows:
+            click.echo(json.dumps(row))
+        return
+    click.echo(f"{'sample':<18} {'codec':<8} {'bytes':>8} {'saved':>7} {'enc us':>8} {'dec us':>8} {'cpu saved us':>13}")
+    for row in rows:
+        click.echo(
+            f"{row['sample']:<18} {row['codec']:<8} {row['bytes']:>8} {row['bytes_saved']:>7} "
+            f"{row['encode_us']:>8} {row['decode_us']:>8} {row['cpu_saved_us']:>13}"
+        )
+
+
+if __name__ == "__main__":
+    main()
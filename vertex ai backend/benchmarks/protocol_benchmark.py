@@ -0,0 +1,87 @@
+"""Micro-benchmark for Message parsing and serialization.
+
+Reports, per sample message, the CPU time per message of:
+
+  legacy_validate   model_validate on the old undiscriminated payload union, where
+                    pydantic tries each payload type in turn
+  validate          model_validate on the message_type-discriminated union
+  legacy_parse      json.loads + legacy model_validate, how a stored message was parsed
+  from_wire         Message.from_wire: pydantic_core JSON parsing + discriminated validation
+  dump_encode       model_dump + wire_codec.encode, how messages are written by the agents
+  to_wire           Message.to_wire: model_dump_json straight to bytes
+
+USAGE:
+  $ python benchmarks/protocol_benchmark.py
+  $ python benchmarks/protocol_benchmark.py --iterations 5000 --json
+"""
+import json
+import sys
+import time
+from pathlib import Path
+
+import click
+from pydantic import BaseModel
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import wire_codec
+from message_protocol import ClarificationPayload, ErrorPayload, EventPayload, Header, Message, ResultPayload, TaskPayload
+from benchmarks.sample_messages import SAMPLES
+
+
+class LegacyMessage(BaseModel):
+    """Message as it was before the payload union was discriminated."""
+    header: Header
+    payload: TaskPayload | ResultPayload | ClarificationPayload | EventPayload | ErrorPayload
+
+
+def _per_call_us(func, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def run(iterations: int) -> list[dict]:
+    codec = wire_codec.get_codec(wire_codec.DEFAULT_CODEC)
+    rows = []
+    for sample_name, build in SAMPLES.items():
+        data = build()
+        message = Message.model_validate(data)
+        raw = wire_codec.encode(data, codec)
+        assert Message.from_wire(raw) == message and Message.from_wire(message.to_wire(codec)) == message, f"{sample_name} did not round-trip"
+        timings = {
+            "legacy_validate": lambda: LegacyMessage.model_validate(data),
+            "validate": lambda: Message.model_validate(data),
+            "legacy_parse": lambda: LegacyMessage.model_validate(json.loads(raw)),
+            "from_wire": lambda: Message.from_wire(raw),
+            "dump_encode": lambda: wire_codec.encode(message.model_dump(), codec),
+            "to_wire": lambda: message.to_wire(codec),
+        }
+        row = {"sample": sample_name, "bytes": len(raw)}
+        row.update({name: round(_per_call_us(func, iterations), 2) for name, func in timings.items()})
+        row["validate_speedup"] = round(row["legacy_validate"] / row["validate"], 2)
+        row["parse_speedup"] = round(row["legacy_parse"] / row["from_wire"], 2)
+        row["write_speedup"] = round(row["dump_encode"] / row["to_wire"], 2)
+        rows.append(row)
+    return rows
+
+
+@click.command()
+@click.option("--iterations", default=2000, show_default=True, help="Calls timed per sample and operation.")
+@click.option("--json", "as_json", is_flag=True, help="Emit one JSON object per sample instead of a table.")
+def main(iterations: int, as_json: bool) -> None:
+    """Compares Message validation and wire (de)serialization paths, in microseconds per message."""
+    rows = run(iterations)
+    if as_json:
+        for row in rows:
+            click.echo(json.dumps(row))
+        return
+    columns = [key for key in rows[0] if key not in ("sample", "bytes")]
+    click.echo(f"{'sample':<18} {'bytes':>7} " + " ".join(f"{column:>16}" for column in columns))
+    for row in rows:
+        click.echo(f"{row['sample']:<18} {row['bytes']:>7} " + " ".join(f"{row[column]:>16}" for column in columns))
+
+
+if __name__ == "__main__":
+    main()
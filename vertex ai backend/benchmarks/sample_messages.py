@@ -0,0 +1,109 @@
+"""Representative broker messages, from the tiny router task up to a full itinerary result.
+
+Shared by the benchmarks in this directory so they all measure the same payloads.
+"""
+import uuid
+from datetime import date, timedelta
+
+from message_protocol import Header, Message, ResultPayload, TaskPayload
+
+
+def router_task() -> dict:
+    """The TASK chat_backend enqueues for the router on every user turn."""
+    return Message(
+        header=Header(
+            correlation_id=str(uuid.uuid4()),
+            message_type="TASK",
+            source_agent="user_interface",
+            target_agent="router_agent",
+            reply_to_channel="results:user_interface",
+        ),
+        payload=TaskPayload(
+            task_name="route_request",
+            parameters={
+                "user_request": "Plan a 5 day trip from Mumbai to Goa next month",
+                "session_id": "user-123_itinerary-456",
+                "user_id": "user-123",
+                "itinerary_id": "itinerary-456",
+            },
+        ),
+    ).model_dump()
+
+
+def specialist_result(options: int = 5) -> dict:
+    """A hotel_agent RESULT carrying a results array, as sent to results:main."""
+    results = [
+        {
+            "name": f"Seaside Resort {i}",
+            "star_rating": 4,
+            "price_per_night": 5400 + 250 * i,
+            "currency": "INR",
+            "address": f"{i} Beach Road, Calangute, Goa 403516",
+            "amenities": ["Pool", "Free WiFi", "Spa", "Airport shuttle", "Breakfast included"],
+            "justification": "Close to the beach, within budget and rated highly for families.",
+        }
+        for i in range(options)
+    ]
+    return Message(
+        header=Header(
+            correlation_id=str(uuid.uuid4()),
+            message_type="RESULT",
+            source_agent="hotel_agent",
+            target_agent="main_agent",
+        ),
+        payload=ResultPayload(status="SUCCESS", data={"results": results, "response": "🏨 **Seaside Resort 0**"}),
+    ).model_dump()
+
+
+def itinerary_result(days: int = 14, items_per_day: int = 6) -> dict:
+    """A main_agent RESULT to results:user_interface embedding the whole itinerary state."""
+    schedule_day = lambda day: [
+        {
+            "activity_type": "activity",
+            "activity_object": f"activity-{day}-{slot}",
+            "origin": "Hotel",
+            "destination": f"Attraction {slot}",
+            "start_time": f"{8 + 2 * slot:02d}:00",
+            "end_time": f"{9 + 2 * slot:02d}:30",
+            "description": "Guided visit with local lunch and time for photos at the viewpoint.",
+            "details": {"price": 1200, "currency": "INR", "booking_reference": f"BK{day:03d}{slot:02d}"},
+            "booking_status": "pending",
+        }
+        for slot in range(items_per_day)
+    ]
+    state = {
+        "user_details": {"name": "Asha", "email": "asha@example.com", "phone_number": "+91 90000 00000"},
+        "preferences": {"travel_theme": ["beach", "culture"], "cuisine_preferences": ["Goan", "seafood"]},
+        "itinerary_created": True,
+        "itinerary": {
+            "trip_name": "Goa getaway",
+            "origin": "Mumbai",
+            "destination": "Goa",
+            "start_date": "2025-12-20",
+            "end_date": (date(2025, 12, 20) + timedelta(days=days - 1)).isoformat(),
+            "days": [
+                {"day_number": day + 1, "date": (date(2025, 12, 20) + timedelta(days=day)).isoformat(), "schedule": schedule_day(day)}
+                for day in range(days)
+            ],
+        },
+        "specialist_results": {"hotel_agent": specialist_result()["payload"]["data"]},
+    }
+    return Message(
+        header=Header(
+            correlation_id=str(uuid.uuid4()),
+            message_type="RESULT",
+            source_agent="main_agent",
+            target_agent="user_interface",
+        ),
+        payload=ResultPayload(
+            status="SUCCESS",
+            data={"response": "Perfect! I've created your complete itinerary.", "user_id": "user-123", "itinerary_id": "itinerary-456", "state": state},
+        ),
+    ).model_dump()
+
+
+SAMPLES = {
+    "router_task": router_task,
+    "specialist_result": specialist_result,
+    "itinerary_result": itinerary_result,
+}
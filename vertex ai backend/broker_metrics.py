@@ -0,0 +1,159 @@
+"""
+Queue and latency metrics for the message broker.
+
+Brokers record into the process-wide REGISTRY: messages enqueued and dequeued per
+queue, the wait between enqueue and dequeue, how long a worker held each task and
+how it ended (completed, requeued or dead-lettered). Agents run as separate
+processes, so every process periodically adds its pending increments to one Redis
+hash (METRICS_KEY). ``render`` turns that hash, plus live queue depths, into the
+Prometheus text format served by chat_backend at ``/metrics``.
+
+Enqueue time is taken from the stream entry ID on the stream transport and from
+``header.timestamp`` (message creation time) otherwise, so for list queues a
+requeued task's wait includes its earlier attempts.
+"""
+import re
+import threading
+from collections import defaultdict
+from datetime import datetime
+from typing import NamedTuple
+
+METRICS_KEY = "metrics:broker"
+# Tasks wait on LLM-bound workers, so buckets run from milliseconds to minutes.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+class Family(NamedTuple):
+    kind: str
+    help: str
+
+
+FAMILIES: dict[str, Family] = {
+    "broker_enqueued_total": Family("counter", "Messages enqueued, per queue."),
+    "broker_dequeued_total": Family("counter", "Messages dequeued, per queue."),
+    "broker_queue_wait_seconds": Family("histogram", "Time between enqueue and dequeue, per queue."),
+    "broker_processing_seconds": Family("histogram", "Time a worker held a task before acking, requeueing or dead-lettering it, per processing queue."),
+    "broker_tasks_finished_total": Family("counter", "Tasks released by workers, per processing queue and outcome (completed, requeued, deferred, dead_lettered, duplicate, expired)."),
+    "broker_admission_rejected_total": Family("counter", "Work refused or deferred because a task queue was above its high-water mark, per queue and priority."),
+    "broker_pubsub_dropped_total": Family("counter", "Pub/Sub messages dropped because a callback's queue was full, per callback."),
+    "broker_claim_checks_total": Family("counter", "Payloads whose data was stored under a claim check instead of in the message."),
+    "broker_claim_check_bytes_total": Family("counter", "Bytes of payload data stored under claim checks."),
+    "broker_payloads_total": Family("counter", "Payloads encoded for writing, by whether they were compressed."),
+    "broker_payload_bytes_in_total": Family("counter", "Bytes of encoded payloads before compression, by whether they were compressed."),
+    "broker_payload_bytes_out_total": Family("counter", "Bytes of encoded payloads as written, by whether they were compressed; out over in for compressed=\"true\" is the compression ratio."),
+    "broker_queue_depth": Family("gauge", "Messages currently in each tasks, processing, delayed, dlq and results queue."),
+}
+QUEUE_DEPTH_PATTERNS = ("tasks:*", "processing:*", "delayed:*", "dlq:*", "results:*")
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def sample_name(name: str, labels: dict[str, str]) -> str:
+    """Formats a sample as it appears in the exposition, e.g. ``name{queue="tasks:x"}``."""
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{key}="{_escape(str(value))}"' for key, value in labels.items()) + "}"
+
+
+class MetricsRegistry:
+    """Accumulates counter and histogram increments until they are drained into Redis."""
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._pending: dict[str, float] = defaultdict(float)
+
+    def inc(self, name: str, labels: dict[str, str], amount: float = 1):
+        with self._lock:
+            self._pending[sample_name(name, labels)] += amount
+
+    def observe(self, name: str, labels: dict[str, str], value: float):
+        with self._lock:
+            for le in self.buckets:
+                # Adding 0 still creates the bucket, so every series exposes the full set.
+                self._pending[sample_name(f"{name}_bucket", {**labels, "le": str(le)})] += 1 if value <= le else 0
+            self._pending[sample_name(f"{name}_bucket", {**labels, "le": "+Inf"})] += 1
+            self._pending[sample_name(f"{name}_sum", labels)] += value
+            self._pending[sample_name(f"{name}_count", labels)] += 1
+
+    def drain(self) -> dict[str, float]:
+        """Returns and clears the increments recorded since the last drain."""
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(float)
+        return dict(pending)
+
+    def restore(self, increments: dict[str, float]):
+        """Puts back increments whose flush failed, so they go out with the next one."""
+        with self._lock:
+            for sample, amount in increments.items():
+                self._pending[sample] += amount
+
+
+REGISTRY = MetricsRegistry()
+
+
+class PayloadSizes:
+    """Records the sizes reported by ``wire_codec.encode`` as payload counters in REGISTRY."""
+
+    def record(self, size_in: int, size_out: int, compressed: bool):
+        labels = {"compressed": "true" if compressed else "false"}
+        REGISTRY.inc("broker_payloads_total", labels)
+        REGISTRY.inc("broker_payload_bytes_in_total", labels, size_in)
+        REGISTRY.inc("broker_payload_bytes_out_total", labels, size_out)
+
+
+PAYLOAD_SIZES = PayloadSizes()
+
+
+def enqueued_at(message: dict, entry_id: str | None = None) -> float | None:
+    """Best-known enqueue time of a message as a UNIX timestamp."""
+    if entry_id:
+        return int(entry_id.split("-", 1)[0]) / 1000
+    timestamp = message.get("header", {}).get("timestamp") if isinstance(message, dict) else None
+    if not timestamp:
+        return None
+    try:
+        return datetime.fromisoformat(timestamp).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+_LE = re.compile(r',?le="([^"]*)"')
+
+
+def _sort_key(sample: str):
+    # Keep histogram buckets of one series together and in ascending order.
+    match = _LE.search(sample)
+    if not match:
+        return sample, 0.0
+    le = match.group(1)
+    return _LE.sub("", sample, count=1), float("inf") if le == "+Inf" else float(le)
+
+
+def _family_of(sample: str) -> str:
+    name = sample.split("{", 1)[0]
+    for suffix in ("_bucket", "_sum", "_count"):
+        base = name[: -len(suffix)]
+        if name.endswith(suffix) and FAMILIES.get(base, Family("", "")).kind == "histogram":
+            return base
+    return name
+
+
+def render(samples: dict[str, float], queue_depths: dict[str, int] | None = None) -> str:
+    """Renders accumulated samples and queue depths in the Prometheus text format (version 0.0.4)."""
+    by_family: dict[str, list[str]] = defaultdict(list)
+    for sample, value in samples.items():
+        by_family[_family_of(sample)].append(f"{sample} {int(value) if value.is_integer() else value}")
+    for queue, depth in sorted((queue_depths or {}).items()):
+        by_family["broker_queue_depth"].append(f"{sample_name('broker_queue_depth', {'queue': queue})} {depth}")
+
+    lines = []
+    for family in sorted(by_family):
+        meta = FAMILIES.get(family)
+        if meta:
+            lines.append(f"# HELP {family} {meta.help}")
+            lines.append(f"# TYPE {family} {meta.kind}")
+        lines.extend(sorted(by_family[family], key=lambda line: _sort_key(line.rsplit(" ", 1)[0])))
+    return "\n".join(lines) + "\n"
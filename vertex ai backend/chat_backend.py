@@ -15,8 +15,9 @@ from firebase_admin import credentials, db
 # Add the project root to the Python path
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '.')))
 
-from message_broker import MessageBroker
-from message_protocol import Message, Header, TaskPayload
+from config import SPECIALIST_AGENTS
+from message_broker import MessageBroker, agent_task_queue
+from message_protocol import Message, Header, TaskPayload, deadline_in
 
 # --- Setup ---
 load_dotenv()
@@ -84,6 +85,14 @@ from redis_session_service import RedisSessionService
 # --- Message Broker ---
 broker = MessageBroker()
 
+# Every queue a chat message passes through. New messages are refused while any of
+# them is above its high-water mark, instead of queueing behind an unbounded backlog.
+ADMISSION_QUEUES = [agent_task_queue(agent) for agent in ("router_agent", "main_agent", *SPECIALIST_AGENTS)]
+
+# How long a chat turn may take end to end. Every task sent for the turn carries the
+# resulting deadline, and agents drop the ones still queued when it passes.
+TURN_TIMEOUT_SECONDS = float(os.getenv("CHAT_TURN_TIMEOUT_SECONDS", "180"))
+
 # --- Session Service ---
 session_service = RedisSessionService()
 
@@ -112,6 +121,14 @@ async def chat(request: Request):
     data = await request.json()
     logger.info(f"Incoming request payload: {json.dumps(data, indent=2)}")
 
+    admission = broker.check_admission(ADMISSION_QUEUES, "interactive")
+    if not admission.admitted:
+        raise HTTPException(
+            status_code=429,
+            detail=f"The assistant is busy, please try again in {admission.retry_after} seconds.",
+            headers={"Retry-After": str(admission.retry_after)},
+        )
+
     try:
         user_message = data["message"]
         user_id = data.get("user_id", "anonymous")
@@ -172,12 +189,14 @@ async def chat(request: Request):
                 message_type="TASK",
                 source_agent="user_interface",
                 target_agent="router_agent",
-                reply_to_channel="results:user_interface"
+                reply_to_channel="results:user_interface",
+                priority="interactive",
+                deadline=deadline_in(TURN_TIMEOUT_SECONDS)
             ),
             payload=task_payload
         )
 
-        main_queue = "tasks:router_agent"
+        main_queue = agent_task_queue("router_agent")
         broker.enqueue_task(main_queue, initial_message.model_dump())
         
         logger.info(f"Enqueued task for router_agent with correlation_id: {correlation_id}")
@@ -194,6 +213,11 @@ async def chat(request: Request):
             logger.error(f"Could not set typing to false after an error: {db_e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
+@app.get("/metrics")
+def metrics():
+    """Broker queue depths and latency metrics for all agents, in the Prometheus text format."""
+    return Response(content=broker.render_metrics(), media_type="text/plain; version=0.0.4")
+
 @app.get("/get_response/{correlation_id}")
 async def get_response(correlation_id: str, user_id: str, itinerary_id: str):
     """
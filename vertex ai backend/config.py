@@ -23,5 +23,11 @@ DOCUMENT_AGENT_A2A_URL: Final[str] = os.getenv("DOCUMENT_AGENT_A2A_URL", "http:/
 HOTEL_AGENT_A2A_URL: Final[str] = os.getenv("HOTEL_AGENT_A2A_URL", "http://127.0.0.1:8010")
 HOST_AGENT_A2A_URL: Final[str] = os.getenv("HOST_AGENT_A2A_URL", "http://127.0.0.1:8000")
 
+# Specialist agents the main agent delegates to; each consumes tasks:<name>.
+SPECIALIST_AGENTS: Final[tuple[str, ...]] = (
+    "flight_agent", "weather_agent", "food_agent", "activity_agent", "budget_agent",
+    "cab_agent", "currency_agent", "document_agent", "hotel_agent",
+)
+
 # ADK Configuration
 ADK_MODEL: Final[str] = os.getenv("ADK_MODEL", "gemini-2.5-flash")
\ No newline at end of file
@@ -3,10 +3,11 @@ import logging
 import asyncio
 import os
 import sys
-from message_broker import MessageBroker
+from message_broker import AsyncMessageBroker, agent_task_queue, agent_processing_queue, agent_dead_letter_queue
 from message_protocol import Message, Header, ResultPayload
 from document_agent.agent import agent
 from google.adk.runners import Runner
+from google.adk.sessions import BaseSessionService
 from redis_session_service import RedisSessionService
 from firebase_state_service import FirebaseStateService
 from main_agent.memory import set_firebase_context
@@ -22,13 +23,13 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 class DocumentAgentExecutor:
-    def __init__(self):
-        self.broker = MessageBroker()
+    def __init__(self, broker: AsyncMessageBroker | None = None, session_service: BaseSessionService | None = None):
+        self.broker = broker or AsyncMessageBroker()
         self.agent_name = "document_agent"
         self.llm_agent = agent
 
         # Redis session service for conversation history
-        self.session_service = RedisSessionService()
+        self.session_service = session_service or RedisSessionService()
 
         # Firebase service for state management
         cred_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'hack2skill-emt-firebase-adminsdk-fbsvc-b2ea50c49d.json'))
@@ -64,15 +65,16 @@ class DocumentAgentExecutor:
         logger.info(f"[{self.agent_name}] Final response length: {len(final_response_text)}")
         return final_response_text
 
-    def run(self):
-        main_queue = f"tasks:{self.agent_name}"
-        processing_queue = f"processing:{self.agent_name}"
-        dlq = f"dlq:{self.agent_name}"
+    async def run(self):
+        main_queue = agent_task_queue(self.agent_name)
+        processing_queue = agent_processing_queue(self.agent_name)
+        dlq = agent_dead_letter_queue(self.agent_name)
         max_retries = 3
 
+        await self.broker.connect()
         logger.info(f"[{self.agent_name}] is waiting for tasks on {main_queue}...")
         while True:
-            task_message_dict = self.broker.start_atomic_task(main_queue, processing_queue)
+            task_message_dict = await self.broker.start_atomic_task(main_queue, processing_queue)
             if not task_message_dict:
                 continue
 
@@ -92,9 +94,7 @@ class DocumentAgentExecutor:
                 logger.info(f"[{self.agent_name}] Task description: {task_description}")
 
                 # Invoke the LLM with Firebase context
-                llm_response_str = asyncio.run(
-                    self._invoke_llm_sync(task_description, session_id, user_id, itinerary_id)
-                )
+                llm_response_str = await self._invoke_llm_sync(task_description, session_id, user_id, itinerary_id)
                 logger.info(f"[{self.agent_name}] Raw LLM response: {llm_response_str[:200]}")
 
                 # Try to parse JSON response, fallback to plain text
@@ -117,6 +117,7 @@ class DocumentAgentExecutor:
 
                 result_header = Header(
                     correlation_id=correlation_id,
+                    task_id=task_message.header.task_id,  # Lets the caller match the reply to its request
                     message_type="RESULT",
                     source_agent=self.agent_name,
                     target_agent=task_message.header.source_agent,
@@ -128,21 +129,19 @@ class DocumentAgentExecutor:
                 result_message = Message(header=result_header, payload=result_payload)
 
                 reply_channel = task_message.header.reply_to_channel or "results:main"
-                self.broker.enqueue_task(reply_channel, result_message.model_dump())
+                # Ack the task and send the result in one atomic round trip
+                await self.broker.complete_task(processing_queue, task_message_dict, reply_channel, result_message.model_dump())
                 logger.info(f"[{self.agent_name}] Sent result to {reply_channel}")
 
-                self.broker.finish_atomic_task(processing_queue, task_message_dict)
-
             except Exception as e:
                 logger.error(f"[{self.agent_name}] Task failed: {e}", exc_info=True)
-                task_message_dict['retry_count'] = task_message_dict.get('retry_count', 0) + 1
-                if task_message_dict['retry_count'] >= max_retries:
-                    self.broker.move_to_dlq(processing_queue, dlq, task_message_dict)
+                # Retry with exponential backoff and jitter, or dead-letter after max_retries
+                retry_delay = await self.broker.fail_task(processing_queue, main_queue, dlq, task_message_dict, max_retries, error=e)
+                if retry_delay is None:
                     logger.error(f"[{self.agent_name}] Task moved to DLQ after {max_retries} retries")
                 else:
-                    self.broker.requeue_failed_task(processing_queue, main_queue, task_message_dict)
-                    logger.warning(f"[{self.agent_name}] Task requeued, retry {task_message_dict['retry_count']}/{max_retries}")
+                    logger.warning(f"[{self.agent_name}] Task retry {task_message_dict['payload']['retry_count']}/{max_retries} scheduled in {retry_delay:.1f}s")
 
 if __name__ == "__main__":
     agent_executor = DocumentAgentExecutor()
-    agent_executor.run()
\ No newline at end of file
+    asyncio.run(agent_executor.run())
\ No newline at end of file
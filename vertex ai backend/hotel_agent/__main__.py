@@ -3,10 +3,13 @@ import logging
 import asyncio
 import os
 import sys
-from message_broker import MessageBroker
+from message_broker import AsyncMessageBroker, agent_task_queue, agent_processing_queue, agent_dead_letter_queue
 from message_protocol import Message, Header, ResultPayload
+from partial_results import PartialReplies
 from hotel_agent.agent import agent
+from google.adk.agents.run_config import RunConfig, StreamingMode
 from google.adk.runners import Runner
+from google.adk.sessions import BaseSessionService
 from redis_session_service import RedisSessionService
 from firebase_state_service import FirebaseStateService
 from main_agent.memory import set_firebase_context
@@ -22,13 +25,13 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 class HotelAgentExecutor:
-    def __init__(self):
-        self.broker = MessageBroker()
+    def __init__(self, broker: AsyncMessageBroker | None = None, session_service: BaseSessionService | None = None):
+        self.broker = broker or AsyncMessageBroker()
         self.agent_name = "hotel_agent"
         self.llm_agent = agent
 
         # Redis session service for conversation history
-        self.session_service = RedisSessionService()
+        self.session_service = session_service or RedisSessionService()
 
         # Firebase service for state management
         cred_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'hack2skill-emt-firebase-adminsdk-fbsvc-b2ea50c49d.json'))
@@ -44,8 +47,12 @@ class HotelAgentExecutor:
         )
         logger.info(f"[{self.agent_name}] Initialized with Firebase state service")
 
-    async def _invoke_llm_sync(self, user_request: str, session_id: str, user_id: str, itinerary_id: str) -> str:
-        """Invokes the agent's LLM synchronously using the Runner."""
+    async def _invoke_llm_sync(self, user_request: str, session_id: str, user_id: str, itinerary_id: str, partials: PartialReplies | None = None) -> str:
+        """Invokes the agent's LLM synchronously using the Runner.
+
+        With ``partials`` the model output is streamed, and each option is sent to the
+        caller as a PARTIAL reply as soon as the model has written it.
+        """
         logger.info(f"[{self.agent_name}] Invoking runner for user: {user_id}, session: {session_id}, itinerary: {itinerary_id}")
 
         # Set Firebase context before invoking runner
@@ -55,24 +62,33 @@ class HotelAgentExecutor:
         content = types.Content(role='user', parts=[types.Part(text=user_request)])
         final_response_text = ""
 
-        async for event in self.runner.run_async(user_id=user_id, session_id=session_id, new_message=content):
+        partials = partials if partials and partials.enabled else None
+        run_config = RunConfig(streaming_mode=StreamingMode.SSE if partials else StreamingMode.NONE)
+        async for event in self.runner.run_async(user_id=user_id, session_id=session_id, new_message=content, run_config=run_config):
             if event.content and event.content.parts:
-                for part in event.content.parts:
-                    if hasattr(part, 'text') and part.text:
-                        final_response_text += part.text
+                text = "".join(part.text for part in event.content.parts if hasattr(part, 'text') and part.text)
+                if event.partial:
+                    # A streamed chunk; the turn's complete text follows in a non-partial event.
+                    if partials:
+                        await partials.feed(text)
+                    continue
+                final_response_text += text
+        if partials:
+            await partials.finish()
 
         logger.info(f"[{self.agent_name}] Final response length: {len(final_response_text)}")
         return final_response_text
 
-    def run(self):
-        main_queue = f"tasks:{self.agent_name}"
-        processing_queue = f"processing:{self.agent_name}"
-        dlq = f"dlq:{self.agent_name}"
+    async def run(self):
+        main_queue = agent_task_queue(self.agent_name)
+        processing_queue = agent_processing_queue(self.agent_name)
+        dlq = agent_dead_letter_queue(self.agent_name)
         max_retries = 3
 
+        await self.broker.connect()
         logger.info(f"[{self.agent_name}] is waiting for tasks on {main_queue}...")
         while True:
-            task_message_dict = self.broker.start_atomic_task(main_queue, processing_queue)
+            task_message_dict = await self.broker.start_atomic_task(main_queue, processing_queue)
             if not task_message_dict:
                 continue
 
@@ -92,9 +108,8 @@ class HotelAgentExecutor:
                 logger.info(f"[{self.agent_name}] Task description: {task_description}")
 
                 # Invoke the LLM with Firebase context
-                llm_response_str = asyncio.run(
-                    self._invoke_llm_sync(task_description, session_id, user_id, itinerary_id)
-                )
+                partials = PartialReplies(self.broker, task_message, self.agent_name)
+                llm_response_str = await self._invoke_llm_sync(task_description, session_id, user_id, itinerary_id, partials)
                 logger.info(f"[{self.agent_name}] Raw LLM response: {llm_response_str[:200]}")
 
                 # Try to parse JSON response, fallback to plain text
@@ -137,6 +152,7 @@ class HotelAgentExecutor:
 
                 result_header = Header(
                     correlation_id=correlation_id,
+                    task_id=task_message.header.task_id,  # Lets the caller match the reply to its request
                     message_type="RESULT",
                     source_agent=self.agent_name,
                     target_agent=task_message.header.source_agent,
@@ -148,21 +164,19 @@ class HotelAgentExecutor:
                 result_message = Message(header=result_header, payload=result_payload)
 
                 reply_channel = task_message.header.reply_to_channel or "results:main"
-                self.broker.enqueue_task(reply_channel, result_message.model_dump())
+                # Ack the task and send the result in one atomic round trip
+                await self.broker.complete_task(processing_queue, task_message_dict, reply_channel, result_message.model_dump())
                 logger.info(f"[{self.agent_name}] Sent result to {reply_channel}")
 
-                self.broker.finish_atomic_task(processing_queue, task_message_dict)
-
             except Exception as e:
                 logger.error(f"[{self.agent_name}] Task failed: {e}", exc_info=True)
-                task_message_dict['retry_count'] = task_message_dict.get('retry_count', 0) + 1
-                if task_message_dict['retry_count'] >= max_retries:
-                    self.broker.move_to_dlq(processing_queue, dlq, task_message_dict)
+                # Retry with exponential backoff and jitter, or dead-letter after max_retries
+                retry_delay = await self.broker.fail_task(processing_queue, main_queue, dlq, task_message_dict, max_retries, error=e)
+                if retry_delay is None:
                     logger.error(f"[{self.agent_name}] Task moved to DLQ after {max_retries} retries")
                 else:
-                    self.broker.requeue_failed_task(processing_queue, main_queue, task_message_dict)
-                    logger.warning(f"[{self.agent_name}] Task requeued, retry {task_message_dict['retry_count']}/{max_retries}")
+                    logger.warning(f"[{self.agent_name}] Task retry {task_message_dict['payload']['retry_count']}/{max_retries} scheduled in {retry_delay:.1f}s")
 
 if __name__ == "__main__":
     agent_executor = HotelAgentExecutor()
-    agent_executor.run()
\ No newline at end of file
+    asyncio.run(agent_executor.run())
\ No newline at end of file
@@ -0,0 +1,309 @@
+"""
+In-process message broker for single-process deployments and benchmarking.
+
+InProcessMessageBroker implements the AsyncMessageBroker API on in-memory deques,
+so router, main and specialist agents can run as coroutines in one process with
+no network hop between them (see scripts/run_single_process.py). Comparing its
+end-to-end latency with the Redis broker shows how much of it is transport.
+
+Semantics follow the Redis list transport: LPUSH/RPOP task lanes in priority order
+with the starvation guard, processing lists, delayed retries, DLQs, reply queues
+drained from the head like BLPOP, reply inbox TTLs, message ID deduplication and Pub/Sub channel and pattern callbacks (patterns are
+matched with fnmatch, which covers Redis' glob syntax except ``[^...]``). Payloads
+still go through the configured codec so producers and consumers never share
+mutable dicts, and metrics are recorded as usual. All brokers sharing a store must
+be used from the same event loop; nothing survives the process.
+"""
+import asyncio
+import fnmatch
+import heapq
+import itertools
+import logging
+import time
+from collections import defaultdict, deque
+
+import broker_metrics
+from message_broker import DEFAULT_PRIORITY, Admission, AsyncMessageBroker
+
+logger = logging.getLogger("message_broker")
+
+
+class InProcessStore:
+    """The queues, delayed sets and channels shared by every InProcessMessageBroker using it."""
+
+    def __init__(self):
+        self.lists: dict[str, deque] = defaultdict(deque)
+        # delayed:<lane> -> heap of (due, sequence, payload), due on the monotonic clock
+        self.delayed: dict[str, list] = defaultdict(list)
+        self.expires: dict[str, float] = {}
+        # done:<processing queue> -> {message ID: completion time}, on the monotonic clock
+        self.done: dict[str, dict[str, float]] = defaultdict(dict)
+        self.subscribers: dict[str, set["InProcessMessageBroker"]] = defaultdict(set)
+        self.pattern_subscribers: dict[str, set["InProcessMessageBroker"]] = defaultdict(set)
+        self.metrics: dict[str, float] = defaultdict(float)
+        self.sequence = itertools.count()
+        self.changed = asyncio.Condition()
+
+    def purge_expired(self):
+        now = time.monotonic()
+        for key in [key for key, deadline in self.expires.items() if deadline <= now]:
+            self.lists.pop(key, None)
+            del self.expires[key]
+
+    def mark_done(self, dedup_set: str, message_id: str, window: float):
+        """Records a completed message ID and forgets the ones older than ``window`` seconds."""
+        now, done = time.monotonic(), self.done[dedup_set]
+        done[message_id] = now
+        for stale in [key for key, completed in done.items() if completed <= now - window]:
+            del done[stale]
+
+    def promote(self, lane: str, delayed: str) -> int:
+        """Moves due entries of a delayed set onto its lane, like the Redis promote function."""
+        heap, now, promoted = self.delayed.get(delayed), time.monotonic(), 0
+        while heap and heap[0][0] <= now:
+            self.lists[lane].appendleft(heapq.heappop(heap)[2])
+            promoted += 1
+        return promoted
+
+    async def notify(self):
+        async with self.changed:
+            self.changed.notify_all()
+
+    async def wait(self, timeout: float):
+        """Waits until something is written, or ``timeout`` seconds pass."""
+        try:
+            async with self.changed:
+                await asyncio.wait_for(self.changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+_default_store: InProcessStore | None = None
+
+
+def default_store() -> InProcessStore:
+    """The process-wide store used by brokers created without an explicit one."""
+    global _default_store
+    if _default_store is None:
+        _default_store = InProcessStore()
+    return _default_store
+
+
+class InProcessMessageBroker(AsyncMessageBroker):
+    """AsyncMessageBroker on in-memory queues. Only the list transport is available."""
+
+    def __init__(self, store: InProcessStore | None = None, codec: str | None = None):
+        self.store = store or default_store()
+        super().__init__("list", codec)
+        # Messages never leave the process, so there is nothing to gain from claim checks.
+        self.claim_threshold = 0
+
+    def _attach_client(self):
+        self.redis_client = None
+        self.pubsub = None
+        logger.info(f"InProcessMessageBroker initialized, codec={self.codec.name}.")
+
+    async def connect(self):
+        """Nothing to connect to; kept for API compatibility."""
+
+    async def close(self):
+        await self.unsubscribe()
+        for listener in list(self._reply_listeners.values()):
+            listener.cancel()
+        for _, future in list(self._calls.values()):
+            future.cancel()
+        await self.flush_metrics()
+
+    def _write(self, queue_name: str, payload: bytes, delay_ms: int = 0, ttl: int = 0):
+        if delay_ms > 0:
+            heapq.heappush(self.store.delayed[self.delayed_name(queue_name)], (time.monotonic() + delay_ms / 1000, next(self.store.sequence), payload))
+            return
+        self.store.lists[queue_name].appendleft(payload)
+        if ttl > 0:
+            self.store.purge_expired()
+            self.store.expires[queue_name] = time.monotonic() + ttl
+
+    async def enqueue_task(self, queue_name: str, task: dict, delay: float = 0):
+        queue_name = self._lane_for(queue_name, task)
+        self._write(queue_name, self._encode(task), int(delay * 1000), self.inbox_ttl_seconds if self._is_inbox(queue_name) else 0)
+        self._record_enqueue(queue_name)
+        await self.store.notify()
+        logger.debug(f"Enqueued task on '{queue_name}'. Correlation ID: {task.get('header', {}).get('correlation_id')}")
+
+    async def enqueue_many(self, tasks: list[tuple[str, dict]]) -> int:
+        for queue_name, task in tasks:
+            queue_name = self._lane_for(queue_name, task)
+            self._write(queue_name, self._encode(task), ttl=self.inbox_ttl_seconds if self._is_inbox(queue_name) else 0)
+            self._record_enqueue(queue_name)
+        if tasks:
+            await self.store.notify()
+        return len(tasks)
+
+    async def _run_transition(self, keys: list, args: list) -> int:
+        """Applies a TRANSITION_SCRIPT call (see message_broker) to the in-memory queues."""
+        source, destination, *dedup = keys
+        ack_mode, ref, _, write_mode, payload, _, delay_ms, ttl, message_id, window_ms = args
+        acked = 0
+        if ack_mode == "list":
+            try:
+                self.store.lists[source].remove(ref)
+                acked = 1
+            except ValueError:
+                pass
+        if dedup and ack_mode != "none":
+            self.store.mark_done(dedup[0], message_id, window_ms / 1000)
+        if write_mode == "delayed":
+            heapq.heappush(self.store.delayed[destination], (time.monotonic() + delay_ms / 1000, next(self.store.sequence), payload))
+        elif write_mode != "none":
+            self._write(destination, payload, ttl=ttl)
+        await self.store.notify()
+        return acked
+
+    # --- Consuming ---
+
+    def _pop_lane(self, queue_name: str) -> tuple[str, bytes] | None:
+        lanes = self._lane_order(queue_name)
+        for lane in lanes:
+            self.store.promote(lane, self.delayed_name(lane))
+        for lane in lanes:
+            if self.store.lists.get(lane):
+                return lane, self.store.lists[lane].pop()
+        return None
+
+    async def get_task_non_blocking(self, queue_name: str) -> dict | None:
+        popped = self._pop_lane(queue_name)
+        if popped is None:
+            return None
+        lane, raw = popped
+        self._note_lane(queue_name, lane)
+        try:
+            task = self._decode(raw)
+        except (TypeError, ValueError) as e:
+            logger.error(f"Error decoding task from queue {queue_name}: {e}")
+            return None
+        self._record_dequeue(lane, task)
+        if self._skip_expired(lane, task):
+            return None
+        return task
+
+    async def start_atomic_task(self, main_queue: str, processing_queue: str, timeout: int = 0) -> dict | None:
+        """Moves the next task to the processing list, waiting at most one lane poll like the Redis broker."""
+        popped = self._pop_lane(main_queue)
+        if popped is None:
+            wait = self._lane_timeout(timeout)
+            due = [heap[0][0] for lane in self._lane_order(main_queue) if (heap := self.store.delayed.get(self.delayed_name(lane)))]
+            if due:
+                # Wake up for the next delayed task instead of a full lane poll later.
+                wait = max(0.0, min(wait, min(due) - time.monotonic()))
+            await self.store.wait(wait)
+            popped = self._pop_lane(main_queue)
+            if popped is None:
+                return None
+        lane, raw = popped
+        self.store.lists[processing_queue].appendleft(raw)
+        self._note_lane(main_queue, lane)
+        try:
+            task = self._decode(raw)
+        except (TypeError, ValueError) as e:
+            logger.error(f"Error decoding atomic task: {e}", exc_info=True)
+            return None
+        self._track_delivery(task, processing_queue, None, None, raw)
+        self._record_dequeue(lane, task)
+        if await self._drop_expired(processing_queue, task) or await self._drop_duplicate(processing_queue, task):
+            return None
+        return task
+
+    async def _drop_duplicate(self, processing_queue: str, task: dict) -> bool:
+        message_id = self._message_id(task)
+        if self.dedup_window_seconds <= 0 or message_id not in self.store.done.get(self.dedup_name(processing_queue), ()):
+            return False
+        await self._run_transition(*self._ack_call(task, processing_queue, "duplicate"))
+        logger.warning(f"Dropped duplicate delivery of message {message_id} from '{processing_queue}'. Correlation ID: {task.get('header', {}).get('correlation_id')}")
+        return True
+
+    async def finish_atomic_task(self, processing_queue: str, task: dict):
+        if not await self._run_transition(*self._ack_call(task, processing_queue, "completed")):
+            logger.warning(f"Could not find task to remove from '{processing_queue}'. Correlation ID: {task.get('header', {}).get('correlation_id')}")
+
+    async def pop_reply(self, queue_name: str, timeout: int = 0) -> dict | None:
+        """Takes the head of a reply queue, waiting up to ``timeout`` seconds (0 waits forever, like BLPOP)."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout if timeout else None
+        while not self.store.lists.get(queue_name):
+            remaining = deadline - loop.time() if deadline is not None else self.lane_poll_seconds
+            if remaining <= 0:
+                return None
+            await self.store.wait(remaining)
+        raw = self.store.lists[queue_name].popleft()
+        if not self.store.lists[queue_name]:
+            del self.store.lists[queue_name]
+            self.store.expires.pop(queue_name, None)
+        try:
+            reply = self._decode(raw)
+        except (TypeError, ValueError) as e:
+            logger.error(f"Error decoding reply from queue {queue_name}: {e}", exc_info=True)
+            return None
+        self._record_dequeue(queue_name, reply)
+        return reply
+
+    # --- Pub/Sub ---
+
+    async def publish_event(self, channel: str, message: dict):
+        payload = self._encode(message)
+        for subscriber in list(self.store.subscribers.get(channel, ())):
+            subscriber._message_handler({"type": "message", "channel": channel, "data": payload})
+        for pattern, subscribers in list(self.store.pattern_subscribers.items()):
+            if subscribers and fnmatch.fnmatchcase(channel, pattern):
+                for subscriber in list(subscribers):
+                    subscriber._message_handler({"type": "pmessage", "pattern": pattern, "channel": channel, "data": payload})
+
+    async def _pubsub_command(self, command: str, names: list[str]):
+        registry = self.store.pattern_subscribers if command.startswith("p") else self.store.subscribers
+        for name in names:
+            if command.endswith("unsubscribe"):
+                registry[name].discard(self)
+            else:
+                registry[name].add(self)
+
+    def _start_listener(self):
+        """Messages are handed over by publish_event; there is no connection to listen on."""
+
+    async def unsubscribe(self):
+        for subscribers in (*self.store.subscribers.values(), *self.store.pattern_subscribers.values()):
+            subscribers.discard(self)
+        self.callbacks.clear()
+        self.pattern_callbacks.clear()
+        self._prune_callback_queues()
+
+    # --- Admission control and metrics ---
+
+    async def check_admission(self, queue_names: list[str], priority: str = DEFAULT_PRIORITY) -> Admission:
+        owners, lengths = [], []
+        for queue_name in queue_names:
+            for lane in self._admission_lanes(queue_name, priority):
+                owners.append(queue_name)
+                lengths.append(len(self.store.lists.get(lane, ())))
+        return self._admission_from(owners, lengths, priority)
+
+    async def flush_metrics(self):
+        """Adds recorded metrics to the store, the in-process stand-in for the shared Redis hash."""
+        self._drain_metrics()
+
+    def _drain_metrics(self):
+        for sample, amount in broker_metrics.REGISTRY.drain().items():
+            self.store.metrics[sample] += amount
+
+    def queue_depths(self) -> dict[str, int]:
+        depths = {}
+        for name, items in self.store.lists.items():
+            if items:
+                queue = self._metric_queue(name)
+                depths[queue] = depths.get(queue, 0) + len(items)
+        depths.update({name: len(heap) for name, heap in self.store.delayed.items() if heap})
+        return dict(sorted(depths.items()))
+
+    def render_metrics(self) -> str:
+        """The recorded metrics and current queue depths in the Prometheus text format. Synchronous,
+        like MessageBroker.render_metrics, since nothing here waits on I/O."""
+        self._drain_metrics()
+        return broker_metrics.render(dict(self.store.metrics), self.queue_depths())
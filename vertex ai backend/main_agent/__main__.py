@@ -1,6 +1,7 @@
+import asyncio
 
 from main_agent.agent import MainAgent
 
 if __name__ == "__main__":
     agent = MainAgent()
-    agent.run()
+    asyncio.run(agent.run())
@@ -2,7 +2,7 @@ import os
 from google.adk.agents import Agent
 from main_agent.memory import _load_precreated_eventplan
 from main_agent.prompt import ROOT_AGENT_PROMPT
-from main_agent.tools import TOOLS
+from main_agent.tools import TOOLS, use_broker
 from flight_agent.agent import agent as flight_agent
 from weather_agent.agent import agent as weather_agent
 from food_agent.agent import agent as food_agent
@@ -38,11 +38,11 @@ root_agent = Agent(
 import json
 import logging
 import asyncio
-import time
 import sys
-from message_broker import MessageBroker
+from message_broker import AsyncMessageBroker, agent_task_queue, agent_processing_queue, agent_dead_letter_queue
 from message_protocol import Message, Header, ResultPayload, TaskPayload
 from google.adk.runners import Runner
+from google.adk.sessions import BaseSessionService
 from redis_session_service import RedisSessionService
 from firebase_state_service import FirebaseStateService
 from google.genai import types
@@ -58,12 +58,17 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 class MainAgent:
-    def __init__(self):
-        self.broker = MessageBroker()
+    def __init__(self, broker: AsyncMessageBroker | None = None, session_service: BaseSessionService | None = None):
+        self.broker = broker or AsyncMessageBroker()
+        if broker is not None:
+            # Delegation tools must send through the same broker the agent consumes from
+            use_broker(broker)
         self.agent_name = "main_agent"
+        # Chat turns this process works on at the same time
+        self.max_concurrent_tasks = max(1, int(os.getenv("MAIN_AGENT_CONCURRENCY", "4")))
         self.llm_agent = root_agent
         # Redis session service for conversation history only
-        self.session_service = RedisSessionService()
+        self.session_service = session_service or RedisSessionService()
         # Firebase service for itinerary state management
         cred_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'hack2skill-emt-firebase-adminsdk-fbsvc-b2ea50c49d.json'))
         self.firebase_service = FirebaseStateService(cred_path=cred_path)
@@ -77,7 +82,7 @@ class MainAgent:
         logger.info(f"[{self.agent_name}] Initialized with runner, app_name={self.app_name}")
         logger.info(f"[{self.agent_name}] Firebase state service initialized")
 
-    async def _invoke_llm_sync(self, user_request: str, session_id: str, user_id: str = "user", itinerary_id: str = "default") -> str:
+    async def _invoke_llm_sync(self, user_request: str, session_id: str, user_id: str = "user", itinerary_id: str = "default", priority: str = "interactive", correlation_id: str | None = None, deadline: float | None = None) -> str:
         """Invokes the agent's LLM synchronously using the Runner."""
         async def _run_async():
             logger.info(f"[{self.agent_name}] Invoking runner for user: {user_id}, session: {session_id}, itinerary: {itinerary_id}")
@@ -109,6 +114,12 @@ class MainAgent:
             session.state["session_id"] = session_id
             session.state["user_id"] = user_id
             session.state["itinerary_id"] = itinerary_id
+            # Specialist tasks delegated for this turn inherit its priority lane and reply
+            # to the turn's own inbox, keyed by its correlation ID
+            session.state["task_priority"] = priority
+            session.state["correlation_id"] = correlation_id or session_id
+            # ... and its deadline, which also bounds how long results are collected
+            session.state["task_deadline"] = deadline
             await self.session_service.update_session(session)
             logger.info(f"[{self.agent_name}] Injected session_id, user_id, and itinerary_id into session state")
 
@@ -392,81 +403,107 @@ class MainAgent:
 
         return await _run_async()
 
-    def run(self):
-        task_queue = f"tasks:{self.agent_name}"
+    async def run(self):
+        main_queue = agent_task_queue(self.agent_name)
+        processing_queue = agent_processing_queue(self.agent_name)
+        dlq = agent_dead_letter_queue(self.agent_name)
 
-        logger.info(f"[{self.agent_name}] is waiting for tasks on {task_queue}...")
+        await self.broker.connect()
+        logger.info(f"[{self.agent_name}] is waiting for tasks on {main_queue} (up to {self.max_concurrent_tasks} at a time)...")
 
+        # Turns spend most of their time awaiting the model and the specialists, so several
+        # run on the loop at once. A task is only taken once a slot is free, so the rest stay
+        # queued where other main_agent processes can pick them up.
+        slots = asyncio.Semaphore(self.max_concurrent_tasks)
+        running: set[asyncio.Task] = set()
         while True:
+            await slots.acquire()
+            # Blocks on the task lanes instead of polling them
+            task_message_dict = await self.broker.start_atomic_task(main_queue, processing_queue)
+            if not task_message_dict:
+                slots.release()
+                continue
+            turn = asyncio.create_task(self._handle_task(task_message_dict, main_queue, processing_queue, dlq))
+            running.add(turn)
+            turn.add_done_callback(running.discard)
+            turn.add_done_callback(lambda _: slots.release())
+
+    async def _handle_task(self, task_message_dict: dict, main_queue: str, processing_queue: str, dlq: str, max_retries: int = 3):
+        try:
+            task_message = Message.model_validate(task_message_dict)
+            correlation_id = task_message.header.correlation_id
+            logger.info(f"[{self.agent_name}] Received task: {task_message.payload.task_name} with Correlation ID: {correlation_id}")
+
+            if task_message.header.priority == "background":
+                specialist_queues = [agent_task_queue(sub_agent.name) for sub_agent in self.llm_agent.sub_agents]
+                admission = await self.broker.check_admission(specialist_queues, "background")
+                if not admission.admitted:
+                    # Shed load: put background work off until the specialists catch up
+                    await self.broker.defer_task(processing_queue, main_queue, task_message_dict, admission.retry_after)
+                    return
+
+            # Extract parameters
+            params = task_message.payload.parameters
+            user_request = params.get("user_request", "")
+            session_id = params.get("session_id", correlation_id)  # Fallback to correlation_id if not provided
+            user_id = params.get("user_id", "user")
+            itinerary_id = params.get("itinerary_id", "default")
+
+            logger.info(f"[{self.agent_name}] User: {user_id}, Session: {session_id}, Itinerary: {itinerary_id}, Request: {user_request[:100]}")
+
+            llm_response_str = await self._invoke_llm_sync(user_request, session_id, user_id, itinerary_id, task_message.header.priority, correlation_id, task_message.header.deadline)
+            logger.info(f"[{self.agent_name}] Raw LLM response (length={len(llm_response_str)}): {llm_response_str[:200] if llm_response_str else 'EMPTY'}")
+
+            # For now, just send the response back to the user interface
+            reply_channel = "results:user_interface"
+            result_header = Header(
+                correlation_id=correlation_id,
+                message_type="RESULT",
+                source_agent=self.agent_name,
+                target_agent="user_interface"
+            )
+
+            # Build response data
+            response_data = {
+                "response": llm_response_str,
+                "user_id": user_id,
+                "itinerary_id": itinerary_id
+            }
+
+            # Add state information for response_storage_worker
+            # This includes itinerary_created flag which determines if activityType should be set
             try:
-                task_message_dict = self.broker.get_task_non_blocking(task_queue)
-                if task_message_dict:
-                    try:
-                        task_message = Message.model_validate(task_message_dict)
-                        correlation_id = task_message.header.correlation_id
-                        logger.info(f"[{self.agent_name}] Received task: {task_message.payload.task_name} with Correlation ID: {correlation_id}")
-
-                        # Extract parameters
-                        params = task_message.payload.parameters
-                        user_request = params.get("user_request", "")
-                        session_id = params.get("session_id", correlation_id)  # Fallback to correlation_id if not provided
-                        user_id = params.get("user_id", "user")
-                        itinerary_id = params.get("itinerary_id", "default")
-
-                        logger.info(f"[{self.agent_name}] User: {user_id}, Session: {session_id}, Itinerary: {itinerary_id}, Request: {user_request[:100]}")
-
-                        llm_response_str = asyncio.run(self._invoke_llm_sync(user_request, session_id, user_id, itinerary_id))
-                        logger.info(f"[{self.agent_name}] Raw LLM response (length={len(llm_response_str)}): {llm_response_str[:200] if llm_response_str else 'EMPTY'}")
-
-                        # For now, just send the response back to the user interface
-                        reply_channel = "results:user_interface"
-                        result_header = Header(
-                            correlation_id=correlation_id,
-                            message_type="RESULT",
-                            source_agent=self.agent_name,
-                            target_agent="user_interface"
-                        )
-
-                        # Build response data
-                        response_data = {
-                            "response": llm_response_str,
-                            "user_id": user_id,
-                            "itinerary_id": itinerary_id
-                        }
-
-                        # Add state information for response_storage_worker
-                        # This includes itinerary_created flag which determines if activityType should be set
-                        try:
-                            async def get_final_state():
-                                session = await self.session_service.get_session(
-                                    app_name=self.runner.app_name,
-                                    user_id=user_id,
-                                    id=session_id
-                                )
-                                if session and "itinerary_state" in session.state:
-                                    return session.state["itinerary_state"]
-                                return {}
-
-                            final_state = asyncio.run(get_final_state())
-                            if final_state:
-                                response_data["state"] = final_state
-                                logger.info(f"[{self.agent_name}] Including state in response (itinerary_created={final_state.get('itinerary_created', False)})")
-                        except Exception as e:
-                            logger.warning(f"[{self.agent_name}] Could not extract state for response: {e}")
-
-                        result_payload = ResultPayload(
-                            status="SUCCESS",
-                            data=response_data
-                        )
-                        result_message = Message(header=result_header, payload=result_payload)
-                        self.broker.enqueue_task(reply_channel, result_message.model_dump())
-                        logger.info(f"[{self.agent_name}] Sent response to {reply_channel}")
-
-                    except Exception as e:
-                        logger.error(f"[{self.agent_name}] Task failed: {e}", exc_info=True)
-                else:
-                    # Sleep for a short duration to avoid busy-waiting
-                    time.sleep(0.1)
-            except KeyboardInterrupt:
-                logger.warning(f"[{self.agent_name}] Received interrupt signal, ignoring and continuing...")
-                continue
\ No newline at end of file
+                async def get_final_state():
+                    session = await self.session_service.get_session(
+                        app_name=self.runner.app_name,
+                        user_id=user_id,
+                        id=session_id
+                    )
+                    if session and "itinerary_state" in session.state:
+                        return session.state["itinerary_state"]
+                    return {}
+
+                final_state = await get_final_state()
+                if final_state:
+                    response_data["state"] = final_state
+                    logger.info(f"[{self.agent_name}] Including state in response (itinerary_created={final_state.get('itinerary_created', False)})")
+            except Exception as e:
+                logger.warning(f"[{self.agent_name}] Could not extract state for response: {e}")
+
+            result_payload = ResultPayload(
+                status="SUCCESS",
+                data=response_data
+            )
+            result_message = Message(header=result_header, payload=result_payload)
+            # Ack the task and send the response in one atomic round trip
+            await self.broker.complete_task(processing_queue, task_message_dict, reply_channel, result_message.model_dump())
+            logger.info(f"[{self.agent_name}] Sent response to {reply_channel}")
+
+        except Exception as e:
+            logger.error(f"[{self.agent_name}] Task failed: {e}", exc_info=True)
+            # Retry with exponential backoff and jitter, or dead-letter after max_retries
+            retry_delay = await self.broker.fail_task(processing_queue, main_queue, dlq, task_message_dict, max_retries, error=e)
+            if retry_delay is None:
+                logger.error(f"[{self.agent_name}] Task moved to DLQ after {max_retries} retries")
+            else:
+                logger.warning(f"[{self.agent_name}] Task retry {task_message_dict['payload']['retry_count']}/{max_retries} scheduled in {retry_delay:.1f}s")
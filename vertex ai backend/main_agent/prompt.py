@@ -143,6 +143,10 @@ CRITICAL: Never show raw JSON to users. Always format specialist responses in a
 
   Example: delegate_task(agent_name='flight_agent', task_description='Find economy class flights from Mumbai to Goa departing on 2025-12-20...')
 
+  When you need more than one agent, delegate to all of them in a single delegate_tasks call instead of calling delegate_task repeatedly.
+
+  Example: delegate_tasks(tasks=[{'agent_name': 'flight_agent', 'task_description': 'Find economy class flights from Mumbai to Goa departing on 2025-12-20...'}, {'agent_name': 'hotel_agent', 'task_description': 'Find hotels in Goa from 2025-12-20 to 2025-12-25...'}])
+
 * **Step 2 - Wait and Collect Results:** CRITICAL - After delegating tasks to specialist agents, you MUST call the collect_specialist_results tool to wait for their responses. Pass the list of agent names you delegated to.
 
   Example: collect_specialist_results(expected_agents=['flight_agent', 'hotel_agent', 'food_agent', 'activity_agent', 'weather_agent', 'budget_agent', 'cab_agent'], timeout_seconds=60)
@@ -1,6 +1,8 @@
 """
 Host Agent tools for dispatching tasks and managing state.
 """
+import asyncio
+import time
 import uuid
 import logging
 import json
@@ -10,8 +12,8 @@ import requests
 from pydantic import BaseModel
 from firebase_admin import firestore
 
-from message_broker import MessageBroker
-from message_protocol import Header, TaskPayload, Message
+from message_broker import AsyncMessageBroker, agent_task_queue
+from message_protocol import Header, TaskPayload, Message, is_claim_check, load_data, redeem
 from google.adk.tools import ToolContext
 from main_agent.models import ItineraryState
 from main_agent.memory import update_state_field, get_current_state
@@ -19,10 +21,120 @@ from main_agent.memory import update_state_field, get_current_state
 # Get the logger from the message_broker to use the same file
 logger = logging.getLogger('message_broker')
 
-# A single, shared broker instance for all tool calls.
-broker = MessageBroker()
+# A single, shared broker instance for all tool calls. The tools are coroutines so
+# queue round trips never block the ADK runner's event loop.
+broker = AsyncMessageBroker()
 
-def delegate_task(
+# Reply futures of delegated tasks as (agent_name, future), by the turn's correlation ID
+# and then task ID, since one turn may ask the same agent more than once.
+# collect_specialist_results takes the ones of the agents it waits for and leaves the
+# rest for a later call. Calls that fail or expire (after the inbox TTL) are forgotten.
+_pending_calls: Dict[str, Dict[str, tuple]] = {}
+
+# PARTIAL replies received for the current turn's tasks, by correlation ID and task ID:
+# {"agent": name, "items": {seq: data}, "final_seq": seq of the final partial or None}.
+# Used for tasks whose RESULT is still missing when collection times out.
+_partial_results: Dict[str, Dict[str, Dict[str, Any]]] = {}
+
+def use_broker(new_broker: AsyncMessageBroker):
+    """Sends the tools' tasks through another broker, e.g. an InProcessMessageBroker."""
+    global broker
+    broker = new_broker
+
+def _turn_id(tool_context: ToolContext, correlation_id: Optional[str] = None) -> Optional[str]:
+    """The current turn's correlation ID from session state, so delegate_task(s) and
+    collect_specialist_results agree even if the model passes its own correlation ID."""
+    return tool_context.state.get("correlation_id") or correlation_id
+
+def _reply_inbox(tool_context: ToolContext, correlation_id: Optional[str] = None) -> str:
+    """The reply inbox of the current turn, results:main:<correlation_id>.
+
+    Falls back to the shared results:main queue when no correlation ID is known.
+    """
+    turn_id = _turn_id(tool_context, correlation_id)
+    return broker.reply_inbox("results:main", turn_id) if turn_id else "results:main"
+
+def _build_delegation_message(
+    tool_context: ToolContext,
+    agent_name: str,
+    task_description: str,
+    correlation_id: str
+) -> Message:
+    """Builds the TASK message for a specialist, carrying user_id, itinerary_id and session_id from context."""
+    user_id = tool_context.state.get("user_id", "user")
+    itinerary_id = tool_context.state.get("itinerary_id", "default")
+    session_id = tool_context.state.get("session_id", correlation_id)
+
+    header = Header(
+        correlation_id=correlation_id,
+        task_id=str(uuid.uuid4()),
+        message_type="TASK",
+        source_agent="main_agent",
+        target_agent=agent_name,
+        reply_to_channel=_reply_inbox(tool_context, correlation_id),
+        priority=tool_context.state.get("task_priority", "interactive"),
+        deadline=tool_context.state.get("task_deadline")
+    )
+    payload = TaskPayload(
+        task_name="execute_task",
+        parameters={
+            "task_description": task_description,
+            "user_id": user_id,
+            "itinerary_id": itinerary_id,
+            "session_id": session_id
+        }
+    )
+    return Message(header=header, payload=payload)
+
+def _partial_recorder(turn_id: str):
+    def record(reply: Dict[str, Any]):
+        agent_name = reply.get("header", {}).get("source_agent")
+        payload = reply.get("payload", {})
+        task_partials = _partial_results.setdefault(turn_id, {})
+        partials = task_partials.setdefault(reply.get("header", {}).get("task_id"), {"agent": agent_name, "items": {}, "final_seq": None})
+        # Keyed by seq, so a retried task streaming its partials again replaces them.
+        partials["items"][payload.get("seq", 0)] = load_data(payload)
+        if payload.get("final"):
+            partials["final_seq"] = payload.get("seq", 0)
+        logger.info(f"Partial result {payload.get('seq')} from {agent_name}{' (final)' if payload.get('final') else ''}")
+    return record
+
+def _assemble_partials(partials: Dict[str, Any]) -> Dict[str, Any]:
+    """The results an agent streamed so far, in the shape of its full result data."""
+    items = partials["items"]
+    return {
+        "results": [items[seq] for seq in sorted(items)],
+        "partial": True,
+        "complete": partials["final_seq"] is not None and len(items) == partials["final_seq"] + 1,
+    }
+
+async def _call_agents(turn_id: str, inbox: str, calls: List[tuple]):
+    """Sends (agent_name, message) tasks and remembers their reply futures for collection."""
+    futures = await broker.call_many(calls, timeout=broker.inbox_ttl_seconds, reply_to=inbox, on_partial=_partial_recorder(turn_id))
+    turn_calls = _pending_calls.setdefault(turn_id, {})
+    for (agent_name, message), future in zip(calls, futures):
+        task_id = message["header"]["task_id"]
+        turn_calls[task_id] = (agent_name, future)
+        future.add_done_callback(lambda future, task_id=task_id: _forget_failed_call(turn_id, task_id, future))
+
+def _forget_failed_call(turn_id: str, task_id: str, future: asyncio.Future):
+    # Retrieving the error keeps calls that expire uncollected from logging "exception was never retrieved".
+    if not future.cancelled() and future.exception() is None:
+        return
+    turn_calls = _pending_calls.get(turn_id, {})
+    if task_id not in turn_calls or turn_calls[task_id][1] is not future:
+        return
+    del turn_calls[task_id]
+    _partial_results.get(turn_id, {}).pop(task_id, None)
+    _drop_empty_turn(turn_id)
+
+def _drop_empty_turn(turn_id: str):
+    if not _pending_calls.get(turn_id):
+        _pending_calls.pop(turn_id, None)
+    if not _partial_results.get(turn_id):
+        _partial_results.pop(turn_id, None)
+
+async def delegate_task(
     tool_context: ToolContext,
     agent_name: str,
     task_description: str,
@@ -35,105 +147,163 @@ def delegate_task(
     if not agent_name:
         return {"error": "Agent name must be provided."}
 
+    correlation_id = correlation_id or tool_context.state.get("correlation_id")
     if correlation_id is None:
         correlation_id = str(uuid.uuid4())
         logger.info(f"New correlation ID created for task delegation: {correlation_id}")
 
-    queue_name = f"tasks:{agent_name}"
-    reply_channel = "results:main"
-
-    # Extract context parameters from tool_context.state
-    user_id = tool_context.state.get("user_id", "user")
-    itinerary_id = tool_context.state.get("itinerary_id", "default")
-    session_id = tool_context.state.get("session_id", correlation_id)
+    queue_name = agent_task_queue(agent_name)
 
     try:
-        header = Header(
-            correlation_id=correlation_id,
-            task_id=str(uuid.uuid4()),
-            message_type="TASK",
-            source_agent="main_agent",
-            target_agent=agent_name,
-            reply_to_channel=reply_channel
-        )
-        payload = TaskPayload(
-            task_name="execute_task",
-            parameters={
-                "task_description": task_description,
-                "user_id": user_id,
-                "itinerary_id": itinerary_id,
-                "session_id": session_id
-            }
-        )
-        message = Message(header=header, payload=payload)
+        message = _build_delegation_message(tool_context, agent_name, task_description, correlation_id)
         message_dump = message.model_dump()
 
         logger.info(f"DELEGATING task to {agent_name}. Message: {json.dumps(message_dump, indent=2)}")
-        broker.enqueue_task(queue_name, message_dump)
+        await _call_agents(_turn_id(tool_context, correlation_id), message.header.reply_to_channel, [(agent_name, message_dump)])
 
         return {
             "status": "Task successfully delegated.",
             "correlation_id": correlation_id,
-            "task_id": header.task_id,
+            "task_id": message.header.task_id,
             "details": f"Task for '{agent_name}' placed on queue '{queue_name}'."
         }
     except Exception as e:
         logger.error(f"Error delegating task to {agent_name}: {str(e)}", exc_info=True)
         return {"error": f"Error delegating task to {agent_name}: {str(e)}"}
 
-def collect_specialist_results(
+async def delegate_tasks(
+    tool_context: ToolContext,
+    tasks: List[Dict[str, str]],
+    correlation_id: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Delegates tasks to several specialist agents at once, in a single round trip to the MessageBroker.
+    Use this instead of repeated delegate_task calls when planning needs more than one specialist.
+
+    Args:
+        tool_context: The tool context
+        tasks: One entry per specialist, each with "agent_name" and "task_description"
+            (e.g., [{"agent_name": "flight_agent", "task_description": "Find flights..."}])
+        correlation_id: Optional correlation ID shared by all delegated tasks
+
+    Returns:
+        Dict with the task_id assigned to each agent
+    """
+    if not tasks:
+        return {"error": "At least one task must be provided."}
+    missing = [i for i, task in enumerate(tasks) if not task.get("agent_name")]
+    if missing:
+        return {"error": f"Agent name must be provided for tasks at positions {missing}."}
+
+    correlation_id = correlation_id or tool_context.state.get("correlation_id")
+    if correlation_id is None:
+        correlation_id = str(uuid.uuid4())
+        logger.info(f"New correlation ID created for task delegation: {correlation_id}")
+
+    try:
+        messages = [
+            _build_delegation_message(tool_context, task["agent_name"], task.get("task_description", ""), correlation_id)
+            for task in tasks
+        ]
+        await _call_agents(_turn_id(tool_context, correlation_id), messages[0].header.reply_to_channel, [(m.header.target_agent, m.model_dump()) for m in messages])
+
+        task_ids = {m.header.target_agent: m.header.task_id for m in messages}
+        logger.info(f"DELEGATED {len(messages)} tasks in one batch (correlation: {correlation_id}): {task_ids}")
+        return {
+            "status": "Tasks successfully delegated.",
+            "correlation_id": correlation_id,
+            "task_ids": task_ids,
+            "details": f"Tasks placed on queues for: {', '.join(task_ids)}."
+        }
+    except Exception as e:
+        logger.error(f"Error delegating batch of {len(tasks)} tasks: {str(e)}", exc_info=True)
+        return {"error": f"Error delegating tasks: {str(e)}"}
+
+async def collect_specialist_results(
     tool_context: ToolContext,
     expected_agents: List[str],
-    timeout_seconds: int = 60
+    timeout_seconds: int = 60,
+    correlation_id: Optional[str] = None
 ) -> Dict[str, Any]:
     """
     Waits for and collects results from specialist agents.
+    Results that are still missing at the timeout can be collected by calling this again.
 
     Args:
         tool_context: The tool context
         expected_agents: List of agent names to wait for (e.g., ["flight_agent", "hotel_agent"])
         timeout_seconds: Maximum time to wait for all results
+        correlation_id: Optional correlation ID the tasks were delegated with
 
     Returns:
         Dict mapping agent names to their results
     """
-    import time
-
-    results_channel = "results:main"
+    turn_id = _turn_id(tool_context, correlation_id)
+    results_channel = _reply_inbox(tool_context, correlation_id)
+    turn_calls = _pending_calls.get(turn_id, {})
     collected_results = {}
-    start_time = time.time()
 
-    logger.info(f"Waiting for results from {len(expected_agents)} agents: {expected_agents}")
+    turn_deadline = tool_context.state.get("task_deadline")
+    if turn_deadline is not None:
+        # Nobody reads results that arrive after the turn's deadline.
+        timeout_seconds = max(0, min(timeout_seconds, turn_deadline - time.time()))
+
+    logger.info(f"Waiting for results from {len(expected_agents)} agents on {results_channel}: {expected_agents}")
     logger.info(f"Timeout: {timeout_seconds} seconds")
 
-    while len(collected_results) < len(expected_agents):
-        elapsed = time.time() - start_time
-        if elapsed > timeout_seconds:
+    # Only the expected agents' calls are taken; the others stay for a later collection.
+    calls = {task_id: call for task_id, call in turn_calls.items() if call[0] in expected_agents}
+    for task_id in calls:
+        del turn_calls[task_id]
+    not_delegated = [agent for agent in expected_agents if agent not in {agent_name for agent_name, _ in calls.values()}]
+    if not_delegated:
+        logger.warning(f"No uncollected task was delegated this turn to {not_delegated}; not waiting for them")
+    futures = {future: task_id for task_id, (_, future) in calls.items()}
+
+    # Replies resolve their futures as they arrive, so results are handled in completion order.
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout_seconds
+    pending = set(futures)
+    while pending:
+        done, pending = await asyncio.wait(pending, timeout=max(deadline - loop.time(), 0), return_when=asyncio.FIRST_COMPLETED)
+        if not done:
             logger.warning(f"Timeout reached. Collected {len(collected_results)}/{len(expected_agents)} results")
             break
-
-        # Try to get a result (non-blocking with short timeout)
-        try:
-            result_dict = broker.redis_client.blpop(results_channel, timeout=2)
-            if result_dict:
-                _, result_json = result_dict
-                import json
-                result_message = json.loads(result_json)
-
-                # Parse the result message
-                source_agent = result_message.get("header", {}).get("source_agent")
-                correlation_id = result_message.get("header", {}).get("correlation_id")
-                payload_data = result_message.get("payload", {}).get("data", {})
-
-                if source_agent in expected_agents:
-                    collected_results[source_agent] = payload_data
-                    logger.info(f"Collected result from {source_agent} (correlation: {correlation_id})")
-                    logger.info(f"Progress: {len(collected_results)}/{len(expected_agents)} results collected")
-                else:
-                    logger.warning(f"Received unexpected result from {source_agent}")
-
-        except Exception as e:
-            logger.error(f"Error collecting result: {e}", exc_info=True)
+        for future in done:
+            if future.cancelled() or future.exception() is not None:
+                logger.error(f"Error collecting result: {future.exception() if not future.cancelled() else 'cancelled'}")
+                continue
+            result_message = future.result()
+            source_agent = result_message.get("header", {}).get("source_agent")
+            correlation_id = result_message.get("header", {}).get("correlation_id")
+            result_data = result_message.get("payload", {}).get("data", {})
+            if is_claim_check(result_data):
+                # Large results are stored apart from the reply; fetch without blocking the loop.
+                result_data = await asyncio.to_thread(redeem, result_data)
+            collected_results[source_agent] = result_data
+            logger.info(f"Collected result from {source_agent} (correlation: {correlation_id})")
+            logger.info(f"Progress: {len(collected_results)}/{len(expected_agents)} results collected")
+
+    # Agents that timed out still contribute the options they streamed so far.
+    turn_partials = _partial_results.get(turn_id, {})
+    partial_agents = []
+    for future in pending:
+        partials = turn_partials.get(futures[future])
+        if partials is not None and partials["agent"] not in collected_results:
+            collected_results[partials["agent"]] = _assemble_partials(partials)
+            partial_agents.append(partials["agent"])
+            logger.info(f"Using {len(partials['items'])} partial results from {partials['agent']}")
+
+    # Until the turn's deadline a later call can still collect the missing replies; after it,
+    # the calls are abandoned and the broker's reply listener drops their late replies.
+    turn_over = turn_deadline is not None and time.time() >= turn_deadline
+    for future, task_id in futures.items():
+        if future in pending and not turn_over:
+            _pending_calls.setdefault(turn_id, {})[task_id] = calls[task_id]
+            continue
+        future.cancel()
+        turn_partials.pop(task_id, None)
+    _drop_empty_turn(turn_id)
 
     # Store results in state for the agent to access
     for agent_name, result_data in collected_results.items():
@@ -149,6 +319,7 @@ SPECIALIST RESULTS COLLECTION COMPLETE:
 - Collected {len(collected_results)}/{len(expected_agents)} agent results
 - Results stored in state under specialist_results
 - Agents that responded: {', '.join(collected_results.keys())}
+- Agents with partial results only (timed out while streaming): {', '.join(partial_agents) or 'none'}
 
 CRITICAL NEXT STEP: You MUST now proceed to Step 3 - Construct the Itinerary.
 1. Call get_current_state() to retrieve specialist results
@@ -167,7 +338,8 @@ DO NOT ask clarifying questions. DO NOT restart the conversation. IMMEDIATELY ge
         "expected": len(expected_agents),
         "message": summary_message.strip(),
         "results": collected_results,
-        "missing_agents": [a for a in expected_agents if a not in collected_results]
+        "missing_agents": [a for a in expected_agents if a not in collected_results],
+        "partial_agents": partial_agents
     }
 
 def send_whatsapp_message(to_number: str, message: str) -> dict:
@@ -263,6 +435,7 @@ def get_user_profile(tool_context: ToolContext) -> Dict[str, Any]:
 
 TOOLS = {
     "delegate_task": delegate_task,
+    "delegate_tasks": delegate_tasks,
     "collect_specialist_results": collect_specialist_results,
     "update_state_field": update_state_field,
     "get_current_state": get_current_state,
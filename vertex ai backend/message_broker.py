@@ -1,10 +1,23 @@
+import asyncio
+import atexit
+import inspect
 import redis
-import json
+import redis.asyncio
 import threading
 import logging
+import math
 import os
+import random
 import re
-from typing import Callable
+import socket
+import time
+import uuid
+from typing import Callable, NamedTuple
+
+import broker_metrics
+import message_protocol
+import redis_connection
+import wire_codec
 
 # --- Setup structured logging ---
 log_dir = "logs"
@@ -24,52 +37,838 @@ file_handler.setFormatter(formatter)
 if not logger.handlers:
     logger.addHandler(file_handler)
 
-class MessageBroker:
+# Queues with this prefix are the ones consumed through start_atomic_task and are
+# therefore the ones moved onto Redis Streams when the stream transport is active.
+# Reply queues (results:*) stay plain lists because they are drained with BLPOP.
+TASK_QUEUE_PREFIX = "tasks:"
+# results:<owner> is a shared reply queue; results:<owner>:<correlation_id> is a
+# per-request reply inbox that expires on its own once nobody reads it.
+RESULTS_PREFIX = "results:"
+STREAM_DATA_FIELD = "data"
+# Broker clients run with decode_responses=False so binary codecs round-trip, hence
+# stream fields come back as bytes.
+_STREAM_DATA_KEY = STREAM_DATA_FIELD.encode()
+TRANSPORTS = ("list", "stream")
+# Task queues are split into priority lanes, consumed in this order. The first lane
+# is the plain tasks:<agent> queue; the others are tasks:<agent>:<priority>.
+PRIORITIES = ("interactive", "background")
+DEFAULT_PRIORITY = PRIORITIES[0]
+# Tasks scheduled for a later retry wait in a sorted set (scored by due time in ms)
+# named delayed:<lane>, and are promoted to the lane once due.
+DELAYED_PREFIX = "delayed:"
+# Message IDs of tasks an agent completed recently, in a sorted set (scored by completion
+# time in ms) named done:<processing queue>. Redeliveries of these are acked unprocessed.
+DEDUP_PREFIX = "done:"
+# Channels and patterns are (un)subscribed in commands of at most this many names.
+PUBSUB_BATCH_SIZE = 500
+# Outcomes of tasks acked without being processed, left out of the processing time histogram.
+UNPROCESSED_OUTCOMES = ("duplicate", "expired")
+
+# Moves due entries of a delayed:<lane> sorted set onto the lane. Shared by the scripts below.
+_PROMOTE_FUNCTION = """
+local function now_ms()
+    local t = redis.call('TIME')
+    return tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+end
+local function promote(delayed, lane, mode, field)
+    local due = redis.call('ZRANGEBYSCORE', delayed, '-inf', now_ms(), 'LIMIT', 0, 100)
+    for _, payload in ipairs(due) do
+        redis.call('ZREM', delayed, payload)
+        if mode == 'stream' then
+            redis.call('XADD', lane, '*', field, payload)
+        else
+            redis.call('LPUSH', lane, payload)
+        end
+    end
+    return #due
+end
+"""
+
+# Acks a task at its source and writes a payload to a destination queue in one
+# atomic step. Backs complete-and-reply, fail-and-requeue and fail-to-DLQ.
+# On Redis Cluster a source and destination in different slots are handled by two
+# calls, one with ack mode "none" and one with write mode "none".
+#   KEYS[1] source: processing list (list transport) or task stream
+#   KEYS[2] destination queue
+#   ARGV[1] ack mode: "list" (LREM the raw payload), "stream" (XACK + XDEL) or "none"
+#   ARGV[2] raw payload (list) or stream entry ID (stream)
+#   ARGV[3] consumer group (stream ack only)
+#   ARGV[4] destination write mode: "list" (LPUSH), "stream" (XADD), "delayed"
+#           (ZADD, due ARGV[7] ms from now by the server clock) or "none"
+#   ARGV[5] payload to write
+#   ARGV[6] stream field name for XADD
+#   ARGV[7] delay in ms ("delayed" only)
+#   ARGV[8] TTL in seconds to (re)set on the destination, 0 for none (reply inboxes)
+#   ARGV[9] message ID to record as done in KEYS[3], if given (ack calls only)
+#   ARGV[10] dedup window in ms; older IDs are trimmed from KEYS[3]
+#   KEYS[3] optional done:<processing queue> dedup set
+# Returns the number of source entries acked (0 means the task was already gone).
+TRANSITION_SCRIPT = _PROMOTE_FUNCTION + """
+local acked = 0
+if ARGV[1] == 'stream' then
+    acked = redis.call('XACK', KEYS[1], ARGV[3], ARGV[2])
+    redis.call('XDEL', KEYS[1], ARGV[2])
+elseif ARGV[1] == 'list' then
+    acked = redis.call('LREM', KEYS[1], 1, ARGV[2])
+end
+if ARGV[4] == 'stream' then
+    redis.call('XADD', KEYS[2], '*', ARGV[6], ARGV[5])
+elseif ARGV[4] == 'delayed' then
+    redis.call('ZADD', KEYS[2], now_ms() + tonumber(ARGV[7]), ARGV[5])
+elseif ARGV[4] == 'list' then
+    redis.call('LPUSH', KEYS[2], ARGV[5])
+end
+if ARGV[4] ~= 'none' and tonumber(ARGV[8]) > 0 then
+    redis.call('EXPIRE', KEYS[2], ARGV[8])
+end
+if KEYS[3] and ARGV[1] ~= 'none' then
+    local now = now_ms()
+    redis.call('ZADD', KEYS[3], now, ARGV[9])
+    redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', now - tonumber(ARGV[10]))
+    redis.call('PEXPIRE', KEYS[3], ARGV[10])
+end
+return acked
+"""
+
+
+# Promotes due delayed tasks, then pops one task from the first non-empty lane,
+# in the order given (list transport).
+#   KEYS[1..n]     lanes, highest priority first
+#   KEYS[n+1..2n]  the lanes' delayed:<lane> sorted sets
+#   KEYS[2n+1]     processing list the task is moved to (ARGV[1] == "move"), else unused
+# Returns {lane index, payload} or nil when every lane is empty.
+PRIORITY_POP_SCRIPT = _PROMOTE_FUNCTION + """
+local lanes = (#KEYS - 1) / 2
+for i = 1, lanes do
+    promote(KEYS[lanes + i], KEYS[i], 'list', '')
+end
+for i = 1, lanes do
+    local payload = redis.call('RPOP', KEYS[i])
+    if payload then
+        if ARGV[1] == 'move' then
+            redis.call('LPUSH', KEYS[#KEYS], payload)
+        end
+        return {i, payload}
+    end
+end
+return nil
+"""
+
+# Promotes due delayed tasks onto their task streams (stream transport).
+#   KEYS[1..n]     task streams
+#   KEYS[n+1..2n]  the streams' delayed:<lane> sorted sets
+#   ARGV[1]        stream field name for XADD
+# Returns the number of tasks promoted.
+PROMOTE_SCRIPT = _PROMOTE_FUNCTION + """
+local lanes = #KEYS / 2
+local promoted = 0
+for i = 1, lanes do
+    promoted = promoted + promote(KEYS[lanes + i], KEYS[i], 'stream', ARGV[1])
+end
+return promoted
+"""
+
+# Schedules a payload on a delayed:<lane> sorted set, due ARGV[1] ms from now by the
+# server clock (the same clock the promote function compares against).
+#   KEYS[1]  delayed set
+#   ARGV[1]  delay in ms
+#   ARGV[2]  payload
+SCHEDULE_SCRIPT = _PROMOTE_FUNCTION + """
+return redis.call('ZADD', KEYS[1], now_ms() + tonumber(ARGV[1]), ARGV[2])
+"""
+
+# Moves one dead-lettered task back to a task lane, unless it already left the DLQ.
+#   KEYS[1]  DLQ
+#   KEYS[2]  task lane
+#   ARGV[1]  raw DLQ entry
+#   ARGV[2]  payload to write
+#   ARGV[3]  write mode: "list" (LPUSH) or "stream" (XADD)
+#   ARGV[4]  stream field name for XADD
+# Returns 1 if the task was redriven, 0 if the entry was not found.
+REDRIVE_SCRIPT = """
+if redis.call('LREM', KEYS[1], 1, ARGV[1]) == 0 then
+    return 0
+end
+if ARGV[3] == 'stream' then
+    redis.call('XADD', KEYS[2], '*', ARGV[4], ARGV[2])
+else
+    redis.call('LPUSH', KEYS[2], ARGV[2])
+end
+return 1
+"""
+# Failure messages kept on a task for DLQ triage are cut to this many characters.
+MAX_ERROR_LENGTH = 500
+
+
+def agent_task_queue(agent_name: str) -> str:
+    """The task queue an agent consumes, ``tasks:<agent>``.
+
+    On Redis Cluster the agent name becomes the key's hash tag, so an agent's task
+    lanes, processing queue, delayed sets and DLQ share one slot and the broker's
+    scripts can touch them together.
+    """
+    return TASK_QUEUE_PREFIX + redis_connection.hash_tag(agent_name)
+
+
+def agent_processing_queue(agent_name: str) -> str:
+    """The queue (or stream consumer group) holding an agent's in-flight tasks, ``processing:<agent>``."""
+    return "processing:" + redis_connection.hash_tag(agent_name)
+
+
+def agent_dead_letter_queue(agent_name: str) -> str:
+    """The queue an agent's tasks go to once they exhaust their retries, ``dlq:<agent>``."""
+    return "dlq:" + redis_connection.hash_tag(agent_name)
+
+
+class _Delivery(NamedTuple):
+    """Bookkeeping for a task handed out by start_atomic_task, used to ack it later."""
+    task: dict
+    queue: str
+    group: str | None
+    entry_id: str | None
+    raw: str
+    started: float
+
+
+class _LastSize:
+    """A wire_codec.SizeRecorder that keeps the sizes of the last payload encoded with it."""
+
+    def record(self, size_in: int, size_out: int, compressed: bool):
+        self.last = (size_in, size_out, compressed)
+
+
+class Admission(NamedTuple):
+    """Outcome of an admission check against the high-water marks of some task queues."""
+    admitted: bool
+    queue: str | None  # The fullest queue checked
+    depth: int
+    limit: int
+    retry_after: int  # Seconds a rejected caller should wait before trying again, 0 if admitted
+
+
+class _CallbackQueue:
+    """Bounded queue of decoded Pub/Sub messages for one callback, drained by its own task.
+
+    A slow callback only delays its own messages; once ``maxsize`` are waiting, the
+    oldest is dropped to make room, since Pub/Sub events are best-effort anyway.
+    """
+
+    def __init__(self, callback: Callable, maxsize: int):
+        self.callback = callback
+        self.name = getattr(callback, "__qualname__", repr(callback))
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self.worker = asyncio.create_task(self._drain())
+
+    def put(self, args: tuple) -> bool:
+        """Queues callback arguments; returns False if an older message had to be dropped."""
+        dropped = False
+        if self.queue.full():
+            self.queue.get_nowait()
+            dropped = True
+        self.queue.put_nowait(args)
+        return not dropped
+
+    async def _drain(self):
+        while True:
+            args = await self.queue.get()
+            try:
+                result = self.callback(*args)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                logger.error(f"Error in pub/sub callback {self.name}: {e}", exc_info=True)
+
+
+class BaseMessageBroker:
+    """
+    Transport configuration and delivery bookkeeping shared by MessageBroker and
+    AsyncMessageBroker. Holds no connection of its own.
+    """
+
+    def __init__(self, transport: str | None = None, codec: str | None = None):
+        self.codec = wire_codec.get_codec(codec or os.getenv("BROKER_CODEC", wire_codec.DEFAULT_CODEC))
+        # Payloads at or above the threshold are compressed; the broker_payload_bytes_* metrics show the ratio.
+        self.compressor = wire_codec.get_compressor(os.getenv("BROKER_COMPRESSION", "zlib"))
+        self.compress_threshold = int(os.getenv("BROKER_COMPRESS_THRESHOLD", "16384"))
+        self.transport = (transport or os.getenv("BROKER_TRANSPORT", "list")).strip().lower()
+        if self.transport not in TRANSPORTS:
+            raise ValueError(f"Unknown broker transport '{self.transport}'. Expected one of {TRANSPORTS}.")
+        self.consumer_name = os.getenv("BROKER_CONSUMER_NAME") or f"{socket.gethostname()}-{os.getpid()}"
+        # A pending entry idle for longer than this is considered abandoned by a crashed consumer.
+        self.claim_idle_ms = int(os.getenv("BROKER_CLAIM_IDLE_MS", "300000"))
+        # How often this process adds its recorded metrics to the shared Redis hash; 0 disables export.
+        self.metrics_flush_seconds = float(os.getenv("BROKER_METRICS_FLUSH_SECONDS", "5"))
+        # After this many interactive tasks in a row, a waiting background task goes next.
+        self.priority_burst = int(os.getenv("BROKER_PRIORITY_BURST", "10"))
+        # With every lane empty, workers block on the interactive lane for at most this long
+        # before checking the lower lanes again.
+        self.lane_poll_seconds = int(os.getenv("BROKER_LANE_POLL_SECONDS", "1"))
+        self._interactive_streak: dict[str, int] = {}
+        self._last_promote: dict[str, float] = {}
+        # Reply inboxes expire this long after the last reply written to them.
+        self.inbox_ttl_seconds = int(os.getenv("BROKER_INBOX_TTL_SECONDS", "600"))
+        # Retry backoff: attempt n waits between half and all of min(max, base * 2 ** (n - 1)) seconds.
+        self.retry_base_seconds = float(os.getenv("BROKER_RETRY_BASE_SECONDS", "2"))
+        self.retry_max_seconds = float(os.getenv("BROKER_RETRY_MAX_SECONDS", "60"))
+        # Admission control: new interactive work is refused once a task queue holds this many
+        # waiting interactive tasks, and background work once it holds the background mark in total.
+        self.high_water_mark = int(os.getenv("BROKER_HIGH_WATER_MARK", "100"))
+        self.background_high_water_mark = int(os.getenv("BROKER_BACKGROUND_HIGH_WATER_MARK", str(self.high_water_mark // 2)))
+        # Suggested back-off for refused work at the high-water mark, scaled up as the backlog grows past it.
+        self.retry_after_seconds = int(os.getenv("BROKER_RETRY_AFTER_SECONDS", "5"))
+        # Completed message IDs are remembered this long, and redeliveries of them within the
+        # window are acked without being handed to the agent again; 0 disables deduplication.
+        self.dedup_window_seconds = int(os.getenv("BROKER_DEDUP_WINDOW_SECONDS", "3600"))
+        # Messages that encode to at least this many bytes have their payload data stored
+        # separately under a claim:<sha256> key for this long (see message_protocol); 0 disables.
+        self.claim_threshold = int(os.getenv("BROKER_CLAIM_THRESHOLD", "65536"))
+        self.claim_ttl_seconds = int(os.getenv("BROKER_CLAIM_TTL_SECONDS", "86400"))
+        self._stream_groups: set[tuple[str, str]] = set()
+        self._last_claim: dict[str, float] = {}
+        # Tasks handed out by start_atomic_task, keyed by id() of the returned dict.
+        # Holding the dict itself keeps the id from being reused until the task is acked.
+        self._deliveries: dict[int, _Delivery] = {}
+        # Pub/Sub callbacks by channel, and by pattern for pattern subscriptions.
+        self.callbacks = {}
+        self.pattern_callbacks = {}
+        # Decoded Pub/Sub messages waiting for each callback of the async broker, at most this many.
+        self.pubsub_queue_size = int(os.getenv("BROKER_PUBSUB_QUEUE_SIZE", "1000"))
+
+    def _encode(self, obj, sizes: wire_codec.SizeRecorder | None = broker_metrics.PAYLOAD_SIZES) -> bytes:
+        return wire_codec.encode(obj, self.codec, self.compressor, self.compress_threshold, sizes)
+
+    def _encode_message(self, message: dict) -> tuple[bytes, tuple[str, bytes] | None]:
+        """Encodes a message, checking its payload data in if the message reaches the claim threshold.
+
+        Returns the payload to write and the ``(claim key, stored data)`` to write before it, if any.
+        """
+        if self.claim_threshold <= 0:
+            return self._encode(message), None
+        # Only the payload that is written counts towards the size metrics, not this trial encoding.
+        sizes = _LastSize()
+        payload = self._encode(message, sizes)
+        checked = None if len(payload) < self.claim_threshold else message_protocol.check_in(message, self.codec, self.compressor, self.compress_threshold)
+        if checked is None:
+            broker_metrics.PAYLOAD_SIZES.record(*sizes.last)
+            return payload, None
+        message, key, stored = checked
+        broker_metrics.REGISTRY.inc("broker_claim_checks_total", {})
+        broker_metrics.REGISTRY.inc("broker_claim_check_bytes_total", {}, len(stored))
+        logger.info(f"Checked in {len(stored)} bytes of payload data as '{key}'. Correlation ID: {message.get('header', {}).get('correlation_id')}")
+        return self._encode(message), (key, stored)
+
+    def _claim_commands(self, pipe, claim: tuple[str, bytes] | None):
+        """Queues the write of checked-in payload data, ahead of the message referring to it."""
+        if claim:
+            pipe.set(claim[0], claim[1], ex=self.claim_ttl_seconds)
+
+    @staticmethod
+    def _decode(raw: bytes):
+        """Decodes a payload written with any registered codec, or legacy plain JSON."""
+        return wire_codec.decode(raw)
+
+    @staticmethod
+    def _channel_name(channel: bytes | str) -> str:
+        return channel.decode() if isinstance(channel, bytes) else channel
+
+    def _route(self, message: dict) -> tuple[Callable, tuple] | None:
+        """Callback and arguments for a Pub/Sub message: ``(data,)`` for a channel
+        subscription, ``(channel, data)`` for a pattern subscription."""
+        channel = self._channel_name(message['channel'])
+        if message.get('type') == 'pmessage':
+            callback = self.pattern_callbacks.get(self._channel_name(message['pattern']))
+            return (callback, (channel, self._decode(message['data']))) if callback else None
+        callback = self.callbacks.get(channel)
+        return (callback, (self._decode(message['data']),)) if callback else None
+
+    @staticmethod
+    def _batches(names: list[str]) -> list[list[str]]:
+        return [names[i:i + PUBSUB_BATCH_SIZE] for i in range(0, len(names), PUBSUB_BATCH_SIZE)]
+
+    # --- Delivery bookkeeping ---
+
+    def _track_delivery(self, task: dict, queue: str, group: str | None, entry_id: str | None, raw: bytes):
+        self._deliveries[id(task)] = _Delivery(task, queue, group, entry_id, raw, time.monotonic())
+
+    def _pop_delivery(self, task: dict) -> _Delivery | None:
+        delivery = self._deliveries.pop(id(task), None)
+        if delivery is not None and delivery.task is not task:
+            return None
+        return delivery
+
+    def _raw_for(self, task: dict, delivery: _Delivery | None) -> bytes:
+        """The exact payload stored in the processing list, so LREM matches even if the task was mutated."""
+        return delivery.raw if delivery else self._encode(task)
+
+    def _queue_write(self, pipe, queue_name: str, payload: bytes):
+        """Queues the enqueue commands for one payload on a pipeline."""
+        if self._uses_stream(queue_name):
+            pipe.xadd(queue_name, {STREAM_DATA_FIELD: payload})
+        else:
+            pipe.lpush(queue_name, payload)
+        if self._is_inbox(queue_name):
+            pipe.expire(queue_name, self.inbox_ttl_seconds)
+
+    def _transition_call(self, task: dict, processing_queue: str, destination: str, message: dict, outcome: str, delay: float = 0, payload: bytes | None = None) -> tuple[list, list]:
+        """Builds KEYS/ARGV for TRANSITION_SCRIPT, consuming the task's delivery record.
+
+        With a positive ``delay`` (seconds) the message is scheduled on the destination
+        lane's delayed set instead of being written to the lane itself. ``payload`` is the
+        message already encoded, if the caller has it.
+        """
+        delivery = self._pop_delivery(task)
+        destination = self._lane_for(destination, message)
+        payload = payload if payload is not None else self._encode(message)
+        self._record_finished(processing_queue, delivery, outcome)
+        self._record_enqueue(destination)
+        if delay > 0:
+            destination, write_mode = self.delayed_name(destination), "delayed"
+        else:
+            write_mode = "stream" if self._uses_stream(destination) else "list"
+        source, ack_mode, ref, group = self._ack_ref(task, processing_queue, delivery)
+        dedup_keys, dedup_args = self._dedup_call(task, processing_queue, outcome)
+        ttl = self.inbox_ttl_seconds if self._is_inbox(destination) else 0
+        return [source, destination, *dedup_keys], [ack_mode, ref, group, write_mode, payload, STREAM_DATA_FIELD, int(delay * 1000), ttl, *dedup_args]
+
+    def _ack_call(self, task: dict, processing_queue: str, outcome: str) -> tuple[list, list]:
+        """Builds KEYS/ARGV for TRANSITION_SCRIPT that only ack the task, consuming its delivery record."""
+        delivery = self._pop_delivery(task)
+        self._record_finished(processing_queue, delivery, outcome)
+        source, ack_mode, ref, group = self._ack_ref(task, processing_queue, delivery)
+        dedup_keys, dedup_args = self._dedup_call(task, processing_queue, outcome)
+        return [source, source, *dedup_keys], [ack_mode, ref, group, "none", "", STREAM_DATA_FIELD, 0, 0, *dedup_args]
+
+    def _ack_ref(self, task: dict, processing_queue: str, delivery: _Delivery | None) -> tuple[str, str, str | bytes, str]:
+        """Source key, ack mode, entry reference and group for acking a delivered task."""
+        if delivery and delivery.entry_id:
+            return delivery.queue, "stream", delivery.entry_id, delivery.group
+        return processing_queue, "list", self._raw_for(task, delivery), ""
+
+    def _dedup_call(self, task: dict, processing_queue: str, outcome: str) -> tuple[list, list]:
+        """Extra KEYS/ARGV recording a completed task's message ID in the dedup set."""
+        message_id = self._message_id(task)
+        if outcome != "completed" or not message_id or self.dedup_window_seconds <= 0:
+            return [], ["", 0]
+        return [self.dedup_name(processing_queue)], [message_id, self.dedup_window_seconds * 1000]
+
+    @staticmethod
+    def _transition_steps(keys: list, args: list) -> list[tuple[list, list]]:
+        """Splits a transition whose keys live in different cluster slots (e.g. an agent's
+        processing queue and a caller's reply inbox) into a write call and an ack call.
+
+        Writing first means a crash in between delivers the message twice rather than never.
+        """
+        source, destination, *dedup = keys
+        if redis_connection.same_slot(*keys):
+            return [(keys, args)]
+        ack_mode, ref, group, write_mode, payload, field, delay_ms, ttl, message_id, window_ms = args
+        return [
+            ([destination, destination], ["none", "", "", write_mode, payload, field, delay_ms, ttl, "", 0]),
+            ([source, source, *dedup], [ack_mode, ref, group, "none", "", field, 0, 0, message_id, window_ms]),
+        ]
+
+    # --- Reply inboxes ---
+
+    @staticmethod
+    def reply_inbox(reply_queue: str, correlation_id: str) -> str:
+        """Per-request inbox for replies that would otherwise go to the shared ``reply_queue``,
+        e.g. ``results:main`` -> ``results:main:<correlation_id>``. Use it as ``reply_to_channel``.
+
+        On Redis Cluster the correlation ID is the hash tag, which spreads inboxes over the slots.
+        """
+        return f"{reply_queue}:{redis_connection.hash_tag(correlation_id)}"
+
+    @staticmethod
+    def _is_inbox(queue_name: str) -> bool:
+        return queue_name.startswith(RESULTS_PREFIX) and queue_name.count(":") >= 2
+
+    # --- Priority lanes ---
+
+    @staticmethod
+    def lane_name(queue_name: str, priority: str) -> str:
+        """The queue holding ``priority`` tasks of a tasks:<agent> queue. Other queues have a single lane."""
+        if priority == DEFAULT_PRIORITY or not queue_name.startswith(TASK_QUEUE_PREFIX):
+            return queue_name
+        return f"{queue_name}:{priority}"
+
+    def _lane_for(self, queue_name: str, message: dict) -> str:
+        """Routes a message to the lane matching its header priority."""
+        if any(queue_name.endswith(f":{priority}") for priority in PRIORITIES[1:]):
+            return queue_name
+        priority = message.get("header", {}).get("priority") if isinstance(message, dict) else None
+        return self.lane_name(queue_name, priority if priority in PRIORITIES else DEFAULT_PRIORITY)
+
+    def _lane_order(self, queue_name: str) -> list[str]:
+        """Lanes of a task queue in the order to try them, letting one background task
+        through after ``priority_burst`` consecutive interactive ones."""
+        lanes = [self.lane_name(queue_name, priority) for priority in PRIORITIES]
+        if len(set(lanes)) == 1:
+            return lanes[:1]
+        if self._interactive_streak.get(queue_name, 0) >= self.priority_burst:
+            lanes = lanes[1:] + lanes[:1]
+        return lanes
+
+    def _note_lane(self, queue_name: str, lane: str):
+        """Updates the starvation guard after taking a task from ``lane``."""
+        if lane == queue_name:
+            self._interactive_streak[queue_name] = self._interactive_streak.get(queue_name, 0) + 1
+        else:
+            self._interactive_streak[queue_name] = 0
+
+    @staticmethod
+    def delayed_name(lane: str) -> str:
+        """Sorted set holding tasks scheduled to re-enter ``lane`` later."""
+        return DELAYED_PREFIX + lane
+
+    @staticmethod
+    def dedup_name(processing_queue: str) -> str:
+        """Sorted set of message IDs recently completed from ``processing_queue``.
+
+        It shares the processing queue's hash tag, so it lives in the agent's cluster slot.
+        """
+        return DEDUP_PREFIX + processing_queue
+
+    @staticmethod
+    def _expired(task: dict) -> bool:
+        """Whether the task's header deadline has passed (compared with this host's clock)."""
+        deadline = task.get("header", {}).get("deadline") if isinstance(task, dict) else None
+        return deadline is not None and time.time() >= deadline
+
+    def _skip_expired(self, queue_name: str, task: dict) -> bool:
+        """Counts and logs a popped task that expired while it waited. Returns True if it did."""
+        if not self._expired(task):
+            return False
+        self._record_finished(queue_name, None, "expired")
+        logger.warning(f"Skipped task from '{queue_name}' whose deadline passed. Correlation ID: {task.get('header', {}).get('correlation_id')}")
+        return True
+
+    @staticmethod
+    def _message_id(task: dict) -> str:
+        header = task.get("header", {})
+        return header.get("message_id") or header.get("task_id") or ""
+
+    def _promote_keys(self, lanes: list[str]) -> list[str]:
+        return [*lanes, *(self.delayed_name(lane) for lane in lanes)]
+
+    def _promote_due(self, queue_name: str) -> bool:
+        """Rate-limits delayed-task promotion on the stream transport to once per lane poll."""
+        now = time.monotonic()
+        if now - self._last_promote.get(queue_name, 0.0) < self.lane_poll_seconds:
+            return False
+        self._last_promote[queue_name] = now
+        return True
+
+    # --- Retries ---
+
+    def retry_delay(self, retry_count: int) -> float:
+        """Exponential backoff with jitter for the ``retry_count``-th retry.
+
+        Half of the exponential step is fixed so retries never fire back to back; the
+        other half is random so tasks that failed together spread out again.
+        """
+        step = min(self.retry_max_seconds, self.retry_base_seconds * 2 ** max(retry_count - 1, 0))
+        return step / 2 + random.uniform(0, step / 2)
+
+    @staticmethod
+    def _record_error(task: dict, error: BaseException | str | None):
+        """Stores the failure on ``payload.last_error`` (``"<ExceptionType>: <message>"``)."""
+        if error is None:
+            return
+        if isinstance(error, BaseException):
+            error = f"{type(error).__name__}: {error}"
+        task.setdefault("payload", {})["last_error"] = error[:MAX_ERROR_LENGTH]
+
+    @staticmethod
+    def _bump_retry_count(task: dict) -> int:
+        """Increments ``payload.retry_count``, folding in the legacy top-level key."""
+        payload = task.setdefault("payload", {})
+        retry_count = max(payload.get("retry_count", 0), task.pop("retry_count", 0)) + 1
+        payload["retry_count"] = retry_count
+        return retry_count
+
+    def _lane_timeout(self, timeout: int) -> int:
+        # Never block indefinitely, so lower lanes and abandoned stream entries are still checked on an idle queue.
+        return min(timeout, self.lane_poll_seconds) if timeout else self.lane_poll_seconds
+
+    # --- Admission control ---
+
+    def _admission_lanes(self, queue_name: str, priority: str) -> list[str]:
+        """Lanes whose backlog delays work of ``priority``: its own lane and every higher one."""
+        ranked = PRIORITIES[:PRIORITIES.index(priority) + 1] if priority in PRIORITIES else PRIORITIES
+        return [self.lane_name(queue_name, p) for p in ranked]
+
+    def _backlog_commands(self, pipe, queue_names: list[str], priority: str) -> list[str]:
+        """Queues one length lookup per relevant lane; returns the task queue each lookup belongs to."""
+        owners = []
+        for queue_name in queue_names:
+            for lane in self._admission_lanes(queue_name, priority):
+                if self._uses_stream(lane):
+                    pipe.xlen(lane)
+                else:
+                    pipe.llen(lane)
+                owners.append(queue_name)
+        return owners
+
+    def _admission_from(self, owners: list[str], lengths: list[int], priority: str) -> Admission:
+        limit = self.background_high_water_mark if priority == "background" else self.high_water_mark
+        depths: dict[str, int] = {}
+        for queue_name, length in zip(owners, lengths):
+            depths[queue_name] = depths.get(queue_name, 0) + length
+        if not depths:
+            return Admission(True, None, 0, limit, 0)
+        queue_name, depth = max(depths.items(), key=lambda item: item[1])
+        if depth < limit:
+            return Admission(True, queue_name, depth, limit, 0)
+        retry_after = math.ceil(self.retry_after_seconds * depth / max(limit, 1))
+        broker_metrics.REGISTRY.inc("broker_admission_rejected_total", {"queue": queue_name, "priority": priority})
+        logger.warning(f"Admission refused for {priority} work: '{queue_name}' holds {depth} tasks (high-water mark {limit}). Retry after {retry_after}s.")
+        return Admission(False, queue_name, depth, limit, retry_after)
+
+    # --- Metrics ---
+
+    @classmethod
+    def _metric_queue(cls, queue_name: str) -> str:
+        """Queue label for metrics: reply inboxes count under their owner queue, e.g.
+        ``results:main:<correlation_id>`` -> ``results:main``, so the label set stays bounded."""
+        return queue_name.rsplit(":", 1)[0] if cls._is_inbox(queue_name) else queue_name
+
+    @classmethod
+    def _record_enqueue(cls, queue_name: str, count: int = 1):
+        broker_metrics.REGISTRY.inc("broker_enqueued_total", {"queue": cls._metric_queue(queue_name)}, count)
+
+    @classmethod
+    def _record_dequeue(cls, queue_name: str, message, entry_id: str | None = None):
+        queue_name = cls._metric_queue(queue_name)
+        broker_metrics.REGISTRY.inc("broker_dequeued_total", {"queue": queue_name})
+        enqueued_at = broker_metrics.enqueued_at(message, entry_id)
+        if enqueued_at is not None:
+            broker_metrics.REGISTRY.observe("broker_queue_wait_seconds", {"queue": queue_name}, max(0.0, time.time() - enqueued_at))
+
+    @staticmethod
+    def _record_finished(processing_queue: str, delivery: _Delivery | None, outcome: str):
+        broker_metrics.REGISTRY.inc("broker_tasks_finished_total", {"queue": processing_queue, "outcome": outcome})
+        # Duplicates and expired tasks are acked without being processed, so they would skew the histogram.
+        if delivery is not None and outcome not in UNPROCESSED_OUTCOMES:
+            broker_metrics.REGISTRY.observe("broker_processing_seconds", {"queue": processing_queue}, time.monotonic() - delivery.started)
+
+    @staticmethod
+    def _metrics_commands(pipe, increments: dict[str, float]):
+        for sample, amount in increments.items():
+            pipe.hincrbyfloat(broker_metrics.METRICS_KEY, sample, amount)
+
+    @staticmethod
+    def _depth_commands(pipe, keys: list[bytes], key_types: list[bytes]):
+        """Queues the length lookups for queue_depths; streams also report their consumer groups."""
+        for key, key_type in zip(keys, key_types):
+            if key_type == b"stream":
+                pipe.xlen(key)
+                pipe.xinfo_groups(key)
+            elif key_type == b"zset":
+                pipe.zcard(key)
+            else:
+                pipe.llen(key)
+
+    @classmethod
+    def _depths_from(cls, keys: list[bytes], key_types: list[bytes], results: list) -> dict[str, int]:
+        depths, results = {}, iter(results)
+        for key, key_type in zip(keys, key_types):
+            name = key.decode()
+            if cls._is_inbox(name):
+                # Reply inboxes are summed under their owner queue, like the other metrics.
+                owner = cls._metric_queue(name)
+                depths[owner] = depths.get(owner, 0) + next(results)
+                continue
+            if key_type == b"stream":
+                length, groups = next(results), next(results)
+                pending = 0
+                for group in groups:
+                    group_name = group["name"].decode() if isinstance(group["name"], bytes) else group["name"]
+                    depths[group_name] = depths.get(group_name, 0) + group["pending"]
+                    pending += group["pending"]
+                # Entries stay in the stream until acked, so pending ones are not waiting.
+                depths[name] = max(0, length - pending)
+            else:
+                depths[name] = depths.get(name, 0) + next(results)
+        return depths
+
+    # --- Stream transport ---
+
+    def _uses_stream(self, queue_name: str) -> bool:
+        return self.transport == "stream" and queue_name.startswith(TASK_QUEUE_PREFIX)
+
+    @staticmethod
+    def _group_for(queue_name: str) -> str:
+        """Default consumer group for a task stream: its matching processing:<agent> name."""
+        return "processing:" + queue_name[len(TASK_QUEUE_PREFIX):]
+
+    def _claim_due(self, stream: str) -> bool:
+        """Rate-limits XAUTOCLAIM to twice per idle window instead of once per dequeue."""
+        now = time.monotonic()
+        if now - self._last_claim.get(stream, 0.0) < self.claim_idle_ms / 2000:
+            return False
+        self._last_claim[stream] = now
+        return True
+
+    @staticmethod
+    def _first_entry(response) -> tuple[str, bytes] | None:
+        if not response:
+            return None
+        _, entries = response[0]
+        if not entries:
+            return None
+        entry_id, fields = entries[0]
+        return entry_id.decode(), fields.get(_STREAM_DATA_KEY)
+
+    def _decode_stream_task(self, stream: str, group: str, entry_id: str, task_json: bytes) -> dict | None:
+        try:
+            task = self._decode(task_json)
+        except (TypeError, ValueError) as e:
+            logger.error(f"Error decoding stream task {entry_id} from '{stream}': {e}", exc_info=True)
+            return None
+        self._track_delivery(task, stream, group, entry_id, task_json)
+        self._record_dequeue(stream, task, entry_id)
+        logger.info(f"Started stream task {entry_id} from '{stream}' in group '{group}'. Correlation ID: {task.get('header', {}).get('correlation_id')}")
+        return task
+
+
+# Metrics are recorded in one registry per process, so a single flusher exports them for
+# every broker in the process: a thread for MessageBroker, a task on its event loop for
+# AsyncMessageBroker. Whatever is left is flushed once more at interpreter exit.
+_metrics_flusher: BaseMessageBroker | None = None
+_metrics_flusher_lock = threading.Lock()
+_exit_flush_registered = False
+
+
+def _claim_metrics_flusher(broker: BaseMessageBroker) -> bool:
+    """Makes ``broker`` the process's metrics flusher unless another broker is. Returns True if it did."""
+    global _metrics_flusher, _exit_flush_registered
+    if broker.metrics_flush_seconds <= 0:
+        return False
+    with _metrics_flusher_lock:
+        if _metrics_flusher is not None:
+            return False
+        _metrics_flusher = broker
+        if not _exit_flush_registered:
+            atexit.register(_flush_metrics_at_exit)
+            _exit_flush_registered = True
+    return True
+
+
+def _release_metrics_flusher(broker: BaseMessageBroker):
+    """Lets the next broker that starts take over flushing, once ``broker`` stops."""
+    global _metrics_flusher
+    with _metrics_flusher_lock:
+        if _metrics_flusher is broker:
+            _metrics_flusher = None
+
+
+def _flush_metrics_at_exit():
+    # No event loop is left to run an async broker's flush on, so this always goes through a sync client.
+    increments = broker_metrics.REGISTRY.drain()
+    if not increments:
+        return
+    try:
+        pipe = redis_connection.get_client().pipeline(transaction=True)
+        BaseMessageBroker._metrics_commands(pipe, increments)
+        pipe.execute()
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Could not flush broker metrics at exit; {len(increments)} samples lost: {e}")
+
+
+class MessageBroker(BaseMessageBroker):
     """
     A centralized class for handling Redis communication, using Lists for reliable
     task queuing and Pub/Sub for ephemeral events, as per the ARCHITECTURE_GUIDE.md.
+
+    Task queues can alternatively be backed by Redis Streams (``transport="stream"``
+    or ``BROKER_TRANSPORT=stream``). In that mode every ``tasks:<agent>`` stream has a
+    consumer group named after the worker's processing queue, tasks are acked by
+    stream ID in O(1), several consumers can share one group, and entries left
+    pending by a crashed consumer are reclaimed with XAUTOCLAIM.
     """
 
-    def __init__(self):
-        """Initializes the connection to Redis using environment variables."""
-        redis_host = "localhost"
-        port_str = "".join(filter(str.isdigit, os.getenv("REDIS_PORT", "6379")))
-        redis_port = int(port_str) if port_str else 6379
-        redis_password = os.getenv("REDIS_PASSWORD", None)
-        redis_db = int(os.getenv("REDIS_DB", "0"))
+    def __init__(self, transport: str | None = None, codec: str | None = None):
+        """Connects through the process-wide pool configured by redis_connection."""
+        super().__init__(transport, codec)
+        endpoint = redis_connection.describe_endpoint()
 
         try:
-            self.redis_client = redis.Redis(host=redis_host, port=redis_port, password=redis_password, db=redis_db, decode_responses=True)
+            self.redis_client = redis_connection.get_client()
             self.redis_client.ping() # Check the connection
-            logger.info(f"MessageBroker initialized and connected to Redis at {redis_host}:{redis_port} (DB: {redis_db}).")
+            logger.info(f"MessageBroker initialized and connected to Redis at {endpoint}, transport={self.transport}, codec={self.codec.name}.")
         except redis.exceptions.ConnectionError as e:
-            logger.error(f"Could not connect to Redis at {redis_host}:{redis_port}. Please check your REDIS_HOST and REDIS_PORT environment variables. Error: {e}")
+            logger.error(f"Could not connect to Redis at {endpoint}. Please check your REDIS_HOST/REDIS_PORT or REDIS_SOCKET_PATH environment variables. Error: {e}")
             raise
             
         self.pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
         self.subscriber_thread = None
-        self.callbacks = {}
+        self._transition = self.redis_client.register_script(TRANSITION_SCRIPT)
+        self._priority_pop = self.redis_client.register_script(PRIORITY_POP_SCRIPT)
+        self._promote = self.redis_client.register_script(PROMOTE_SCRIPT)
+        self._schedule = self.redis_client.register_script(SCHEDULE_SCRIPT)
+        self._redrive = self.redis_client.register_script(REDRIVE_SCRIPT)
+        if _claim_metrics_flusher(self):
+            threading.Thread(target=self._flush_metrics_loop, name="broker-metrics", daemon=True).start()
 
-    def enqueue_task(self, queue_name: str, task: dict):
-        """Adds a critical task to a reliable queue (Redis List)."""
-        payload = json.dumps(task)
-        self.redis_client.lpush(queue_name, payload)
-        logger.info(f"Enqueued task on '{queue_name}'. Correlation ID: {task.get('header', {}).get('correlation_id')}")
+    def enqueue_task(self, queue_name: str, task: dict, delay: float = 0):
+        """Adds a critical task to a reliable queue (Redis List), in the lane matching its priority.
+
+        With a positive ``delay`` (seconds) the task is scheduled and enters its lane once due.
+        """
+        queue_name = self._lane_for(queue_name, task)
+        payload, claim = self._encode_message(task)
+        if delay > 0:
+            self._store_claim(claim)
+            self._schedule(keys=[self.delayed_name(queue_name)], args=[int(delay * 1000), payload])
+        else:
+            pipe = self.redis_client.pipeline(transaction=False)
+            self._claim_commands(pipe, claim)
+            self._queue_write(pipe, queue_name, payload)
+            pipe.execute()
+        self._record_enqueue(queue_name)
+        when = f" in {delay:.1f}s" if delay > 0 else ""
+        logger.info(f"Enqueued task on '{queue_name}'{when}. Correlation ID: {task.get('header', {}).get('correlation_id')}")
+
+    def enqueue_many(self, tasks: list[tuple[str, dict]]) -> int:
+        """Adds several tasks, possibly to different queues, in a single pipelined round trip.
+
+        Args:
+            tasks: ``(queue_name, task)`` pairs, enqueued in order.
+
+        Returns:
+            The number of tasks enqueued.
+        """
+        if not tasks:
+            return 0
+        tasks = [(self._lane_for(queue_name, task), task) for queue_name, task in tasks]
+        pipe = self.redis_client.pipeline(transaction=False)
+        for queue_name, task in tasks:
+            payload, claim = self._encode_message(task)
+            self._claim_commands(pipe, claim)
+            self._queue_write(pipe, queue_name, payload)
+        pipe.execute()
+        for queue_name, _ in tasks:
+            self._record_enqueue(queue_name)
+        logger.info(f"Enqueued {len(tasks)} tasks in one round trip on {sorted({queue for queue, _ in tasks})}.")
+        return len(tasks)
 
     def publish_event(self, channel: str, message: dict):
         """Publishes a non-critical event to a Pub/Sub channel."""
-        payload = json.dumps(message)
-        self.redis_client.publish(channel, payload)
+        payload, claim = self._encode_message(message)
+        pipe = self.redis_client.pipeline(transaction=False)
+        self._claim_commands(pipe, claim)
+        pipe.publish(channel, payload)
+        pipe.execute()
         logger.info(f"Published event to '{channel}'.")
 
     def _message_handler(self, message: dict):
         """Internal wrapper to decode and route messages from Pub/Sub."""
         try:
-            channel = message['channel']
-            if channel in self.callbacks:
-                data = json.loads(message['data'])
-                logger.info(f"Received Pub/Sub message on '{channel}'.")
-                self.callbacks[channel](data)
+            routed = self._route(message)
+            if routed:
+                callback, args = routed
+                logger.debug(f"Received Pub/Sub message on '{self._channel_name(message['channel'])}'.")
+                callback(*args)
         except Exception as e:
             logger.error(f"Error in pub/sub message handler: {e}", exc_info=True)
 
@@ -79,64 +878,961 @@ class MessageBroker:
             self.pubsub.subscribe(**{channel: self._message_handler})
             logger.info(f"Subscribed to Pub/Sub channel: {channel}")
         self.callbacks[channel] = callback
-        
+        self._start_subscriber_thread()
+
+    def subscribe_to_pattern(self, pattern: str, callback: Callable):
+        """Subscribes to every channel matching a glob-style pattern, e.g. ``events:<correlation_id>:*``.
+
+        The callback is called with the channel name and the decoded message.
+        """
+        if pattern not in self.pattern_callbacks:
+            self.pubsub.psubscribe(**{pattern: self._message_handler})
+            logger.info(f"Subscribed to Pub/Sub pattern: {pattern}")
+        self.pattern_callbacks[pattern] = callback
+        self._start_subscriber_thread()
+
+    def _start_subscriber_thread(self):
         if not self.subscriber_thread or not self.subscriber_thread.is_alive():
-            self.subscriber_thread = self.pubsub.run_in_thread(sleep_time=0.01, daemon=True)
+            # get_message blocks on the socket for up to sleep_time, so messages are handled as
+            # soon as they arrive and an idle thread only wakes once a second.
+            self.subscriber_thread = self.pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+
+    def pop_reply(self, queue_name: str, timeout: int = 0) -> dict | None:
+        """Blocks up to ``timeout`` seconds for a message on a reply queue (Redis List)."""
+        result = self.redis_client.blpop(queue_name, timeout=timeout)
+        if not result:
+            return None
+        _, raw = result
+        try:
+            reply = self._decode(raw)
+            self._record_dequeue(queue_name, reply)
+            return reply
+        except (TypeError, ValueError) as e:
+            logger.error(f"Error decoding reply from queue {queue_name}: {e}", exc_info=True)
+            return None
 
     def get_task_non_blocking(self, queue_name: str) -> dict | None:
         """
-        Retrieves a task from a reliable queue (Redis List) in a non-blocking manner.
+        Retrieves a task from a reliable queue (Redis List) in a non-blocking manner,
+        trying its priority lanes in order.
         """
+        entry_id = None
+        lanes = self._lane_order(queue_name)
         try:
-            task_json = self.redis_client.rpop(queue_name)
-            if task_json is None:
+            if self._uses_stream(queue_name):
+                group = self._group_for(queue_name)
+                if self._promote_due(queue_name):
+                    self._promote(keys=self._promote_keys(lanes), args=[STREAM_DATA_FIELD])
+                for lane in lanes:
+                    self._ensure_group(lane, group)
+                    entry = self._read_group_entry(lane, group, block_ms=None)
+                    if entry is not None:
+                        break
+                else:
+                    return None
+                entry_id, task_json = entry
+                # Same at-most-once semantics as RPOP: the entry is acked as soon as it is read.
+                self._ack_stream_entry(lane, group, entry_id)
+            else:
+                popped = self._priority_pop(keys=[*self._promote_keys(lanes), queue_name], args=["pop"])
+                if popped is None:
+                    return None
+                lane, task_json = lanes[popped[0] - 1], popped[1]
+            self._note_lane(queue_name, lane)
+            logger.info(f"Popped task from '{lane}'.")
+            task = self._decode(task_json)
+            self._record_dequeue(lane, task, entry_id)
+            if self._skip_expired(lane, task):
                 return None
-            logger.info(f"Popped task from '{queue_name}'.")
-            return json.loads(task_json)
-        except (TypeError, json.JSONDecodeError) as e:
+            return task
+        except (TypeError, ValueError) as e:
             logger.error(f"Error decoding task from queue {queue_name}: {e}")
             return None
 
     def start_atomic_task(self, main_queue: str, processing_queue: str, timeout: int = 0) -> dict | None:
-        """Atomically moves a task from the main queue to a worker-specific processing queue."""
+        """Atomically moves a task from the main queue to a worker-specific processing queue.
+
+        Priority lanes are tried in order (see ``_lane_order``). When all are empty the
+        call blocks on the interactive lane for at most ``lane_poll_seconds`` and returns
+        None if nothing arrived, so callers should simply call again.
+
+        With the stream transport the "processing queue" is the pending entries list of
+        the consumer group named ``processing_queue``.
+        """
+        if self._uses_stream(main_queue):
+            return self._start_stream_task(main_queue, processing_queue, timeout)
+        lanes = self._lane_order(main_queue)
         try:
-            logger.info(f"Atomically waiting for task from '{main_queue}' to move to '{processing_queue}'.")
-            task_json = self.redis_client.brpoplpush(main_queue, processing_queue, timeout)
-            if task_json is None:
+            popped = self._priority_pop(keys=[*self._promote_keys(lanes), processing_queue], args=["move"])
+            if popped is not None:
+                lane, task_json = lanes[popped[0] - 1], popped[1]
+            else:
+                logger.debug(f"Atomically waiting for task from '{main_queue}' to move to '{processing_queue}'.")
+                lane = main_queue
+                task_json = self.redis_client.brpoplpush(main_queue, processing_queue, self._lane_timeout(timeout))
+                if task_json is None:
+                    return None
+            self._note_lane(main_queue, lane)
+            task = self._decode(task_json)
+            self._track_delivery(task, processing_queue, None, None, task_json)
+            self._record_dequeue(lane, task)
+            if self._drop_expired(processing_queue, task) or self._drop_duplicate(processing_queue, task):
                 return None
-            task = json.loads(task_json)
-            logger.info(f"Started atomic task. Moved from '{main_queue}' to '{processing_queue}'. Correlation ID: {task.get('header', {}).get('correlation_id')}")
+            logger.info(f"Started atomic task. Moved from '{lane}' to '{processing_queue}'. Correlation ID: {task.get('header', {}).get('correlation_id')}")
             return task
-        except (TypeError, json.JSONDecodeError) as e:
+        except (TypeError, ValueError) as e:
             logger.error(f"Error decoding atomic task: {e}", exc_info=True)
             return None
 
+    def _drop_expired(self, processing_queue: str, task: dict) -> bool:
+        """Acks a just-started task whose deadline has passed, so no work is spent on it.
+
+        Returns True if the task expired, in which case it must not be processed.
+        """
+        if not self._expired(task):
+            return False
+        self._run_transition(*self._ack_call(task, processing_queue, "expired"))
+        logger.warning(f"Dropped task from '{processing_queue}' whose deadline passed. Correlation ID: {task.get('header', {}).get('correlation_id')}")
+        return True
+
+    def _drop_duplicate(self, processing_queue: str, task: dict) -> bool:
+        """Acks a just-started task whose message ID was completed within the dedup window.
+
+        Returns True if the task was a duplicate, in which case it must not be processed.
+        """
+        message_id = self._message_id(task)
+        if self.dedup_window_seconds <= 0 or not message_id:
+            return False
+        if self.redis_client.zscore(self.dedup_name(processing_queue), message_id) is None:
+            return False
+        self._run_transition(*self._ack_call(task, processing_queue, "duplicate"))
+        logger.warning(f"Dropped duplicate delivery of message {message_id} from '{processing_queue}'. Correlation ID: {task.get('header', {}).get('correlation_id')}")
+        return True
+
     def finish_atomic_task(self, processing_queue: str, task: dict):
-        """Removes a successfully processed task from the processing queue."""
-        task_json = json.dumps(task)
-        result = self.redis_client.lrem(processing_queue, 1, task_json)
+        """Removes a successfully processed task from the processing queue and records its
+        message ID as done, so redeliveries of it are dropped (see ``_drop_duplicate``)."""
+        correlation_id = task.get('header', {}).get('correlation_id')
+        result = self._run_transition(*self._ack_call(task, processing_queue, "completed"))
         if result > 0:
-            logger.info(f"Finished atomic task. Removed from '{processing_queue}'. Correlation ID: {task.get('header', {}).get('correlation_id')}")
+            logger.info(f"Finished atomic task. Removed from '{processing_queue}'. Correlation ID: {correlation_id}")
+        else:
+            logger.warning(f"Could not find task to remove from '{processing_queue}'. Race condition? Correlation ID: {correlation_id}")
+
+    def _store_claim(self, claim: tuple[str, bytes] | None):
+        if claim:
+            self.redis_client.set(claim[0], claim[1], ex=self.claim_ttl_seconds)
+
+    def _run_transition(self, keys: list, args: list) -> int:
+        acked = 0
+        for step_keys, step_args in self._transition_steps(keys, args):
+            acked = self._transition(keys=step_keys, args=step_args)
+        return acked
+
+    def complete_task(self, processing_queue: str, task: dict, reply_queue: str, reply: dict):
+        """Acks a finished task and enqueues its reply (or follow-up task) in one atomic round trip.
+
+        On Redis Cluster, if the reply queue is in another slot, the reply is written first and
+        the task acked second.
+        """
+        payload, claim = self._encode_message(reply)
+        self._store_claim(claim)
+        keys, args = self._transition_call(task, processing_queue, reply_queue, reply, "completed", payload=payload)
+        acked = self._run_transition(keys, args)
+        correlation_id = task.get('header', {}).get('correlation_id')
+        if acked:
+            logger.info(f"Completed task from '{processing_queue}' and enqueued reply on '{reply_queue}'. Correlation ID: {correlation_id}")
         else:
-            logger.warning(f"Could not find task to remove from '{processing_queue}'. Race condition? Correlation ID: {task.get('header', {}).get('correlation_id')}")
+            logger.warning(f"Enqueued reply on '{reply_queue}' but task was no longer in '{processing_queue}'. Race condition? Correlation ID: {correlation_id}")
+
+    def requeue_failed_task(self, processing_queue: str, main_queue: str, task: dict, delay: float = 0):
+        """Atomically moves a failed task from the processing queue back to the main queue for a retry.
+
+        With a positive ``delay`` (seconds) the task is scheduled instead and re-enters
+        its lane once due.
+        """
+        keys, args = self._transition_call(task, processing_queue, main_queue, task, "requeued", delay)
+        self._run_transition(keys, args)
+        when = f" in {delay:.1f}s" if delay > 0 else ""
+        logger.warning(f"Re-queued failed task from '{processing_queue}' to '{main_queue}'{when}. Correlation ID: {task.get('header', {}).get('correlation_id')}")
+
+    def fail_task(self, processing_queue: str, main_queue: str, dlq_name: str, task: dict, max_retries: int = 3, error: BaseException | str | None = None) -> float | None:
+        """Handles a failed task: increments ``payload.retry_count`` and either schedules a
+        retry with exponential backoff and jitter or, once ``max_retries`` is reached, moves
+        the task to the DLQ. ``error`` is recorded on ``payload.last_error``.
 
-    def requeue_failed_task(self, processing_queue: str, main_queue: str, task: dict):
-        """Atomically moves a failed task from the processing queue back to the main queue for a retry."""
-        task_json = json.dumps(task)
-        self.redis_client.lpush(main_queue, task_json)
-        self.redis_client.lrem(processing_queue, 1, task_json)
-        logger.warning(f"Re-queued failed task from '{processing_queue}' to '{main_queue}'. Correlation ID: {task.get('header', {}).get('correlation_id')}")
+        Returns:
+            The retry delay in seconds, or None if the task was dead-lettered.
+        """
+        self._record_error(task, error)
+        retry_count = self._bump_retry_count(task)
+        if retry_count >= max_retries:
+            self.move_to_dlq(processing_queue, dlq_name, task)
+            return None
+        delay = self.retry_delay(retry_count)
+        self.requeue_failed_task(processing_queue, main_queue, task, delay)
+        return delay
+
+    def defer_task(self, processing_queue: str, main_queue: str, task: dict, delay: float):
+        """Atomically moves a task from the processing queue back to its lane, due after ``delay``
+        seconds, without counting a retry. Used to put off background work under load."""
+        keys, args = self._transition_call(task, processing_queue, main_queue, task, "deferred", delay)
+        self._run_transition(keys, args)
+        logger.info(f"Deferred task from '{processing_queue}' to '{main_queue}' by {delay:.1f}s. Correlation ID: {task.get('header', {}).get('correlation_id')}")
 
     def move_to_dlq(self, processing_queue: str, dlq_name: str, task: dict):
         """Moves a task that has exhausted its retries to the Dead-Letter Queue."""
-        task_json = json.dumps(task)
-        self.redis_client.lpush(dlq_name, task_json)
-        self.redis_client.lrem(processing_queue, 1, task_json)
+        keys, args = self._transition_call(task, processing_queue, dlq_name, task, "dead_lettered")
+        self._run_transition(keys, args)
         logger.error(f"Moved task to DLQ '{dlq_name}' from '{processing_queue}'. Correlation ID: {task.get('header', {}).get('correlation_id')}")
 
+    def redrive_dead_letters(self, dlq_name: str, main_queue: str, entries: list[bytes]) -> int:
+        """Moves raw DLQ entries (as read with LRANGE) back to ``main_queue`` in one pipelined
+        round trip. Each task goes to the lane matching its priority with its retry count, last
+        error and deadline cleared; entries no longer in the DLQ are skipped.
+
+        Returns:
+            The number of tasks redriven.
+        """
+        pipe = self.redis_client.pipeline(transaction=False)
+        lanes = []
+        for raw in entries:
+            task = self._decode(raw)
+            payload = task.setdefault("payload", {})
+            payload["retry_count"] = 0
+            payload.pop("last_error", None)
+            task.pop("retry_count", None)
+            # The turn that set the deadline is long over; keeping it would get the task dropped as expired.
+            header = task.get("header")
+            if isinstance(header, dict) and header.get("deadline") is not None:
+                header["deadline"] = None
+            lane = self._lane_for(main_queue, task)
+            write_mode = "stream" if self._uses_stream(lane) else "list"
+            self._redrive(keys=[dlq_name, lane], args=[raw, self._encode(task), write_mode, STREAM_DATA_FIELD], client=pipe)
+            lanes.append(lane)
+        redriven = 0
+        for lane, moved in zip(lanes, pipe.execute() if lanes else []):
+            if moved:
+                self._record_enqueue(lane)
+                redriven += 1
+        logger.warning(f"Redrove {redriven} of {len(entries)} task(s) from DLQ '{dlq_name}' to '{main_queue}'.")
+        return redriven
+
+    # --- Admission control ---
+
+    def check_admission(self, queue_names: list[str], priority: str = DEFAULT_PRIORITY) -> Admission:
+        """Checks the backlog of ``queue_names`` against the high-water mark for ``priority``,
+        in one round trip. Callers should refuse or defer the work when ``admitted`` is False."""
+        pipe = self.redis_client.pipeline(transaction=False)
+        owners = self._backlog_commands(pipe, queue_names, priority)
+        return self._admission_from(owners, pipe.execute() if owners else [], priority)
+
+    # --- Metrics ---
+
+    def flush_metrics(self):
+        """Adds the metrics recorded in this process since the last flush to the shared Redis hash."""
+        increments = broker_metrics.REGISTRY.drain()
+        if not increments:
+            return
+        try:
+            pipe = self.redis_client.pipeline(transaction=True)
+            self._metrics_commands(pipe, increments)
+            pipe.execute()
+        except redis.exceptions.RedisError as e:
+            broker_metrics.REGISTRY.restore(increments)
+            logger.warning(f"Could not flush broker metrics, will retry: {e}")
+
+    def _flush_metrics_loop(self):
+        while True:
+            time.sleep(self.metrics_flush_seconds)
+            self.flush_metrics()
+
+    def queue_depths(self) -> dict[str, int]:
+        """Current length of every tasks, processing, delayed, dlq and results queue (stream groups count their
+        pending entries, and reply inboxes are summed under their owner queue)."""
+        keys = sorted({key for pattern in broker_metrics.QUEUE_DEPTH_PATTERNS for key in self.redis_client.scan_iter(match=pattern, count=500)})
+        pipe = self.redis_client.pipeline(transaction=False)
+        for key in keys:
+            pipe.type(key)
+        key_types = pipe.execute()
+        self._depth_commands(pipe, keys, key_types)
+        return self._depths_from(keys, key_types, pipe.execute())
+
+    def render_metrics(self) -> str:
+        """The fleet-wide broker metrics and current queue depths in the Prometheus text format."""
+        self.flush_metrics()
+        samples = {field.decode(): float(value) for field, value in self.redis_client.hgetall(broker_metrics.METRICS_KEY).items()}
+        return broker_metrics.render(samples, self.queue_depths())
+
+    # --- Stream transport ---
+
+    def _ensure_group(self, stream: str, group: str):
+        if (stream, group) in self._stream_groups:
+            return
+        try:
+            self.redis_client.xgroup_create(stream, group, id="0", mkstream=True)
+            logger.info(f"Created consumer group '{group}' on stream '{stream}'.")
+        except redis.exceptions.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        self._stream_groups.add((stream, group))
+
+    def _ack_stream_entry(self, stream: str, group: str, entry_id: str) -> int:
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.xack(stream, group, entry_id)
+        pipe.xdel(stream, entry_id)
+        acked, _ = pipe.execute()
+        return acked
+
+    def _read_group_entry(self, stream: str, group: str, block_ms: int | None) -> tuple[str, bytes] | None:
+        response = self.redis_client.xreadgroup(group, self.consumer_name, {stream: ">"}, count=1, block=block_ms)
+        return self._first_entry(response)
+
+    def _claim_stale_entry(self, stream: str, group: str) -> tuple[str, bytes] | None:
+        """Takes over one entry that another consumer has held for longer than claim_idle_ms."""
+        if not self._claim_due(stream):
+            return None
+        response = self.redis_client.xautoclaim(stream, group, self.consumer_name, self.claim_idle_ms, start_id="0-0", count=1)
+        entries = response[1] if response and len(response) > 1 else []
+        for entry_id, fields in entries:
+            if not fields:
+                # The entry was deleted while pending; just drop it from the PEL.
+                self.redis_client.xack(stream, group, entry_id)
+                continue
+            entry_id = entry_id.decode()
+            logger.warning(f"Reclaimed stale task {entry_id} on '{stream}' for consumer '{self.consumer_name}'.")
+            # Anything reclaimed is still a candidate for the next reclaim pass.
+            self._last_claim.pop(stream, None)
+            return entry_id, fields.get(_STREAM_DATA_KEY)
+        return None
+
+    def _start_stream_task(self, stream: str, group: str, timeout: int) -> dict | None:
+        lanes = self._lane_order(stream)
+        entry = None
+        if self._promote_due(stream):
+            self._promote(keys=self._promote_keys(lanes), args=[STREAM_DATA_FIELD])
+        for lane in lanes:
+            self._ensure_group(lane, group)
+            entry = self._claim_stale_entry(lane, group)
+            if entry is not None:
+                break
+        else:
+            for lane in lanes:
+                entry = self._read_group_entry(lane, group, block_ms=None)
+                if entry is not None:
+                    break
+            else:
+                logger.debug(f"Waiting for task from stream '{stream}' in group '{group}'.")
+                lane = stream
+                entry = self._read_group_entry(stream, group, block_ms=self._lane_timeout(timeout) * 1000)
+                if entry is None:
+                    return None
+        self._note_lane(stream, lane)
+        entry_id, task_json = entry
+        task = self._decode_stream_task(lane, group, entry_id, task_json)
+        if task is None:
+            self._ack_stream_entry(lane, group, entry_id)
+        elif self._drop_expired(group, task) or self._drop_duplicate(group, task):
+            return None
+        return task
+
     def unsubscribe(self):
         """Stops the subscriber thread and unsubscribes from all channels."""
         if self.subscriber_thread:
             self.subscriber_thread.stop()
         self.pubsub.unsubscribe()
-        logger.info("Unsubscribed from all channels and stopped subscriber thread.")
\ No newline at end of file
+        self.pubsub.punsubscribe()
+        self.callbacks.clear()
+        self.pattern_callbacks.clear()
+        logger.info("Unsubscribed from all channels and stopped subscriber thread.")
+
+
+class AsyncMessageBroker(BaseMessageBroker):
+    """
+    asyncio counterpart of MessageBroker built on redis.asyncio, with the same
+    queue, stream and Pub/Sub semantics. Every method that talks to Redis is a
+    coroutine, so agents can await queue operations without stalling their event
+    loop. Pub/Sub callbacks may be plain functions or coroutine functions.
+    """
+
+    def __init__(self, transport: str | None = None, codec: str | None = None):
+        """Takes a client on the shared asyncio pool; connections are opened lazily on first use."""
+        super().__init__(transport, codec)
+        self.subscriber_task: asyncio.Task | None = None
+        self._callback_queues: dict[Callable, _CallbackQueue] = {}
+        self._metrics_task: asyncio.Task | None = None
+        # Outstanding RPC calls by task_id, and one reply listener per inbox.
+        self._calls: dict[str, tuple[str, asyncio.Future]] = {}
+        # Callbacks for the PARTIAL replies of outstanding calls, by task_id.
+        self._partial_handlers: dict[str, Callable[[dict], None]] = {}
+        self._reply_listeners: dict[str, asyncio.Task] = {}
+        self._attach_client()
+
+    def _attach_client(self):
+        """Sets up the Redis client, its Pub/Sub handle and the broker's scripts. Brokers
+        that keep their queues elsewhere override this and leave ``redis_client`` unset."""
+        self.redis_client = redis_connection.get_async_client()
+        self.pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+        self._transition = self.redis_client.register_script(TRANSITION_SCRIPT)
+        self._priority_pop = self.redis_client.register_script(PRIORITY_POP_SCRIPT)
+        self._promote = self.redis_client.register_script(PROMOTE_SCRIPT)
+        self._schedule = self.redis_client.register_script(SCHEDULE_SCRIPT)
+        logger.info(f"AsyncMessageBroker initialized for Redis at {redis_connection.describe_endpoint()}, transport={self.transport}, codec={self.codec.name}.")
+
+    async def connect(self):
+        """Checks the connection, so startup fails fast when Redis is unreachable."""
+        try:
+            await self.redis_client.ping()
+        except redis.exceptions.ConnectionError as e:
+            logger.error(f"Could not connect to Redis at {redis_connection.describe_endpoint()}. Please check your REDIS_HOST/REDIS_PORT or REDIS_SOCKET_PATH environment variables. Error: {e}")
+            raise
+        if self._metrics_task is None and _claim_metrics_flusher(self):
+            self._metrics_task = asyncio.create_task(self._flush_metrics_loop())
+            # Released when the task ends, on close or when its event loop shuts down.
+            self._metrics_task.add_done_callback(lambda _: _release_metrics_flusher(self))
+
+    async def close(self):
+        """Stops the Pub/Sub and reply listeners. The shared pool stays open for other users in the process."""
+        await self.unsubscribe()
+        for listener in list(self._reply_listeners.values()):
+            listener.cancel()
+        for _, future in list(self._calls.values()):
+            future.cancel()
+        if self._metrics_task:
+            self._metrics_task.cancel()
+            self._metrics_task = None
+        await self.flush_metrics()
+        if not redis_connection.is_cluster():  # The cluster client is shared by the whole process
+            await self.redis_client.aclose()
+
+    async def enqueue_task(self, queue_name: str, task: dict, delay: float = 0):
+        """Adds a critical task to a reliable queue (Redis List), in the lane matching its priority.
+
+        With a positive ``delay`` (seconds) the task is scheduled and enters its lane once due.
+        """
+        queue_name = self._lane_for(queue_name, task)
+        payload, claim = self._encode_message(task)
+        if delay > 0:
+            await self._store_claim(claim)
+            await self._schedule(keys=[self.delayed_name(queue_name)], args=[int(delay * 1000), payload])
+        else:
+            pipe = self.redis_client.pipeline(transaction=False)
+            self._claim_commands(pipe, claim)
+            self._queue_write(pipe, queue_name, payload)
+            await pipe.execute()
+        self._record_enqueue(queue_name)
+        when = f" in {delay:.1f}s" if delay > 0 else ""
+        logger.info(f"Enqueued task on '{queue_name}'{when}. Correlation ID: {task.get('header', {}).get('correlation_id')}")
+
+    async def enqueue_many(self, tasks: list[tuple[str, dict]]) -> int:
+        """Adds several tasks, possibly to different queues, in a single pipelined round trip."""
+        if not tasks:
+            return 0
+        tasks = [(self._lane_for(queue_name, task), task) for queue_name, task in tasks]
+        pipe = self.redis_client.pipeline(transaction=False)
+        for queue_name, task in tasks:
+            payload, claim = self._encode_message(task)
+            self._claim_commands(pipe, claim)
+            self._queue_write(pipe, queue_name, payload)
+        await pipe.execute()
+        for queue_name, _ in tasks:
+            self._record_enqueue(queue_name)
+        logger.info(f"Enqueued {len(tasks)} tasks in one round trip on {sorted({queue for queue, _ in tasks})}.")
+        return len(tasks)
+
+    async def publish_event(self, channel: str, message: dict):
+        """Publishes a non-critical event to a Pub/Sub channel."""
+        payload, claim = self._encode_message(message)
+        pipe = self.redis_client.pipeline(transaction=False)
+        self._claim_commands(pipe, claim)
+        pipe.publish(channel, payload)
+        await pipe.execute()
+        logger.info(f"Published event to '{channel}'.")
+
+    def _message_handler(self, message: dict):
+        """Decodes a Pub/Sub message and queues it for its callback, without waiting for the callback."""
+        try:
+            routed = self._route(message)
+            if not routed:
+                return
+            callback, args = routed
+            queue = self._callback_queues.get(callback)
+            if queue is None:
+                queue = self._callback_queues[callback] = _CallbackQueue(callback, self.pubsub_queue_size)
+            if not queue.put(args):
+                broker_metrics.REGISTRY.inc("broker_pubsub_dropped_total", {"callback": queue.name})
+                logger.warning(f"Pub/Sub queue of {queue.name} is full; dropped its oldest message.")
+        except Exception as e:
+            logger.error(f"Error in pub/sub message handler: {e}", exc_info=True)
+
+    async def _listen(self):
+        """Reads Pub/Sub messages until nothing is subscribed. It waits on the socket, so an idle
+        listener uses no CPU however many channels it holds."""
+        async for message in self.pubsub.listen():
+            if message and message.get('type') in ('message', 'pmessage'):
+                self._message_handler(message)
+
+    async def _pubsub_command(self, command: str, names: list[str]):
+        """Sends (P)SUBSCRIBE/(P)UNSUBSCRIBE for ``names``, batched for large channel sets."""
+        for batch in self._batches(names):
+            await getattr(self.pubsub, command)(*batch)
+
+    def _start_listener(self):
+        if not self.subscriber_task or self.subscriber_task.done():
+            self.subscriber_task = asyncio.create_task(self._listen())
+
+    def _prune_callback_queues(self):
+        """Stops the queues of callbacks that no longer have a subscription."""
+        live = {*self.callbacks.values(), *self.pattern_callbacks.values()}
+        for callback in [callback for callback in self._callback_queues if callback not in live]:
+            self._callback_queues.pop(callback).worker.cancel()
+
+    async def subscribe_to_channel(self, channel: str, callback: Callable):
+        """Subscribes to a Pub/Sub channel for non-critical events."""
+        await self.subscribe_to_channels([channel], callback)
+
+    async def subscribe_to_channels(self, channels: list[str], callback: Callable):
+        """Subscribes one callback to many channels, e.g. one per in-flight request.
+
+        All of them are served by the broker's single listener task and share the
+        callback's bounded queue (``BROKER_PUBSUB_QUEUE_SIZE``).
+        """
+        new = [channel for channel in dict.fromkeys(channels) if channel not in self.callbacks]
+        self.callbacks.update(dict.fromkeys(channels, callback))
+        await self._pubsub_command("subscribe", new)
+        if new:
+            logger.info(f"Subscribed to {len(new)} Pub/Sub channel(s), e.g. {new[0]}")
+        self._prune_callback_queues()
+        self._start_listener()
+
+    async def subscribe_to_pattern(self, pattern: str, callback: Callable):
+        """Subscribes to every channel matching a glob-style pattern, e.g. ``events:<correlation_id>:*``.
+
+        The callback is called with the channel name and the decoded message.
+        """
+        if pattern not in self.pattern_callbacks:
+            await self._pubsub_command("psubscribe", [pattern])
+            logger.info(f"Subscribed to Pub/Sub pattern: {pattern}")
+        self.pattern_callbacks[pattern] = callback
+        self._prune_callback_queues()
+        self._start_listener()
+
+    async def unsubscribe_from_channels(self, channels: list[str]):
+        """Drops some channel subscriptions, keeping the others and the listener running."""
+        gone = [channel for channel in dict.fromkeys(channels) if self.callbacks.pop(channel, None) is not None]
+        await self._pubsub_command("unsubscribe", gone)
+        self._prune_callback_queues()
+
+    async def unsubscribe_from_pattern(self, pattern: str):
+        """Drops a pattern subscription, keeping the others and the listener running."""
+        if self.pattern_callbacks.pop(pattern, None) is not None:
+            await self._pubsub_command("punsubscribe", [pattern])
+        self._prune_callback_queues()
+
+    async def pop_reply(self, queue_name: str, timeout: int = 0) -> dict | None:
+        """Blocks up to ``timeout`` seconds for a message on a reply queue (Redis List)."""
+        result = await self.redis_client.blpop(queue_name, timeout=timeout)
+        if not result:
+            return None
+        _, raw = result
+        try:
+            reply = self._decode(raw)
+            self._record_dequeue(queue_name, reply)
+            return reply
+        except (TypeError, ValueError) as e:
+            logger.error(f"Error decoding reply from queue {queue_name}: {e}", exc_info=True)
+            return None
+
+    # --- Request/response ---
+
+    async def call(self, agent_name: str, message: dict, timeout: float | None = None, reply_to: str | None = None) -> dict:
+        """Sends a task to ``agent_task_queue(agent_name)`` and waits for its reply.
+
+        Raises:
+            asyncio.TimeoutError: If no reply arrived within ``timeout`` seconds.
+        """
+        (future,) = await self.call_many([(agent_name, message)], timeout, reply_to)
+        return await future
+
+    async def call_many(self, calls: list[tuple[str, dict]], timeout: float | None = None, reply_to: str | None = None,
+                        on_partial: Callable[[dict], None] | None = None) -> list[asyncio.Future]:
+        """Sends several tasks in one round trip and returns a future per task, in order.
+
+        Each future resolves to the reply whose ``header.task_id`` matches the task, so
+        callers can ``asyncio.gather`` them or handle replies as they complete. Replies
+        go to ``reply_to`` (by default an inbox owned by this broker) and are routed to
+        their futures by a single listener per inbox. With a ``timeout`` a future that
+        is still pending after that many seconds fails with asyncio.TimeoutError.
+
+        PARTIAL replies sent before a task's result (see send_partial) do not resolve its
+        future; they are passed to ``on_partial``, if given, as they arrive.
+        """
+        loop = asyncio.get_running_loop()
+        inbox = reply_to or self.reply_inbox(f"{RESULTS_PREFIX}rpc", self.consumer_name)
+        futures, tasks = [], []
+        for agent_name, message in calls:
+            header = message.setdefault("header", {})
+            header["task_id"] = header.get("task_id") or str(uuid.uuid4())
+            header["reply_to_channel"] = inbox
+            future = loop.create_future()
+            self._register_call(header["task_id"], inbox, future, on_partial)
+            if timeout is not None:
+                timer = loop.call_later(timeout, self._expire_call, future, agent_name, timeout)
+                future.add_done_callback(lambda _, timer=timer: timer.cancel())
+            futures.append(future)
+            tasks.append((agent_task_queue(agent_name), message))
+        try:
+            await self.enqueue_many(tasks)
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+        if inbox not in self._reply_listeners:
+            self._reply_listeners[inbox] = asyncio.create_task(self._dispatch_replies(inbox))
+        return futures
+
+    def _register_call(self, task_id: str, inbox: str, future: asyncio.Future, on_partial: Callable[[dict], None] | None = None):
+        self._calls[task_id] = (inbox, future)
+        if on_partial:
+            self._partial_handlers[task_id] = on_partial
+        future.add_done_callback(lambda _: (self._calls.pop(task_id, None), self._partial_handlers.pop(task_id, None)))
+
+    @staticmethod
+    def _expire_call(future: asyncio.Future, agent_name: str, timeout: float):
+        if not future.done():
+            future.set_exception(asyncio.TimeoutError(f"No reply from '{agent_name}' within {timeout}s."))
+
+    async def _dispatch_replies(self, inbox: str):
+        """Resolves pending calls from replies on ``inbox`` until none are left."""
+        try:
+            while any(pending_inbox == inbox for pending_inbox, _ in self._calls.values()):
+                reply = await self.pop_reply(inbox, timeout=self.lane_poll_seconds)
+                if reply is None:
+                    continue
+                header = reply.get("header", {})
+                task_id = header.get("task_id")
+                if header.get("message_type") == "PARTIAL":
+                    self._deliver_partial(task_id, reply)
+                    continue
+                pending = self._calls.get(task_id)
+                if pending is None or pending[1].done():
+                    logger.warning(f"Dropped reply on '{inbox}' for unknown or expired call {task_id}.")
+                    continue
+                pending[1].set_result(reply)
+        except Exception as e:
+            logger.error(f"Reply listener for '{inbox}' failed: {e}", exc_info=True)
+            for pending_inbox, future in list(self._calls.values()):
+                if pending_inbox == inbox and not future.done():
+                    future.set_exception(e)
+        finally:
+            self._reply_listeners.pop(inbox, None)
+
+    def _deliver_partial(self, task_id: str, reply: dict):
+        handler = self._partial_handlers.get(task_id)
+        if handler is None:
+            # Replies are not ordered, so partials may trail their result, which holds them all anyway.
+            logger.debug(f"Dropped partial reply for call {task_id}, which is finished or has no partial handler.")
+            return
+        try:
+            handler(reply)
+        except Exception as e:
+            logger.error(f"Partial reply handler for call {task_id} failed: {e}", exc_info=True)
+
+    async def send_partial(self, reply_queue: str, message: dict):
+        """Sends a PARTIAL reply ahead of a task's result, without acking the task.
+
+        The task stays in the processing queue until complete_task sends the RESULT, so if
+        the worker dies mid-stream the task is redelivered and its retry streams the
+        partials again from seq 0.
+        """
+        await self.enqueue_task(reply_queue, message)
+
+    async def get_task_non_blocking(self, queue_name: str) -> dict | None:
+        """
+        Retrieves a task from a reliable queue (Redis List) in a non-blocking manner,
+        trying its priority lanes in order.
+        """
+        entry_id = None
+        lanes = self._lane_order(queue_name)
+        try:
+            if self._uses_stream(queue_name):
+                group = self._group_for(queue_name)
+                if self._promote_due(queue_name):
+                    await self._promote(keys=self._promote_keys(lanes), args=[STREAM_DATA_FIELD])
+                for lane in lanes:
+                    await self._ensure_group(lane, group)
+                    entry = await self._read_group_entry(lane, group, block_ms=None)
+                    if entry is not None:
+                        break
+                else:
+                    return None
+                entry_id, task_json = entry
+                # Same at-most-once semantics as RPOP: the entry is acked as soon as it is read.
+                await self._ack_stream_entry(lane, group, entry_id)
+            else:
+                popped = await self._priority_pop(keys=[*self._promote_keys(lanes), queue_name], args=["pop"])
+                if popped is None:
+                    return None
+                lane, task_json = lanes[popped[0] - 1], popped[1]
+            self._note_lane(queue_name, lane)
+            logger.info(f"Popped task from '{lane}'.")
+            task = self._decode(task_json)
+            self._record_dequeue(lane, task, entry_id)
+            if self._skip_expired(lane, task):
+                return None
+            return task
+        except (TypeError, ValueError) as e:
+            logger.error(f"Error decoding task from queue {queue_name}: {e}")
+            return None
+
+    async def start_atomic_task(self, main_queue: str, processing_queue: str, timeout: int = 0) -> dict | None:
+        """Atomically moves a task from the main queue to a worker-specific processing queue.
+
+        Priority lanes are tried in order (see ``_lane_order``). When all are empty the
+        call blocks on the interactive lane for at most ``lane_poll_seconds`` and returns
+        None if nothing arrived, so callers should simply call again.
+
+        With the stream transport the "processing queue" is the pending entries list of
+        the consumer group named ``processing_queue``.
+        """
+        if self._uses_stream(main_queue):
+            return await self._start_stream_task(main_queue, processing_queue, timeout)
+        lanes = self._lane_order(main_queue)
+        try:
+            popped = await self._priority_pop(keys=[*self._promote_keys(lanes), processing_queue], args=["move"])
+            if popped is not None:
+                lane, task_json = lanes[popped[0] - 1], popped[1]
+            else:
+                logger.debug(f"Atomically waiting for task from '{main_queue}' to move to '{processing_queue}'.")
+                lane = main_queue
+                task_json = await self.redis_client.brpoplpush(main_queue, processing_queue, self._lane_timeout(timeout))
+                if task_json is None:
+                    return None
+            self._note_lane(main_queue, lane)
+            task = self._decode(task_json)
+            self._track_delivery(task, processing_queue, None, None, task_json)
+            self._record_dequeue(lane, task)
+            if await self._drop_expired(processing_queue, task) or await self._drop_duplicate(processing_queue, task):
+                return None
+            logger.info(f"Started atomic task. Moved from '{lane}' to '{processing_queue}'. Correlation ID: {task.get('header', {}).get('correlation_id')}")
+            return task
+        except (TypeError, ValueError) as e:
+            logger.error(f"Error decoding atomic task: {e}", exc_info=True)
+            return None
+
+    async def _drop_expired(self, processing_queue: str, task: dict) -> bool:
+        """Acks a just-started task whose deadline has passed, so no work is spent on it.
+
+        Returns True if the task expired, in which case it must not be processed.
+        """
+        if not self._expired(task):
+            return False
+        await self._run_transition(*self._ack_call(task, processing_queue, "expired"))
+        logger.warning(f"Dropped task from '{processing_queue}' whose deadline passed. Correlation ID: {task.get('header', {}).get('correlation_id')}")
+        return True
+
+    async def _drop_duplicate(self, processing_queue: str, task: dict) -> bool:
+        """Acks a just-started task whose message ID was completed within the dedup window.
+
+        Returns True if the task was a duplicate, in which case it must not be processed.
+        """
+        message_id = self._message_id(task)
+        if self.dedup_window_seconds <= 0 or not message_id:
+            return False
+        if await self.redis_client.zscore(self.dedup_name(processing_queue), message_id) is None:
+            return False
+        await self._run_transition(*self._ack_call(task, processing_queue, "duplicate"))
+        logger.warning(f"Dropped duplicate delivery of message {message_id} from '{processing_queue}'. Correlation ID: {task.get('header', {}).get('correlation_id')}")
+        return True
+
+    async def finish_atomic_task(self, processing_queue: str, task: dict):
+        """Removes a successfully processed task from the processing queue and records its
+        message ID as done, so redeliveries of it are dropped (see ``_drop_duplicate``)."""
+        correlation_id = task.get('header', {}).get('correlation_id')
+        result = await self._run_transition(*self._ack_call(task, processing_queue, "completed"))
+        if result > 0:
+            logger.info(f"Finished atomic task. Removed from '{processing_queue}'. Correlation ID: {correlation_id}")
+        else:
+            logger.warning(f"Could not find task to remove from '{processing_queue}'. Race condition? Correlation ID: {correlation_id}")
+
+    async def _store_claim(self, claim: tuple[str, bytes] | None):
+        if claim:
+            await self.redis_client.set(claim[0], claim[1], ex=self.claim_ttl_seconds)
+
+    async def _run_transition(self, keys: list, args: list) -> int:
+        acked = 0
+        for step_keys, step_args in self._transition_steps(keys, args):
+            acked = await self._transition(keys=step_keys, args=step_args)
+        return acked
+
+    async def complete_task(self, processing_queue: str, task: dict, reply_queue: str, reply: dict):
+        """Acks a finished task and enqueues its reply (or follow-up task) in one atomic round trip.
+
+        On Redis Cluster, if the reply queue is in another slot, the reply is written first and
+        the task acked second.
+        """
+        payload, claim = self._encode_message(reply)
+        await self._store_claim(claim)
+        keys, args = self._transition_call(task, processing_queue, reply_queue, reply, "completed", payload=payload)
+        acked = await self._run_transition(keys, args)
+        correlation_id = task.get('header', {}).get('correlation_id')
+        if acked:
+            logger.info(f"Completed task from '{processing_queue}' and enqueued reply on '{reply_queue}'. Correlation ID: {correlation_id}")
+        else:
+            logger.warning(f"Enqueued reply on '{reply_queue}' but task was no longer in '{processing_queue}'. Race condition? Correlation ID: {correlation_id}")
+
+    async def requeue_failed_task(self, processing_queue: str, main_queue: str, task: dict, delay: float = 0):
+        """Atomically moves a failed task from the processing queue back to the main queue for a retry.
+
+        With a positive ``delay`` (seconds) the task is scheduled instead and re-enters
+        its lane once due.
+        """
+        keys, args = self._transition_call(task, processing_queue, main_queue, task, "requeued", delay)
+        await self._run_transition(keys, args)
+        when = f" in {delay:.1f}s" if delay > 0 else ""
+        logger.warning(f"Re-queued failed task from '{processing_queue}' to '{main_queue}'{when}. Correlation ID: {task.get('header', {}).get('correlation_id')}")
+
+    async def fail_task(self, processing_queue: str, main_queue: str, dlq_name: str, task: dict, max_retries: int = 3, error: BaseException | str | None = None) -> float | None:
+        """Handles a failed task: increments ``payload.retry_count`` and either schedules a
+        retry with exponential backoff and jitter or, once ``max_retries`` is reached, moves
+        the task to the DLQ. ``error`` is recorded on ``payload.last_error``.
+
+        Returns:
+            The retry delay in seconds, or None if the task was dead-lettered.
+        """
+        self._record_error(task, error)
+        retry_count = self._bump_retry_count(task)
+        if retry_count >= max_retries:
+            await self.move_to_dlq(processing_queue, dlq_name, task)
+            return None
+        delay = self.retry_delay(retry_count)
+        await self.requeue_failed_task(processing_queue, main_queue, task, delay)
+        return delay
+
+    async def defer_task(self, processing_queue: str, main_queue: str, task: dict, delay: float):
+        """Atomically moves a task from the processing queue back to its lane, due after ``delay``
+        seconds, without counting a retry. Used to put off background work under load."""
+        keys, args = self._transition_call(task, processing_queue, main_queue, task, "deferred", delay)
+        await self._run_transition(keys, args)
+        logger.info(f"Deferred task from '{processing_queue}' to '{main_queue}' by {delay:.1f}s. Correlation ID: {task.get('header', {}).get('correlation_id')}")
+
+    async def move_to_dlq(self, processing_queue: str, dlq_name: str, task: dict):
+        """Moves a task that has exhausted its retries to the Dead-Letter Queue."""
+        keys, args = self._transition_call(task, processing_queue, dlq_name, task, "dead_lettered")
+        await self._run_transition(keys, args)
+        logger.error(f"Moved task to DLQ '{dlq_name}' from '{processing_queue}'. Correlation ID: {task.get('header', {}).get('correlation_id')}")
+
+    # --- Admission control ---
+
+    async def check_admission(self, queue_names: list[str], priority: str = DEFAULT_PRIORITY) -> Admission:
+        """Checks the backlog of ``queue_names`` against the high-water mark for ``priority``,
+        in one round trip. Callers should refuse or defer the work when ``admitted`` is False."""
+        pipe = self.redis_client.pipeline(transaction=False)
+        owners = self._backlog_commands(pipe, queue_names, priority)
+        return self._admission_from(owners, await pipe.execute() if owners else [], priority)
+
+    # --- Metrics ---
+
+    async def flush_metrics(self):
+        """Adds the metrics recorded in this process since the last flush to the shared Redis hash."""
+        increments = broker_metrics.REGISTRY.drain()
+        if not increments:
+            return
+        try:
+            pipe = self.redis_client.pipeline(transaction=True)
+            self._metrics_commands(pipe, increments)
+            await pipe.execute()
+        except redis.exceptions.RedisError as e:
+            broker_metrics.REGISTRY.restore(increments)
+            logger.warning(f"Could not flush broker metrics, will retry: {e}")
+
+    async def _flush_metrics_loop(self):
+        while True:
+            await asyncio.sleep(self.metrics_flush_seconds)
+            await self.flush_metrics()
+
+    # --- Stream transport ---
+
+    async def _ensure_group(self, stream: str, group: str):
+        if (stream, group) in self._stream_groups:
+            return
+        try:
+            await self.redis_client.xgroup_create(stream, group, id="0", mkstream=True)
+            logger.info(f"Created consumer group '{group}' on stream '{stream}'.")
+        except redis.exceptions.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        self._stream_groups.add((stream, group))
+
+    async def _ack_stream_entry(self, stream: str, group: str, entry_id: str) -> int:
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.xack(stream, group, entry_id)
+        pipe.xdel(stream, entry_id)
+        acked, _ = await pipe.execute()
+        return acked
+
+    async def _read_group_entry(self, stream: str, group: str, block_ms: int | None) -> tuple[str, bytes] | None:
+        response = await self.redis_client.xreadgroup(group, self.consumer_name, {stream: ">"}, count=1, block=block_ms)
+        return self._first_entry(response)
+
+    async def _claim_stale_entry(self, stream: str, group: str) -> tuple[str, bytes] | None:
+        """Takes over one entry that another consumer has held for longer than claim_idle_ms."""
+        if not self._claim_due(stream):
+            return None
+        response = await self.redis_client.xautoclaim(stream, group, self.consumer_name, self.claim_idle_ms, start_id="0-0", count=1)
+        entries = response[1] if response and len(response) > 1 else []
+        for entry_id, fields in entries:
+            if not fields:
+                await self.redis_client.xack(stream, group, entry_id)
+                continue
+            entry_id = entry_id.decode()
+            logger.warning(f"Reclaimed stale task {entry_id} on '{stream}' for consumer '{self.consumer_name}'.")
+            self._last_claim.pop(stream, None)
+            return entry_id, fields.get(_STREAM_DATA_KEY)
+        return None
+
+    async def _start_stream_task(self, stream: str, group: str, timeout: int) -> dict | None:
+        lanes = self._lane_order(stream)
+        entry = None
+        if self._promote_due(stream):
+            await self._promote(keys=self._promote_keys(lanes), args=[STREAM_DATA_FIELD])
+        for lane in lanes:
+            await self._ensure_group(lane, group)
+            entry = await self._claim_stale_entry(lane, group)
+            if entry is not None:
+                break
+        else:
+            for lane in lanes:
+                entry = await self._read_group_entry(lane, group, block_ms=None)
+                if entry is not None:
+                    break
+            else:
+                logger.debug(f"Waiting for task from stream '{stream}' in group '{group}'.")
+                lane = stream
+                entry = await self._read_group_entry(stream, group, block_ms=self._lane_timeout(timeout) * 1000)
+                if entry is None:
+                    return None
+        self._note_lane(stream, lane)
+        entry_id, task_json = entry
+        task = self._decode_stream_task(lane, group, entry_id, task_json)
+        if task is None:
+            await self._ack_stream_entry(lane, group, entry_id)
+        elif await self._drop_expired(group, task) or await self._drop_duplicate(group, task):
+            return None
+        return task
+
+    async def unsubscribe(self):
+        """Stops the listener task and unsubscribes from all channels."""
+        if self.subscriber_task:
+            self.subscriber_task.cancel()
+            try:
+                await self.subscriber_task
+            except asyncio.CancelledError:
+                pass
+            self.subscriber_task = None
+        await self.pubsub.unsubscribe()
+        await self.pubsub.punsubscribe()
+        self.callbacks.clear()
+        self.pattern_callbacks.clear()
+        self._prune_callback_queues()
+        logger.info("Unsubscribed from all channels and stopped listener task.")
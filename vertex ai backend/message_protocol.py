@@ -1,50 +1,181 @@
 
-from pydantic import BaseModel, Field
-from typing import Dict, Any, Literal, List
+from pydantic import BaseModel, ConfigDict, Discriminator, Field, PrivateAttr, Tag, model_validator
+from typing import Annotated, Callable, Dict, Any, Literal, List, Union
+import hashlib
+import time
 import uuid
 from datetime import datetime, timezone
 
+import wire_codec
+
+# Claim checks: the broker stores payload data that would make a message too large once,
+# under claim:<sha256 of the stored bytes> with a TTL, and the message carries
+# {"claim_check": <key>, "size": <stored bytes>} in its place. Identical data from any
+# number of messages shares one key.
+CLAIM_PREFIX = "claim:"
+CLAIM_FIELD = "claim_check"
+
+class ClaimCheckExpired(LookupError):
+    """The data a claim check refers to is no longer stored (its TTL ran out)."""
+
+def is_claim_check(value: Any) -> bool:
+    return isinstance(value, dict) and isinstance(value.get(CLAIM_FIELD), str) and value[CLAIM_FIELD].startswith(CLAIM_PREFIX)
+
+def check_in(message: dict, codec: wire_codec.Codec, compressor: wire_codec.Compressor | None = None, threshold: int = 0) -> tuple[dict, str, bytes] | None:
+    """Replaces a message's payload data with a claim check.
+
+    Returns the new message (the original is not modified), the claim key and the
+    encoded data to store under it, or None if the payload has no data to check in.
+    """
+    payload = message.get("payload")
+    if not isinstance(payload, dict) or payload.get("data") is None or is_claim_check(payload["data"]):
+        return None
+    stored = wire_codec.encode(payload["data"], codec, compressor, threshold)
+    key = CLAIM_PREFIX + hashlib.sha256(stored).hexdigest()
+    return {**message, "payload": {**payload, "data": {CLAIM_FIELD: key, "size": len(stored)}}}, key, stored
+
+def _redis_claim_loader(key: str) -> bytes | None:
+    import redis_connection
+    return redis_connection.get_client().get(key)
+
+_claim_loader: Callable[[str], bytes | None] = _redis_claim_loader
+
+def set_claim_loader(loader: Callable[[str], bytes | None]):
+    """Sets how claimed data is fetched by key. Defaults to a GET on the process-wide Redis client."""
+    global _claim_loader
+    _claim_loader = loader
+
+def redeem(value: Any) -> Any:
+    """Fetches the data a claim check refers to; any other value is returned as is."""
+    if not is_claim_check(value):
+        return value
+    stored = _claim_loader(value[CLAIM_FIELD])
+    if stored is None:
+        raise ClaimCheckExpired(f"Claimed payload data '{value[CLAIM_FIELD]}' has expired.")
+    return wire_codec.decode(stored)
+
+def load_data(payload: dict, default: Any = None) -> Any:
+    """``payload["data"]`` of a decoded message dict, fetched if it was checked in."""
+    return redeem(payload.get("data", default))
+
 def get_utc_timestamp() -> str:
     return datetime.now(timezone.utc).isoformat()
 
 def create_message_id() -> str:
     return str(uuid.uuid4())
 
+def deadline_in(seconds: float) -> float:
+    """An absolute ``Header.deadline``, ``seconds`` from now."""
+    return time.time() + seconds
+
 class Header(BaseModel):
     message_id: str = Field(default_factory=create_message_id)
     correlation_id: str # Tracks the entire user request journey
     task_id: str | None = None # ID for a specific task-response loop
     timestamp: str = Field(default_factory=get_utc_timestamp)
-    message_type: Literal["TASK", "RESULT", "CLARIFICATION_REQUEST", "ERROR", "EVENT"]
+    message_type: Literal["TASK", "RESULT", "PARTIAL", "CLARIFICATION_REQUEST", "ERROR", "EVENT"]
     source_agent: str
     target_agent: str | None = None
     reply_to_channel: str | None = None
+    # Lane the broker queues a TASK in. Background work never delays interactive chat turns.
+    priority: Literal["interactive", "background"] = "interactive"
+    # Unix time after which nobody waits for the outcome any more. Copied onto every task
+    # a hop sends on behalf of this one; brokers drop tasks picked up past it unprocessed.
+    deadline: float | None = None
 
 class TaskPayload(BaseModel):
     task_name: str
     parameters: Dict[str, Any]
     retry_count: int = 0
+    # Set by the broker when the task fails, so dead-lettered tasks can be grouped by cause.
+    last_error: str | None = None
+
+class _ClaimCheckedData(BaseModel):
+    """Payload whose ``data`` may arrive as a claim check, fetched on first access to ``data``.
 
-class ResultPayload(BaseModel):
+    The value as sent (inline data or the claim check) is ``raw_data``; it is validated
+    and serialized as "data", so a checked-in payload is forwarded without fetching it.
+    """
+    model_config = ConfigDict(validate_by_name=True, validate_by_alias=True, serialize_by_alias=True)
+    # (fetched data,) once a claim check has been redeemed
+    _loaded: tuple | None = PrivateAttr(default=None)
+
+    @property
+    def data(self) -> Any:
+        if not is_claim_check(self.raw_data):
+            return self.raw_data
+        if self._loaded is None:
+            self._loaded = (redeem(self.raw_data),)
+        return self._loaded[0]
+
+    @data.setter
+    def data(self, value: Any):
+        self.raw_data = value
+        self._loaded = None
+
+class ResultPayload(_ClaimCheckedData):
     status: Literal["SUCCESS", "FAILURE"]
-    data: Any
+    raw_data: Any = Field(alias="data")
     error_message: str | None = None
 
+class PartialPayload(_ClaimCheckedData):
+    """One piece of a specialist's output (e.g. one hotel option), sent before its RESULT.
+
+    Pieces are numbered from 0 per task and may arrive out of order; the last one has
+    ``final`` set, so a receiver holding seq 0..n of a final n has the whole set. The
+    RESULT that follows still carries the complete output.
+    """
+    seq: int
+    raw_data: Any = Field(alias="data")
+    final: bool = False
+
 class ClarificationPayload(BaseModel):
     question: str
     options: List[str] | None = None
 
-class EventPayload(BaseModel):
+class EventPayload(_ClaimCheckedData):
     event_name: str
-    data: Dict[str, Any]
+    raw_data: Dict[str, Any] = Field(alias="data")
 
 class ErrorPayload(BaseModel):
     error_code: str
     error_message: str
 
+# Payload model for each header.message_type.
+PAYLOAD_TYPES = {
+    "TASK": TaskPayload,
+    "RESULT": ResultPayload,
+    "PARTIAL": PartialPayload,
+    "CLARIFICATION_REQUEST": ClarificationPayload,
+    "EVENT": EventPayload,
+    "ERROR": ErrorPayload,
+}
+_MESSAGE_TYPES = {payload_type: message_type for message_type, payload_type in PAYLOAD_TYPES.items()}
+# A required field that only one payload type has, so a raw payload's type can be told without trying them all.
+_PAYLOAD_KEYS = (("task_name", "TASK"), ("status", "RESULT"), ("seq", "PARTIAL"), ("question", "CLARIFICATION_REQUEST"), ("event_name", "EVENT"), ("error_code", "ERROR"))
+
+def _payload_type(payload: Any) -> str | None:
+    if isinstance(payload, dict):
+        return next((message_type for key, message_type in _PAYLOAD_KEYS if key in payload), None)
+    return _MESSAGE_TYPES.get(type(payload))
+
+# Validated against the one matching member instead of each member in turn.
+Payload = Annotated[
+    Union[tuple(Annotated[payload_type, Tag(message_type)] for message_type, payload_type in PAYLOAD_TYPES.items())],
+    Discriminator(_payload_type),
+]
+
 class Message(BaseModel):
     header: Header
-    payload: TaskPayload | ResultPayload | ClarificationPayload | EventPayload | ErrorPayload
+    payload: Payload
+
+    @model_validator(mode="after")
+    def _payload_matches_type(self) -> "Message":
+        # The payload is discriminated on its own keys, so check it agrees with the header.
+        expected = PAYLOAD_TYPES[self.header.message_type]
+        if not isinstance(self.payload, expected):
+            raise ValueError(f"{self.header.message_type} message carries a {type(self.payload).__name__}, expected {expected.__name__}")
+        return self
 
     def to_json(self):
         return self.model_dump_json()
@@ -52,3 +183,14 @@ class Message(BaseModel):
     @classmethod
     def from_json(cls, json_str: str):
         return cls.model_validate_json(json_str)
+
+    def to_wire(self, codec: wire_codec.Codec | None = None, compressor: wire_codec.Compressor | None = None, threshold: int = 0) -> bytes:
+        """Serializes straight to the broker's stored format, without an intermediate dict for JSON."""
+        codec = codec or wire_codec.get_codec(wire_codec.DEFAULT_CODEC)
+        body = self.model_dump_json().encode() if codec.name == wire_codec.DEFAULT_CODEC else codec.dumps(self.model_dump())
+        return wire_codec.encode_body(body, codec, compressor, threshold)
+
+    @classmethod
+    def from_wire(cls, raw: bytes | str) -> "Message":
+        """Parses a payload as stored by the broker, in any codec."""
+        return cls.model_validate(wire_codec.decode(raw))
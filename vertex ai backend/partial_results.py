@@ -0,0 +1,130 @@
+"""
+Incremental specialist output.
+
+Specialists answer with JSON of the form ``{"results": [{...}, {...}], ...}``. While the
+model is still writing it, ResultStreamer picks each finished object out of the
+``results`` array, and PartialReplies sends it to the caller as a PARTIAL message (see
+message_protocol.PartialPayload), so the orchestrator has the first options long before
+the turn, and the RESULT that ends it, is over.
+
+The newest option is held back until the next one is complete or the output ends, so
+the last PARTIAL of a task can be sent with ``final`` set.
+"""
+import json
+import logging
+import re
+
+from message_broker import AsyncMessageBroker
+from message_protocol import Header, Message, PartialPayload
+
+logger = logging.getLogger(__name__)
+
+_RESULTS_ARRAY = re.compile(r'"results"\s*:\s*\[')
+
+
+class ResultStreamer:
+    """Finds the complete objects of a ``"results"`` array in JSON text fed in chunks."""
+
+    def __init__(self):
+        self.text = ""
+        self._pos = -1  # scan position once inside the array, -1 before it is found
+        self._depth = 0
+        self._start = 0
+        self._in_string = False
+        self._escaped = False
+        self.done = False
+
+    def feed(self, chunk: str) -> list[dict]:
+        """Adds streamed text and returns the objects completed by it, in order."""
+        self.text += chunk
+        if self.done:
+            return []
+        if self._pos < 0:
+            match = _RESULTS_ARRAY.search(self.text)
+            if not match:
+                return []
+            self._pos = match.end()
+        found = []
+        while self._pos < len(self.text):
+            char = self.text[self._pos]
+            self._pos += 1
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                if self._depth == 0:
+                    self._start = self._pos - 1
+                self._depth += 1
+            elif char in "}]":
+                if self._depth == 0:
+                    # The results array itself closed.
+                    self.done = True
+                    break
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        item = json.loads(self.text[self._start:self._pos])
+                    except json.JSONDecodeError:
+                        continue
+                    if isinstance(item, dict):
+                        found.append(item)
+        return found
+
+
+class PartialReplies:
+    """Streams the results of one task to its caller as PARTIAL replies."""
+
+    def __init__(self, broker: AsyncMessageBroker, task_message: Message, agent_name: str):
+        self.broker = broker
+        self.task_message = task_message
+        self.agent_name = agent_name
+        self.streamer = ResultStreamer()
+        self.sent = 0
+        self._held: dict | None = None
+
+    @property
+    def enabled(self) -> bool:
+        # Without a reply channel nobody is waiting for this task, so there is no one to stream to.
+        return bool(self.task_message.header.reply_to_channel)
+
+    async def feed(self, chunk: str):
+        """Feeds streamed model text, sending every result it completes but the newest."""
+        if not self.enabled:
+            return
+        for item in self.streamer.feed(chunk):
+            if self._held is not None:
+                await self._send(self._held, final=False)
+            self._held = item
+
+    async def finish(self):
+        """Sends the held-back result as the final PARTIAL, once the model output is complete."""
+        if self._held is not None:
+            await self._send(self._held, final=True)
+            self._held = None
+
+    async def _send(self, data: dict, final: bool):
+        header = self.task_message.header
+        message = Message(
+            header=Header(
+                correlation_id=header.correlation_id,
+                task_id=header.task_id,
+                message_type="PARTIAL",
+                source_agent=self.agent_name,
+                target_agent=header.source_agent,
+            ),
+            payload=PartialPayload(seq=self.sent, data=data, final=final),
+        )
+        try:
+            await self.broker.send_partial(header.reply_to_channel, message.model_dump())
+        except Exception as e:
+            # Partials are an early preview; the RESULT still carries everything.
+            logger.warning(f"[{self.agent_name}] Could not send partial result {self.sent}: {e}")
+            return
+        self.sent += 1
+        logger.info(f"[{self.agent_name}] Sent partial result {self.sent - 1}{' (final)' if final else ''} to {header.reply_to_channel}")
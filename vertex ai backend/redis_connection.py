@@ -0,0 +1,279 @@
+"""
+Process-wide Redis connection factory.
+
+MessageBroker, AsyncMessageBroker, RedisSessionService and the maintenance scripts
+all take their clients from here, so a process keeps one sync and one asyncio
+connection pool no matter how many brokers or services it creates.
+
+Setting REDIS_CLUSTER_NODES switches every client to Redis Cluster. Keys that are
+used together in one command or script must then live in the same hash slot;
+``hash_tag`` marks the part of a key name that decides the slot.
+
+Configuration (environment variables):
+  REDIS_HOST                   Hostname of the Redis server (default: localhost)
+  REDIS_PORT                   Port of the Redis server (default: 6379)
+  REDIS_SOCKET_PATH            Unix domain socket path; takes precedence over host/port
+  REDIS_PASSWORD               Password, if the server requires AUTH
+  REDIS_DB                     Database number (default: 0)
+  REDIS_MAX_CONNECTIONS        Connections per pool (default: 50)
+  REDIS_POOL_TIMEOUT           Seconds to wait for a free connection before failing (default: 20)
+  REDIS_HEALTH_CHECK_INTERVAL  Seconds a connection may sit idle before it is PINGed on checkout (default: 30)
+  REDIS_CLUSTER_NODES          Comma-separated host:port startup nodes; enables Redis Cluster mode
+
+The asyncio pool binds its connections to the event loop that first uses them, so
+each process should drive its async clients from a single event loop.
+"""
+import logging
+import os
+import re
+import threading
+
+import redis
+import redis.asyncio
+import redis.asyncio.cluster
+import redis.cluster
+from redis.crc import key_slot as _key_slot
+
+logger = logging.getLogger(__name__)
+
+
+def _env_int(name: str, default: int) -> int:
+    digits = "".join(filter(str.isdigit, os.getenv(name, "")))
+    return int(digits) if digits else default
+
+
+def connection_settings() -> dict:
+    """Reads the connection settings from the environment."""
+    host = re.sub(r'[^\x00-\x7F]+', '', os.getenv("REDIS_HOST", "localhost")).strip() or "localhost"
+    return {
+        "host": host,
+        "port": _env_int("REDIS_PORT", 6379),
+        "socket_path": os.getenv("REDIS_SOCKET_PATH", "").strip() or None,
+        "password": os.getenv("REDIS_PASSWORD", None),
+        "db": _env_int("REDIS_DB", 0),
+        "max_connections": _env_int("REDIS_MAX_CONNECTIONS", 50),
+        "pool_timeout": _env_int("REDIS_POOL_TIMEOUT", 20),
+        "health_check_interval": _env_int("REDIS_HEALTH_CHECK_INTERVAL", 30),
+        "cluster_nodes": _cluster_nodes(os.getenv("REDIS_CLUSTER_NODES", "")),
+    }
+
+
+def _cluster_nodes(value: str) -> list[tuple[str, int]]:
+    nodes = []
+    for node in filter(None, (part.strip() for part in value.split(","))):
+        host, _, port = node.rpartition(":")
+        nodes.append((host or node, int(port) if port.isdigit() else 6379))
+    return nodes
+
+
+def is_cluster() -> bool:
+    """Whether clients talk to Redis Cluster (REDIS_CLUSTER_NODES is set)."""
+    return bool(os.getenv("REDIS_CLUSTER_NODES", "").strip())
+
+
+def hash_tag(value: str) -> str:
+    """Marks ``value`` as the hash tag of a key on Redis Cluster, e.g. ``tasks:{flight_agent}``.
+
+    Keys sharing a tag map to the same slot. Outside cluster mode the value is
+    returned unchanged, so standalone deployments keep their existing key names.
+    """
+    return f"{{{value}}}" if is_cluster() else value
+
+
+def key_slot(key: str | bytes) -> int:
+    """The cluster hash slot of ``key`` (honours hash tags)."""
+    return _key_slot(key.encode() if isinstance(key, str) else key)
+
+
+def same_slot(*keys: str | bytes) -> bool:
+    """True outside cluster mode, or if every key maps to the same slot."""
+    return not is_cluster() or len({key_slot(key) for key in keys}) <= 1
+
+
+def describe_endpoint(settings: dict | None = None) -> str:
+    """Human-readable endpoint for log messages, e.g. ``localhost:6379 (DB: 0)``."""
+    settings = settings or connection_settings()
+    if settings["cluster_nodes"]:
+        return "cluster " + ",".join(f"{host}:{port}" for host, port in settings["cluster_nodes"])
+    where = f"unix://{settings['socket_path']}" if settings["socket_path"] else f"{settings['host']}:{settings['port']}"
+    return f"{where} (DB: {settings['db']})"
+
+
+def _pool_kwargs(settings: dict, unix_connection_class, tcp_connection_class) -> dict:
+    kwargs = {
+        "max_connections": settings["max_connections"],
+        "timeout": settings["pool_timeout"],
+        "password": settings["password"],
+        "db": settings["db"],
+        "health_check_interval": settings["health_check_interval"],
+        "decode_responses": False,
+    }
+    if settings["socket_path"]:
+        kwargs.update(connection_class=unix_connection_class, path=settings["socket_path"])
+    else:
+        kwargs.update(connection_class=tcp_connection_class, host=settings["host"], port=settings["port"])
+    return kwargs
+
+
+class _SyncPool(redis.BlockingConnectionPool):
+    """Blocking pool that counts checkouts and created connections, to measure reuse."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.created = 0
+
+    def make_connection(self):
+        self.created += 1
+        return super().make_connection()
+
+    def get_connection(self, *args, **kwargs):
+        self.checkouts += 1
+        return super().get_connection(*args, **kwargs)
+
+
+class _AsyncPool(redis.asyncio.BlockingConnectionPool):
+    """asyncio counterpart of _SyncPool."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.created = 0
+
+    def make_connection(self):
+        self.created += 1
+        return super().make_connection()
+
+    async def get_connection(self, *args, **kwargs):
+        self.checkouts += 1
+        return await super().get_connection(*args, **kwargs)
+
+
+_lock = threading.Lock()
+_sync_pool: _SyncPool | None = None
+_async_pool: _AsyncPool | None = None
+# In cluster mode each client keeps a pool per node, so the client itself is what gets shared.
+_sync_cluster: redis.cluster.RedisCluster | None = None
+_async_cluster: redis.asyncio.cluster.RedisCluster | None = None
+
+
+def _cluster_kwargs(settings: dict) -> dict:
+    return {
+        "startup_nodes": [redis.cluster.ClusterNode(host, port) for host, port in settings["cluster_nodes"]],
+        "password": settings["password"],
+        "max_connections": settings["max_connections"],
+        "health_check_interval": settings["health_check_interval"],
+        "decode_responses": False,
+    }
+
+
+def _get_sync_cluster() -> redis.cluster.RedisCluster:
+    global _sync_cluster
+    with _lock:
+        if _sync_cluster is None:
+            settings = connection_settings()
+            _sync_cluster = redis.cluster.RedisCluster(**_cluster_kwargs(settings))
+            logger.info(f"Connected Redis Cluster client to {describe_endpoint(settings)}, max_connections={settings['max_connections']} per node.")
+        return _sync_cluster
+
+
+def _get_async_cluster() -> redis.asyncio.cluster.RedisCluster:
+    global _async_cluster
+    with _lock:
+        if _async_cluster is None:
+            settings = connection_settings()
+            kwargs = _cluster_kwargs(settings)
+            kwargs["startup_nodes"] = [redis.asyncio.cluster.ClusterNode(host, port) for host, port in settings["cluster_nodes"]]
+            _async_cluster = redis.asyncio.cluster.RedisCluster(**kwargs)
+            logger.info(f"Created asyncio Redis Cluster client for {describe_endpoint(settings)}, max_connections={settings['max_connections']} per node.")
+        return _async_cluster
+
+
+def get_pool() -> redis.BlockingConnectionPool:
+    """Returns the process-wide sync connection pool, creating it on first use."""
+    global _sync_pool
+    with _lock:
+        if _sync_pool is None:
+            settings = connection_settings()
+            _sync_pool = _SyncPool(**_pool_kwargs(settings, redis.UnixDomainSocketConnection, redis.Connection))
+            logger.info(f"Created Redis connection pool for {describe_endpoint(settings)}, max_connections={settings['max_connections']}.")
+        return _sync_pool
+
+
+def get_async_pool() -> redis.asyncio.BlockingConnectionPool:
+    """Returns the process-wide asyncio connection pool, creating it on first use."""
+    global _async_pool
+    with _lock:
+        if _async_pool is None:
+            settings = connection_settings()
+            _async_pool = _AsyncPool(**_pool_kwargs(settings, redis.asyncio.UnixDomainSocketConnection, redis.asyncio.Connection))
+            logger.info(f"Created asyncio Redis connection pool for {describe_endpoint(settings)}, max_connections={settings['max_connections']}.")
+        return _async_pool
+
+
+def get_client() -> redis.Redis | redis.cluster.RedisCluster:
+    """A sync client on the shared pool, or the shared cluster client. Responses are bytes."""
+    if is_cluster():
+        return _get_sync_cluster()
+    return redis.Redis(connection_pool=get_pool())
+
+
+def get_async_client() -> redis.asyncio.Redis | redis.asyncio.cluster.RedisCluster:
+    """An asyncio client on the shared pool, or the shared cluster client. Responses are bytes."""
+    if is_cluster():
+        return _get_async_cluster()
+    return redis.asyncio.Redis(connection_pool=get_async_pool())
+
+
+def use_fakeredis():
+    """Backs the shared sync and asyncio pools with one in-memory fakeredis server, so
+    benchmarks and local experiments run without a redis-server. Needs ``pip install fakeredis``."""
+    global _sync_pool, _async_pool
+    try:
+        import fakeredis
+        import fakeredis.aioredis
+    except ImportError as e:
+        raise RuntimeError("fakeredis is not available: pip install fakeredis") from e
+    server = fakeredis.FakeServer()
+    with _lock:
+        _sync_pool = _SyncPool(connection_class=fakeredis.FakeConnection, server=server)
+        _async_pool = _AsyncPool(connection_class=fakeredis.aioredis.FakeConnection, server=server)
+    logger.info("Using an in-memory fakeredis server instead of Redis.")
+
+
+def pool_stats() -> dict:
+    """Connection reuse per pool: checkouts, connections created and the share of checkouts served by reuse."""
+    stats = {}
+    for name, pool in (("sync", _sync_pool), ("async", _async_pool)):
+        if pool is None:
+            continue
+        stats[name] = {
+            "max_connections": pool.max_connections,
+            "checkouts": pool.checkouts,
+            "created": pool.created,
+            "reuse_ratio": round(1 - pool.created / pool.checkouts, 4) if pool.checkouts else None,
+        }
+    return stats
+
+
+def reset():
+    """Disconnects and forgets the sync pool and cluster client, e.g. after the environment changed."""
+    global _sync_pool, _sync_cluster
+    with _lock:
+        if _sync_pool is not None:
+            _sync_pool.disconnect()
+        if _sync_cluster is not None:
+            _sync_cluster.close()
+        _sync_pool = _sync_cluster = None
+
+
+async def close_async_pool():
+    """Disconnects and forgets the asyncio pool and cluster client. Call from the event loop that used them."""
+    global _async_pool, _async_cluster
+    with _lock:
+        pool, _async_pool = _async_pool, None
+        cluster, _async_cluster = _async_cluster, None
+    if pool is not None:
+        await pool.disconnect()
+    if cluster is not None:
+        await cluster.aclose()
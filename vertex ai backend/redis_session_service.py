@@ -1,13 +1,12 @@
-import redis
 import json
 import os
 import uuid
 import base64
-from google.adk.sessions.base_session_service import BaseSessionService
+from google.adk.sessions.base_session_service import BaseSessionService, GetSessionConfig
 from google.adk.events import Event
 from google.adk.sessions import Session, State
 
-import re
+import redis_connection
 
 class SessionJSONEncoder(json.JSONEncoder):
     """Custom JSON encoder to handle bytes and other non-serializable types."""
@@ -34,50 +33,130 @@ def decode_custom_types(obj):
     else:
         return obj
 
+def session_key(session_id: str) -> str:
+    """Redis hash of a session; on Redis Cluster the session ID is the key's hash tag."""
+    return f"session:{redis_connection.hash_tag(session_id)}"
+
+def events_key(session_id: str) -> str:
+    """Redis list of a session's events, oldest first. Shares the session hash's slot."""
+    return f"{session_key(session_id)}:events"
+
+# Session hash layout: META_FIELD holds app_name, user_id and last_update_time as JSON,
+# and each state key is a field of its own, STATE_PREFIX + key, holding the value as JSON.
+# Sessions written before this layout keep everything, events included, in LEGACY_FIELD;
+# they are converted the first time they are read.
+META_FIELD = "meta"
+STATE_PREFIX = "state:"
+LEGACY_FIELD = "session_data"
+
+def _dumps(obj) -> str:
+    return json.dumps(obj, cls=SessionJSONEncoder)
+
+def _loads(raw):
+    return decode_custom_types(json.loads(raw))
+
 class RedisSessionService(BaseSessionService):
+    """
+    ADK session service on Redis, through redis.asyncio so that loading and saving
+    sessions never blocks the event loop the ADK runner and the broker share.
+
+    Appending an event costs one RPUSH of that event plus HSETs of the state keys it
+    changed, however long the conversation already is, and ``get_session`` can load
+    just the newest events (``config.num_recent_events``, or SESSION_EVENT_WINDOW for
+    every load).
+    """
+
     def __init__(self):
-        redis_host = os.getenv("REDIS_HOST", "localhost").strip()
-        redis_host = re.sub(r'[^\x00-\x7F]+', '', redis_host).strip()
-        port_str = "".join(filter(str.isdigit, os.getenv("REDIS_PORT", "6379")))
-        redis_port = int(port_str) if port_str else 6379
-        redis_password = os.getenv("REDIS_PASSWORD", None)
-        redis_db = int(os.getenv("REDIS_DB", "0"))
+        # Shares the process-wide asyncio pool with AsyncMessageBroker; responses are bytes.
+        # Like the pool, the service must be used from a single event loop.
+        self.redis_client = redis_connection.get_async_client()
+        # Newest events loaded by get_session when the caller does not ask for a number; 0 loads all.
+        self.event_window = int(os.getenv("SESSION_EVENT_WINDOW", "0"))
+
+    @staticmethod
+    def _session_fields(session: Session) -> dict[str, str]:
+        fields = {META_FIELD: _dumps({"app_name": session.app_name, "user_id": session.user_id, "last_update_time": session.last_update_time})}
+        fields.update({STATE_PREFIX + key: _dumps(value) for key, value in session.state.items() if not key.startswith(State.TEMP_PREFIX)})
+        return fields
 
-        self.redis_client = redis.Redis(host=redis_host, port=redis_port, password=redis_password, db=redis_db, decode_responses=True)
+    async def _write_session(self, session: Session, events: list | None = None):
+        """Replaces a session's metadata and state, and its events too if ``events`` is given, atomically."""
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.delete(session_key(session.id))
+        pipe.hset(session_key(session.id), mapping=self._session_fields(session))
+        if events is not None:
+            pipe.delete(events_key(session.id))
+            if events:
+                pipe.rpush(events_key(session.id), *(_dumps(event.model_dump()) for event in events))
+        await pipe.execute()
 
     async def create_session(self, app_name: str, user_id: str, id: str = None, session_id: str = None, state: State = None) -> Session:
         session_id = id or session_id or str(uuid.uuid4())
         session = Session(app_name=app_name, user_id=user_id, id=session_id, state=state or {})
-        self.redis_client.hset(f"session:{session_id}", "session_data", json.dumps(session.model_dump(), cls=SessionJSONEncoder))
+        await self._write_session(session, events=[])
         return session
 
-    async def get_session(self, app_name: str, user_id: str, id: str = None, session_id: str = None) -> Session | None:
+    async def get_session(self, app_name: str, user_id: str, id: str = None, session_id: str = None, config: GetSessionConfig | None = None) -> Session | None:
         session_id = id or session_id
         if not session_id:
             return None
-        session_data = self.redis_client.hget(f"session:{session_id}", "session_data")
-        if session_data:
-            session_dict = json.loads(session_data)
-            # Decode custom types (bytes, etc.) back to Python objects
-            session_dict = decode_custom_types(session_dict)
-            return Session.model_validate(session_dict)
-        return None
+        window = config.num_recent_events if config and config.num_recent_events else self.event_window
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.hgetall(session_key(session_id))
+        pipe.lrange(events_key(session_id), -window if window > 0 else 0, -1)
+        fields, raw_events = await pipe.execute()
+        if not fields:
+            return None
+        fields = {name.decode(): value for name, value in fields.items()}
+        if LEGACY_FIELD in fields and META_FIELD not in fields:
+            session = await self._convert_legacy(fields[LEGACY_FIELD])
+            if window > 0:
+                session.events = session.events[-window:]
+        else:
+            meta = json.loads(fields[META_FIELD])
+            session = Session(
+                app_name=meta["app_name"],
+                user_id=meta["user_id"],
+                id=session_id,
+                state={name[len(STATE_PREFIX):]: _loads(value) for name, value in fields.items() if name.startswith(STATE_PREFIX)},
+                events=[Event.model_validate(_loads(raw)) for raw in raw_events],
+                last_update_time=meta.get("last_update_time") or 0.0,
+            )
+        if config and config.after_timestamp:
+            session.events = [event for event in session.events if event.timestamp >= config.after_timestamp]
+        return session
+
+    async def _convert_legacy(self, session_data: bytes) -> Session:
+        """Reads a session stored as one JSON document and rewrites it in the hash + event list layout."""
+        session = Session.model_validate(_loads(session_data))
+        await self._write_session(session, events=session.events)
+        return session
 
     async def update_session(self, session: Session):
-        self.redis_client.hset(f"session:{session.id}", "session_data", json.dumps(session.model_dump(), cls=SessionJSONEncoder))
+        """Saves the session's metadata and state. Events are saved as they are appended."""
+        await self._write_session(session)
 
     async def append_event(self, session: Session, event):
-        """Override to persist events to Redis immediately."""
-        # Call parent method to add event to session.events in memory
+        """Persists the event, and the state keys it changed, as soon as it is appended."""
+        # Call parent method to add event to session.events and apply its state delta in memory
         event = await super().append_event(session, event)
-        # Persist the updated session to Redis
-        await self.update_session(session)
+        if event.partial:
+            return event
+        session.last_update_time = event.timestamp
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.rpush(events_key(session.id), _dumps(event.model_dump()))
+        changed = event.actions.state_delta if event.actions else {}
+        # temp: keys live only for the current invocation, as in ADK's own services.
+        fields = {STATE_PREFIX + key: _dumps(value) for key, value in changed.items() if not key.startswith(State.TEMP_PREFIX)}
+        fields[META_FIELD] = _dumps({"app_name": session.app_name, "user_id": session.user_id, "last_update_time": session.last_update_time})
+        pipe.hset(session_key(session.id), mapping=fields)
+        await pipe.execute()
         return event
 
     async def delete_session(self, app_name: str, user_id: str, id: str = None, session_id: str = None):
         session_id = id or session_id
         if session_id:
-            self.redis_client.delete(f"session:{session_id}")
+            await self.redis_client.delete(session_key(session_id), events_key(session_id))
 
     async def list_sessions(self, app_name: str, user_id: str) -> list[str]:
         # This is not trivial to implement with the current schema.
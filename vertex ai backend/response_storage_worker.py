@@ -18,6 +18,7 @@ from firebase_admin import db, credentials
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '.')))
 
 from message_broker import MessageBroker
+from message_protocol import load_data
 from redis_session_service import RedisSessionService
 
 # --- Logging ---
@@ -64,11 +65,10 @@ class ResponseStorageWorker:
         while not self.stop_event.is_set():
             try:
                 # Use a shorter timeout so we can check stop_event regularly
-                result = self.broker.redis_client.blpop(self.results_queue, timeout=2)
+                response = self.broker.pop_reply(self.results_queue, timeout=2)
 
-                if result:
-                    _, response_data = result
-                    self._process_response(response_data)
+                if response:
+                    self._process_response(response)
 
             except Exception as e:
                 logger.error(f"Error in worker loop: {e}", exc_info=True)
@@ -77,10 +77,9 @@ class ResponseStorageWorker:
 
         logger.info("Worker thread exiting")
 
-    def _process_response(self, response_data: bytes):
+    def _process_response(self, response: dict):
         """Process and store a single response to Firebase."""
         try:
-            response = json.loads(response_data)
             logger.info(f"Processing response: {json.dumps(response, indent=2)[:500]}")
 
             # Extract information from response
@@ -91,7 +90,7 @@ class ResponseStorageWorker:
             source_agent = header.get("source_agent", "")
 
             # Handle ResultPayload structure with data field
-            data = payload.get("data", {})
+            data = load_data(payload, {})
             agent_response_text = data.get("response", "")
             user_id = data.get("user_id")
             itinerary_id = data.get("itinerary_id")
@@ -174,9 +173,6 @@ class ResponseStorageWorker:
 
             logger.info(f"Successfully stored response with correlation_id: {correlation_id}")
 
-        except json.JSONDecodeError as e:
-            logger.error(f"Failed to decode JSON response: {e}", exc_info=True)
-            logger.error(f"Raw response data: {response_data}")
         except Exception as e:
             logger.error(f"Error processing response: {e}", exc_info=True)
             # Try to set typing indicator to false even if processing failed
@@ -1,10 +1,11 @@
 import json
 import logging
 import asyncio
-from message_broker import MessageBroker
+from message_broker import AsyncMessageBroker, agent_task_queue, agent_processing_queue, agent_dead_letter_queue
 from message_protocol import Message, Header, TaskPayload
 from router_agent.agent import agent
 from google.adk.runners import Runner
+from google.adk.sessions import BaseSessionService
 from redis_session_service import RedisSessionService
 from google.genai import types
 
@@ -12,64 +13,59 @@ from google.genai import types
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('message_broker')
 
+# Agents the router feeds; background requests wait while their queues are above the background high-water mark.
+DOWNSTREAM_AGENTS = ["main_agent"]
+
 class RouterAgent:
-    def __init__(self):
-        self.broker = MessageBroker()
+    def __init__(self, broker: AsyncMessageBroker | None = None, session_service: BaseSessionService | None = None):
+        self.broker = broker or AsyncMessageBroker()
         self.agent_name = "router_agent"
         self.llm_agent = agent
-        self.session_service = RedisSessionService()
+        self.session_service = session_service or RedisSessionService()
         self.runner = Runner(
             agent=self.llm_agent,
             app_name=f"{self.agent_name}_app",
             session_service=self.session_service
         )
 
-    def _invoke_llm_sync(self, user_request: str, correlation_id: str) -> str:
-        """Invokes the agent's LLM synchronously using the Runner."""
-        async def _run_async():
-            user_id = "user"
-            session_id = correlation_id
+    async def _invoke_llm_sync(self, user_request: str, correlation_id: str) -> str:
+        """Invokes the agent's LLM using the Runner on the worker's event loop."""
+        user_id = "user"
+        session_id = correlation_id
 
-            session = await self.session_service.get_session(
+        session = await self.session_service.get_session(
+            app_name=self.runner.app_name,
+            user_id=user_id,
+            id=session_id
+        )
+        if not session:
+            logging.info(f"Creating new session for user: {user_id}, session: {session_id}")
+            await self.session_service.create_session(
                 app_name=self.runner.app_name,
                 user_id=user_id,
-                id=session_id
+                id=session_id,
+                state={}
             )
-            if not session:
-                logging.info(f"Creating new session for user: {user_id}, session: {session_id}")
-                await self.session_service.create_session(
-                    app_name=self.runner.app_name,
-                    user_id=user_id,
-                    id=session_id,
-                    state={}
-                )
 
-            content = types.Content(role='user', parts=[types.Part(text=user_request)])
-            final_response_text = ""
-            async for event in self.runner.run_async(user_id=user_id, session_id=session_id, new_message=content):
-                if event.is_final_response():
-                    if event.content and event.content.parts:
-                        final_response_text = event.content.parts[0].text
-                    break
-            return final_response_text
-
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        try:
-            result = loop.run_until_complete(_run_async())
-            return result
-        finally:
-            loop.close()
-
-    def run(self):
-        main_queue = f"tasks:{self.agent_name}"
-        processing_queue = f"processing:{self.agent_name}"
-        dlq = f"dlq:{self.agent_name}"
+        content = types.Content(role='user', parts=[types.Part(text=user_request)])
+        final_response_text = ""
+        async for event in self.runner.run_async(user_id=user_id, session_id=session_id, new_message=content):
+            if event.is_final_response():
+                if event.content and event.content.parts:
+                    final_response_text = event.content.parts[0].text
+                break
+        return final_response_text
+
+    async def run(self):
+        main_queue = agent_task_queue(self.agent_name)
+        processing_queue = agent_processing_queue(self.agent_name)
+        dlq = agent_dead_letter_queue(self.agent_name)
         max_retries = 3
 
+        await self.broker.connect()
         logger.info(f"[{self.agent_name}] is waiting for tasks on {main_queue}...")
         while True:
-            task_message_dict = self.broker.start_atomic_task(main_queue, processing_queue)
+            task_message_dict = await self.broker.start_atomic_task(main_queue, processing_queue)
             if not task_message_dict:
                 continue
 
@@ -78,9 +74,16 @@ class RouterAgent:
                 correlation_id = task_message.header.correlation_id
                 logger.info(f"[{self.agent_name}] Received task: {task_message.payload.task_name} with Correlation ID: {correlation_id}")
 
+                if task_message.header.priority == "background":
+                    admission = await self.broker.check_admission([agent_task_queue(agent) for agent in DOWNSTREAM_AGENTS], "background")
+                    if not admission.admitted:
+                        # Shed load: put background work off until the downstream backlog drains
+                        await self.broker.defer_task(processing_queue, main_queue, task_message_dict, admission.retry_after)
+                        continue
+
                 llm_input = task_message.payload.parameters["user_request"]
                 
-                llm_response_str = self._invoke_llm_sync(llm_input, correlation_id)
+                llm_response_str = await self._invoke_llm_sync(llm_input, correlation_id)
                 logger.info(f"[{self.agent_name}] Raw LLM response: {llm_response_str}")
                 logger.info(f"[{self.agent_name}] Raw LLM response: {llm_response_str}")
 
@@ -103,7 +106,9 @@ class RouterAgent:
                     message_type="TASK",
                     source_agent=self.agent_name,
                     target_agent=target_agent,
-                    reply_to_channel=task_message.header.reply_to_channel
+                    reply_to_channel=task_message.header.reply_to_channel,
+                    priority=task_message.header.priority,
+                    deadline=task_message.header.deadline
                 )
                 task_payload = TaskPayload(
                     task_name=next_task,
@@ -111,19 +116,14 @@ class RouterAgent:
                 )
                 new_task_message = Message(header=task_header, payload=task_payload)
 
-                self.broker.enqueue_task(f"tasks:{target_agent}", new_task_message.model_dump())
+                # Ack the incoming task and hand it on in one atomic round trip
+                await self.broker.complete_task(processing_queue, task_message_dict, agent_task_queue(target_agent), new_task_message.model_dump())
                 logger.info(f"[{self.agent_name}] Delegated task '{next_task}' to {target_agent}")
 
-                self.broker.finish_atomic_task(processing_queue, task_message_dict)
-
             except Exception as e:
                 logger.error(f"[{self.agent_name}] Task failed: {e}", exc_info=True)
-                task_message_dict['retry_count'] = task_message_dict.get('retry_count', 0) + 1
-                if task_message_dict['retry_count'] >= max_retries:
-                    self.broker.move_to_dlq(processing_queue, dlq, task_message_dict)
-                else:
-                    self.broker.requeue_failed_task(processing_queue, main_queue, task_message_dict)
+                await self.broker.fail_task(processing_queue, main_queue, dlq, task_message_dict, max_retries, error=e)
 
 if __name__ == "__main__":
     agent = RouterAgent()
-    agent.run()
\ No newline at end of file
+    asyncio.run(agent.run())
\ No newline at end of file
@@ -6,12 +6,10 @@ import sys
 import os
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from message_broker import MessageBroker
+import redis_connection
 
 def clear_all_sessions():
-    # Use MessageBroker which already has Redis connection
-    broker = MessageBroker()
-    redis_client = broker.redis_client
+    redis_client = redis_connection.get_client()
 
     # Get all session keys
     session_keys = redis_client.keys("session:*")
@@ -25,7 +23,7 @@ def clear_all_sessions():
     # Delete all session keys
     for key in session_keys:
         redis_client.delete(key)
-        print(f"Deleted: {key}")
+        print(f"Deleted: {key.decode()}")
 
     print(f"\nCleared {len(session_keys)} sessions from Redis")
     print("Old conversation history removed. New conversations will start fresh.")
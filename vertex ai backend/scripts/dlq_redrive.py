@@ -0,0 +1,195 @@
+"""Inspect dead-lettered tasks and redrive them to their agents at a controlled rate.
+
+Tasks land in ``dlq:<agent>`` once they exhaust their retries, with the failure
+that killed them in ``payload.last_error``. ``summary`` scans every DLQ (SCAN, then
+LRANGE in pages) and groups the dead tasks by agent and error. ``redrive`` moves the
+selected ones back to ``tasks:<agent>`` in pipelined batches, no faster than
+``--rate`` tasks per second, and waits while an agent's queue is above the broker's
+background high-water mark so a replay never buries the workers. Redriven tasks start
+over with a retry count of 0 and no deadline; the turn deadline a task carried has
+usually passed by the time it is redriven, and workers would drop it as expired. Both
+commands report how many tasks are past their deadline. Use ``--dry-run`` to see what
+would be moved.
+
+Errors are grouped with digits masked, so "429 ... retry in 31s" and "retry in 7s"
+fall in one group; ``--error`` filters on a substring of the original message.
+
+USAGE:
+  $ python scripts/dlq_redrive.py summary
+  $ python scripts/dlq_redrive.py summary --agent hotel_agent --json
+  $ python scripts/dlq_redrive.py redrive --error ResourceExhausted --dry-run
+  $ python scripts/dlq_redrive.py redrive --agent hotel_agent --rate 2 --batch-size 10
+"""
+import json
+import re
+import sys
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+
+import click
+from dotenv import load_dotenv
+
+# Add the project root to the Python path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+load_dotenv()
+
+import wire_codec
+from message_broker import MessageBroker, agent_dead_letter_queue, agent_task_queue
+
+NO_ERROR = "(no error recorded)"
+
+
+def _agent_name(dlq_key: str) -> str:
+    """``dlq:<agent>`` or ``dlq:{<agent>}`` (Redis Cluster) -> ``<agent>``."""
+    return dlq_key[len("dlq:"):].strip("{}")
+
+
+def _error_group(error: str | None) -> str:
+    if not error:
+        return NO_ERROR
+    return re.sub(r"\d+", "N", error.splitlines()[0])[:120]
+
+
+def scan_dead_letters(broker: MessageBroker, agents: tuple[str, ...], page_size: int):
+    """Yields ``(agent, raw entry, task)`` for every DLQ entry, oldest first per DLQ."""
+    if agents:
+        keys = [agent_dead_letter_queue(agent) for agent in agents]
+    else:
+        keys = sorted({key.decode() for key in broker.redis_client.scan_iter(match="dlq:*", count=500)})
+    for key in keys:
+        length = broker.redis_client.llen(key)
+        # LPUSH puts the newest entry at the head, so page backwards from the tail.
+        for end in range(length - 1, -1, -page_size):
+            page = broker.redis_client.lrange(key, max(0, end - page_size + 1), end)
+            for raw in reversed(page):
+                try:
+                    task = wire_codec.decode(raw)
+                except (TypeError, ValueError) as e:
+                    click.echo(f"Skipping undecodable entry in '{key}': {e}", err=True)
+                    continue
+                yield _agent_name(key), raw, task
+
+
+def _selected(broker: MessageBroker, agents: tuple[str, ...], error: str | None, page_size: int):
+    for agent, raw, task in scan_dead_letters(broker, agents, page_size):
+        last_error = task.get("payload", {}).get("last_error")
+        if error is None or (last_error and error in last_error):
+            yield agent, raw, task
+
+
+def summarize(broker: MessageBroker, agents: tuple[str, ...], error: str | None, page_size: int) -> list[dict]:
+    groups: dict[tuple[str, str], list[dict]] = defaultdict(list)
+    for agent, _, task in _selected(broker, agents, error, page_size):
+        groups[(agent, _error_group(task.get("payload", {}).get("last_error")))].append(task)
+    return [
+        {
+            "agent": agent,
+            "error": group,
+            "count": len(tasks),
+            "task_names": dict(Counter(task.get("payload", {}).get("task_name") for task in tasks)),
+            "expired": sum(MessageBroker._expired(task) for task in tasks),
+            "oldest": tasks[0].get("header", {}).get("timestamp"),
+            "sample_correlation_ids": [task.get("header", {}).get("correlation_id") for task in tasks[:3]],
+        }
+        for (agent, group), tasks in sorted(groups.items(), key=lambda item: -len(item[1]))
+    ]
+
+
+def _wait_for_capacity(broker: MessageBroker, agent: str):
+    """Sleeps while the agent's queue is over the background high-water mark."""
+    while True:
+        admission = broker.check_admission([agent_task_queue(agent)], "background")
+        if admission.admitted:
+            return
+        click.echo(f"'{admission.queue}' holds {admission.depth} tasks (limit {admission.limit}); waiting {admission.retry_after}s.", err=True)
+        time.sleep(admission.retry_after)
+
+
+def redrive(broker: MessageBroker, agents: tuple[str, ...], error: str | None, page_size: int, rate: float, batch_size: int, limit: int | None, dry_run: bool) -> tuple[Counter, Counter]:
+    """Redrives the selected dead letters. Returns how many were moved per agent, and how
+    many of the selected tasks per agent were past their deadline (which redriving clears)."""
+    by_agent: dict[str, list[bytes]] = defaultdict(list)
+    expired: Counter = Counter()
+    for agent, raw, task in _selected(broker, agents, error, page_size):
+        if limit is not None and sum(map(len, by_agent.values())) >= limit:
+            break
+        by_agent[agent].append(raw)
+        is_expired = MessageBroker._expired(task)
+        expired[agent] += is_expired
+        if dry_run:
+            header = task.get("header", {})
+            click.echo(f"[dry-run] {agent}: {task.get('payload', {}).get('task_name')} correlation_id={header.get('correlation_id')} error={task.get('payload', {}).get('last_error') or NO_ERROR}{' (past deadline)' if is_expired else ''}")
+
+    moved: Counter = Counter()
+    if dry_run:
+        for agent, entries in by_agent.items():
+            moved[agent] = len(entries)
+        return moved, expired
+
+    started, sent = time.monotonic(), 0
+    for agent, entries in by_agent.items():
+        for start in range(0, len(entries), batch_size):
+            _wait_for_capacity(broker, agent)
+            batch = entries[start:start + batch_size]
+            moved[agent] += broker.redrive_dead_letters(agent_dead_letter_queue(agent), agent_task_queue(agent), batch)
+            sent += len(batch)
+            # Pace whole batches so the average stays at or below ``rate`` tasks per second.
+            ahead = sent / rate - (time.monotonic() - started)
+            if ahead > 0:
+                time.sleep(ahead)
+    return moved, expired
+
+
+@click.group()
+def cli():
+    """Inspect and redrive dead-lettered agent tasks."""
+
+
+def _selection_options(command):
+    command = click.option("--agent", "agents", multiple=True, help="Only this agent's DLQ; repeat for several. Default: every dlq:* key.")(command)
+    command = click.option("--error", default=None, help="Only tasks whose last error contains this text.")(command)
+    command = click.option("--page-size", default=200, show_default=True, help="Entries read per LRANGE.")(command)
+    return command
+
+
+@cli.command()
+@_selection_options
+@click.option("--json", "as_json", is_flag=True, help="Emit one JSON object per group.")
+def summary(agents: tuple[str, ...], error: str | None, page_size: int, as_json: bool) -> None:
+    """Counts dead-lettered tasks per agent and error."""
+    groups = summarize(MessageBroker(), agents, error, page_size)
+    if as_json:
+        for group in groups:
+            click.echo(json.dumps(group))
+        return
+    if not groups:
+        click.echo("No dead-lettered tasks.")
+        return
+    for group in groups:
+        click.echo(f"{group['count']:>6}  {group['agent']:<16} {group['error']}")
+        click.echo(f"        oldest {group['oldest']}, tasks {group['task_names']}, {group['expired']} past deadline, e.g. {', '.join(filter(None, group['sample_correlation_ids']))}")
+
+
+@cli.command("redrive")
+@_selection_options
+@click.option("--rate", default=5.0, show_default=True, help="Maximum tasks redriven per second.")
+@click.option("--batch-size", default=20, show_default=True, help="Tasks moved per pipelined round trip.")
+@click.option("--limit", type=int, default=None, help="Redrive at most this many tasks.")
+@click.option("--dry-run", is_flag=True, help="List the tasks that would be redriven without moving them.")
+def redrive_command(agents: tuple[str, ...], error: str | None, page_size: int, rate: float, batch_size: int, limit: int | None, dry_run: bool) -> None:
+    """Moves dead-lettered tasks back to their agents' task queues."""
+    if rate <= 0 or batch_size <= 0:
+        raise click.BadParameter("--rate and --batch-size must be positive.")
+    moved, expired = redrive(MessageBroker(), agents, error, page_size, rate, batch_size, limit, dry_run)
+    verb = "Would redrive" if dry_run else "Redrove"
+    for agent, count in sorted(moved.items()):
+        click.echo(f"{verb} {count} task(s) to {agent_task_queue(agent)}")
+    click.echo(f"{verb} {sum(moved.values())} task(s) in total.")
+    if sum(expired.values()):
+        click.echo(f"{sum(expired.values())} selected task(s) were past their deadline; redriving clears it.")
+
+
+if __name__ == "__main__":
+    cli()
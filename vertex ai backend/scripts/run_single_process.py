@@ -0,0 +1,139 @@
+"""Single-process runner for the whole agent pipeline.
+
+Runs the router, main and specialist agents as coroutines on one event loop,
+sends chat messages through them the way chat_backend does, and reports the
+end-to-end latency of each reply. By default the agents talk through an
+InProcessMessageBroker, so no message crosses the network; --redis-broker runs the
+same single process on the Redis broker instead, and the difference between the
+two is the cost of the Redis transport.
+
+Agents still call their LLMs and Firebase, so the usual .env settings apply.
+
+USAGE:
+  $ python scripts/run_single_process.py -m "Plan 3 days in Goa for 2 people"
+  $ python scripts/run_single_process.py -m "Weekend in Jaipur" --memory-sessions --json
+  $ python scripts/run_single_process.py -m "Weekend in Jaipur" --redis-broker
+"""
+import asyncio
+import importlib
+import json
+import sys
+import time
+import uuid
+from pathlib import Path
+
+import click
+from dotenv import load_dotenv
+
+# Add the project root to the Python path
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+load_dotenv()
+
+from config import SPECIALIST_AGENTS
+from inprocess_broker import InProcessMessageBroker, InProcessStore
+from message_broker import AsyncMessageBroker, agent_task_queue
+from message_protocol import Header, Message, TaskPayload, load_data
+
+REPLY_QUEUE = "results:user_interface"
+
+# (module, class) of every agent worker, in start order.
+AGENT_CLASSES = [
+    ("router_agent.__main__", "RouterAgent"),
+    *((f"{name}.__main__", name.split("_")[0].capitalize() + "AgentExecutor") for name in SPECIALIST_AGENTS),
+    ("main_agent.agent", "MainAgent"),
+]
+
+
+def _chat_task(message: str, user_id: str, itinerary_id: str) -> dict:
+    """The router task chat_backend enqueues for a chat message."""
+    return Message(
+        header=Header(
+            correlation_id=str(uuid.uuid4()),
+            message_type="TASK",
+            source_agent="user_interface",
+            target_agent="router_agent",
+            reply_to_channel=REPLY_QUEUE,
+            priority="interactive",
+        ),
+        payload=TaskPayload(
+            task_name="route_request",
+            parameters={
+                "user_request": message,
+                "session_id": f"{user_id}_{itinerary_id}",
+                "user_id": user_id,
+                "itinerary_id": itinerary_id,
+            },
+        ),
+    ).model_dump()
+
+
+async def run(messages: list[str], user_id: str, itinerary_id: str, redis_broker: bool, memory_sessions: bool, timeout: int) -> list[dict]:
+    store = InProcessStore()
+
+    def new_broker() -> AsyncMessageBroker:
+        return AsyncMessageBroker() if redis_broker else InProcessMessageBroker(store)
+
+    session_service = None
+    if memory_sessions:
+        from google.adk.sessions import InMemorySessionService
+        session_service = InMemorySessionService()
+
+    workers = []
+    for module_name, class_name in AGENT_CLASSES:
+        agent_class = getattr(importlib.import_module(module_name), class_name)
+        agent = agent_class(broker=new_broker(), session_service=session_service)
+        workers.append(asyncio.create_task(agent.run(), name=class_name))
+
+    client = new_broker()
+    await client.connect()
+    results = []
+    try:
+        for message in messages:
+            task = _chat_task(message, user_id, itinerary_id)
+            correlation_id = task["header"]["correlation_id"]
+            started = time.perf_counter()
+            await client.enqueue_task(agent_task_queue("router_agent"), task)
+            reply = None
+            while reply is None or reply.get("header", {}).get("correlation_id") != correlation_id:
+                remaining = timeout - (time.perf_counter() - started)
+                if remaining <= 0:
+                    reply = None
+                    break
+                reply = await client.pop_reply(REPLY_QUEUE, timeout=max(1, int(remaining)))
+            results.append({
+                "message": message,
+                "correlation_id": correlation_id,
+                "latency_s": round(time.perf_counter() - started, 3) if reply else None,
+                "response": load_data(reply["payload"], {}).get("response") if reply else None,
+            })
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        await client.close()
+    return results
+
+
+@click.command()
+@click.option("--message", "-m", "messages", multiple=True, required=True, help="Chat message to send; repeat for several turns.")
+@click.option("--user-id", default="single_process_user", show_default=True)
+@click.option("--itinerary-id", default="default", show_default=True)
+@click.option("--redis-broker", is_flag=True, help="Use the Redis broker instead of in-process queues, for comparison.")
+@click.option("--memory-sessions", is_flag=True, help="Keep ADK sessions in memory instead of Redis.")
+@click.option("--timeout", default=300, show_default=True, help="Seconds to wait for each reply.")
+@click.option("--json", "as_json", is_flag=True, help="Emit one JSON object per message.")
+def main(messages: tuple[str, ...], user_id: str, itinerary_id: str, redis_broker: bool, memory_sessions: bool, timeout: int, as_json: bool) -> None:
+    """Runs every agent in this process and times chat messages end to end."""
+    results = asyncio.run(run(list(messages), user_id, itinerary_id, redis_broker, memory_sessions, timeout))
+    for result in results:
+        if as_json:
+            click.echo(json.dumps(result))
+        else:
+            latency = f"{result['latency_s']}s" if result["latency_s"] is not None else "timed out"
+            click.echo(f"[{latency}] {result['message']}\n{result['response'] or ''}\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""
+Wire codecs for MessageBroker payloads.
+
+Every payload the broker writes to Redis is either a legacy plain-JSON document
+or an envelope that records which codec produced the body:
+
+    b"\\x00" | version (1 byte) | codec id (1 byte) | flags (1 byte) | body
+
+A leading NUL byte can never start a JSON document, so readers tell the two
+formats apart from the first byte. Plain JSON is still written while the
+active codec is "json" and no flags are needed, which keeps payloads readable
+by workers that predate envelopes during a rollout. Any worker running this
+module can read every registered codec regardless of the codec it writes.
+
+Bodies at or above a size threshold can also be compressed (zlib, or zstd when
+installed). The compressor is recorded in the envelope flags and undone
+transparently by ``decode``.
+"""
+import json
+import struct
+import zlib
+from typing import Any, Callable, NamedTuple, Protocol
+
+try:
+    import pydantic_core
+except ImportError:  # Optional dependency, installed with pydantic
+    pydantic_core = None
+
+try:
+    import orjson
+except ImportError:  # Optional dependency
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # Optional dependency
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:  # Optional dependency
+    zstandard = None
+
+ENVELOPE_MARKER = b"\x00"
+ENVELOPE_VERSION = 1
+_ENVELOPE_HEADER = struct.Struct("!cBBB")
+DEFAULT_CODEC = "json"
+
+# Envelope flag bits.
+FLAG_ZLIB = 0x01
+FLAG_ZSTD = 0x02
+_COMPRESSION_FLAGS = FLAG_ZLIB | FLAG_ZSTD
+
+
+class Codec(NamedTuple):
+    """A named serializer. ``codec_id`` is what gets written into the envelope."""
+    name: str
+    codec_id: int
+    dumps: Callable[[Any], bytes]
+    loads: Callable[[bytes], Any]
+
+
+_CODECS_BY_NAME: dict[str, Codec] = {}
+_CODECS_BY_ID: dict[int, Codec] = {}
+# Codecs that are known but whose library is not installed, with an install hint.
+_UNAVAILABLE: dict[str, str] = {}
+
+
+def register_codec(codec: Codec):
+    """Adds a codec to the registry. Codec ids must be stable across deployments."""
+    existing = _CODECS_BY_ID.get(codec.codec_id)
+    if existing and existing.name != codec.name:
+        raise ValueError(f"Codec id {codec.codec_id} is already used by '{existing.name}'.")
+    _CODECS_BY_NAME[codec.name] = codec
+    _CODECS_BY_ID[codec.codec_id] = codec
+    _UNAVAILABLE.pop(codec.name, None)
+
+
+def get_codec(name: str) -> Codec:
+    """Looks up a codec by name, raising ValueError if it is unknown or not installed."""
+    name = name.strip().lower()
+    if name in _CODECS_BY_NAME:
+        return _CODECS_BY_NAME[name]
+    if name in _UNAVAILABLE:
+        raise ValueError(f"Codec '{name}' is not available: {_UNAVAILABLE[name]}")
+    raise ValueError(f"Unknown codec '{name}'. Available codecs: {available_codecs()}")
+
+
+def available_codecs() -> list[str]:
+    return sorted(_CODECS_BY_NAME)
+
+
+class Compressor(NamedTuple):
+    """A compression algorithm and the envelope flag that marks bodies it produced."""
+    name: str
+    flag: int
+    compress: Callable[[bytes], bytes]
+    decompress: Callable[[bytes], bytes]
+
+
+_COMPRESSORS: dict[str, Compressor] = {
+    "zlib": Compressor("zlib", FLAG_ZLIB, lambda body: zlib.compress(body, 6), zlib.decompress),
+}
+if zstandard is not None:
+    _COMPRESSORS["zstd"] = Compressor(
+        "zstd", FLAG_ZSTD,
+        lambda body: zstandard.ZstdCompressor(level=3).compress(body),
+        lambda body: zstandard.ZstdDecompressor().decompress(body),
+    )
+
+
+def get_compressor(name: str) -> Compressor | None:
+    """Looks up a compressor by name; "none" (or an empty name) disables compression."""
+    name = (name or "none").strip().lower()
+    if name == "none":
+        return None
+    if name == "zstd" and zstandard is None:
+        raise ValueError("Compressor 'zstd' is not available: pip install zstandard")
+    if name not in _COMPRESSORS:
+        raise ValueError(f"Unknown compressor '{name}'. Available compressors: {sorted(_COMPRESSORS)} or 'none'")
+    return _COMPRESSORS[name]
+
+
+class SizeRecorder(Protocol):
+    """Receives the size of every encoded payload before and after compression,
+    e.g. ``broker_metrics.PAYLOAD_SIZES``."""
+
+    def record(self, size_in: int, size_out: int, compressed: bool) -> None: ...
+
+
+def encode(
+    obj: Any,
+    codec: Codec,
+    compressor: Compressor | None = None,
+    threshold: int = 0,
+    stats: SizeRecorder | None = None,
+) -> bytes:
+    """Serializes ``obj`` with ``codec``, wrapping it in an envelope unless it is plain JSON.
+
+    When a compressor is given and the body is at least ``threshold`` bytes, the
+    body is compressed, provided that actually makes it smaller.
+    """
+    return encode_body(codec.dumps(obj), codec, compressor, threshold, stats)
+
+
+def encode_body(
+    body: bytes,
+    codec: Codec,
+    compressor: Compressor | None = None,
+    threshold: int = 0,
+    stats: SizeRecorder | None = None,
+) -> bytes:
+    """Like ``encode`` for a body already serialized in ``codec``'s format."""
+    size_in = len(body)
+    flags = 0
+    if compressor is not None and size_in >= threshold:
+        packed = compressor.compress(body)
+        if len(packed) < size_in:
+            body, flags = packed, compressor.flag
+    raw = body if codec.name == DEFAULT_CODEC and not flags else wrap(body, codec, flags)
+    if stats is not None:
+        stats.record(size_in, len(raw), bool(flags))
+    return raw
+
+
+def wrap(body: bytes, codec: Codec, flags: int) -> bytes:
+    return _ENVELOPE_HEADER.pack(ENVELOPE_MARKER, ENVELOPE_VERSION, codec.codec_id, flags) + body
+
+
+def unwrap(raw: bytes | str) -> tuple[Codec, int, bytes | str]:
+    """Splits a stored payload into ``(codec, flags, body)``. Plain JSON maps to the json codec."""
+    if isinstance(raw, str) or not raw.startswith(ENVELOPE_MARKER):
+        return _CODECS_BY_NAME[DEFAULT_CODEC], 0, raw
+    _, version, codec_id, flags = _ENVELOPE_HEADER.unpack_from(raw)
+    if version != ENVELOPE_VERSION:
+        raise ValueError(f"Unsupported envelope version {version}.")
+    codec = _CODECS_BY_ID.get(codec_id)
+    if codec is None:
+        raise ValueError(f"Payload was written with unknown codec id {codec_id}.")
+    return codec, flags, raw[_ENVELOPE_HEADER.size:]
+
+
+def decode(raw: bytes | str) -> Any:
+    """Deserializes a payload written by any registered codec, or legacy plain JSON."""
+    codec, flags, body = unwrap(raw)
+    if flags & _COMPRESSION_FLAGS:
+        compressor = next((c for c in _COMPRESSORS.values() if flags & c.flag), None)
+        if compressor is None:
+            raise ValueError(f"Payload is compressed with an unavailable compressor (flags={flags:#x}).")
+        body = compressor.decompress(body)
+    return codec.loads(body)
+
+
+# pydantic_core's parser reads the same documents about twice as fast as json.loads.
+register_codec(Codec("json", 1, lambda obj: json.dumps(obj).encode("utf-8"), pydantic_core.from_json if pydantic_core is not None else json.loads))
+
+if orjson is not None:
+    register_codec(Codec("orjson", 2, lambda obj: orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS), orjson.loads))
+else:
+    _UNAVAILABLE["orjson"] = "pip install orjson"
+
+if msgpack is not None:
+    register_codec(Codec("msgpack", 3, lambda obj: msgpack.packb(obj, use_bin_type=True), lambda raw: msgpack.unpackb(raw, raw=False)))
+else:
+    _UNAVAILABLE["msgpack"] = "pip install msgpack"